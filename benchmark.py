@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Time the codecs and each stage of the export and import over a synthetic ROM,
+or a real one with --rom, and compare the results against a saved baseline.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import tomlkit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from lib import maps, util
+from lib.rom import Rom
+from lib.synthetic import make_rom
+from lib.simulate import simulate
+from lib.scan import scan
+from lib.decoders import TileDecoder, SpriteDecoder
+from lib.encoders import encode_tiles, encode_sprites
+from lib.sound import MinLibSound, read_pmmusic, write_pmmusic
+from lib.structures import GrandPrixTrack, TrackGhost, known_ranges, read2b_base
+
+
+class Result(NamedTuple):
+	# Best time of all the runs
+	seconds: float
+	# Bytes of input processed per run, 0 if it isn't meaningful
+	size: int
+	# Peak memory traced by tracemalloc during one run
+	peak: int
+
+	@property
+	def throughput(self) -> float:
+		return self.size / self.seconds if self.size and self.seconds else 0
+
+
+Stage = Tuple[str, Callable[[], object], int]
+
+
+def make_workspace(folder: str, rom_fn: Optional[str], seed: int) -> Tuple[str, dict]:
+	"""
+	Write a tracks.toml listing every track and, unless rom_fn is given,
+	a synthetic ROM into folder. Return the ROM's filename and the config.
+	"""
+	with open(os.path.join(HERE, "tracks.toml")) as f:
+		obj = tomlkit.loads(f.read())
+	config = {k: v for k, v in obj.items() if not isinstance(v, dict)}
+
+	doc = tomlkit.document()
+	for k, v in config.items():
+		doc[k] = v
+	for i in range(config["track_count"]):
+		table = tomlkit.table()
+		table["class"] = "GrandPrixTrack"
+		table["index"] = i
+		doc[f"Track{i}"] = table
+	with open(os.path.join(folder, "tracks.toml"), "wt") as f:
+		f.write(tomlkit.dumps(doc))
+
+	if rom_fn is None:
+		rom_fn = os.path.join(folder, "race.min")
+		with open(rom_fn, "wb") as f:
+			f.write(make_rom(config, seed))
+	return os.path.abspath(rom_fn), config
+
+
+def reset():
+	""" Forget everything a previous stage loaded so it's done again. """
+	for d in (
+		util.music, util.tilesets, util.spritesets, util.atlases, util.tileset_sources,
+		util.spriteset_sources, maps.made_tilesets
+	):
+		d.clear()
+	util.written.clear()
+	util.cache = None
+	util.manifest = None
+	util.paletted = False
+	util.writer = None
+
+
+def run_editor(*argv: str):
+	import race_map_editor
+	old_argv = sys.argv
+	sys.argv = ["race_map_editor.py", *argv]
+	try:
+		reset()
+		with redirect_stdout(io.StringIO()):
+			race_map_editor.main()
+	finally:
+		sys.argv = old_argv
+
+
+def make_stages(rom: Rom, rom_fn: str, config: dict, out: str) -> List[Stage]:
+	reset()
+	for i, name in enumerate(("easy", "normal", "hard")):
+		config[f"ai_{name}_table_base"] = read2b_base(rom, config["ai_table_base"], i)
+	util.load_tileset(rom, config["titles_grand_prix_tileset"], height=8)
+	util.load_tileset(rom, config["titles_menus_tileset"])
+	tracks = [GrandPrixTrack(f"Track{i}", i, config=config) for i in range(config["track_count"])]
+	for track in tracks:
+		track.read(rom)
+
+	tileset_bases = sorted({t.metadata.tileset_base for t in tracks})
+	sprite_bases = sorted({t.metadata.sprite_base for t in tracks})
+	tile_data = [rom.read(base, 10 * 16 * 8) for base in tileset_bases]
+	sprite_data = [rom.read(base, 12 * 16 * 64) for base in sprite_bases]
+	tile_size = sum(map(len, tile_data))
+	sprite_size = sum(map(len, sprite_data))
+	tile_images = [TileDecoder.from_bytes(b, height=10) for b in tile_data]
+	sprite_images = [SpriteDecoder.from_bytes(b, height=12) for b in sprite_data]
+
+	map_size = sum(len(t.tilemap) for t in tracks)
+	atlases = {base: util.load_atlas(base) for base in tileset_bases}
+
+	ghosts = [g for t in tracks for g in (t.ai_easy, t.ai_normal, t.ai_hard)]
+	ghost_bins = [g.to_bin() for g in ghosts]
+	ghost_strings = [g.to_string() for g in ghosts]
+	ghost_size = sum(map(len, ghost_bins))
+
+	bgm_table = util.Table(config["audio_table_base"], config["track_count"], (b"\xf0", b"\xf2"))
+	ai_tables = [
+		util.Table(config[f"ai_{name}_table_base"], config["track_count"], b"\xff\x00")
+		for name in ("easy", "normal", "hard")
+	]
+	bgm_table.read(rom)
+	songs = [MinLibSound.from_bin(f"track_{i}", d) for i, d in bgm_table.iter_entries(rom)]
+	song_mml = [s.to_pmmusic_mml() for s in songs]
+	song_size = sum(len(s.to_bin()) for s in songs)
+
+	tmx_folder = os.path.join(out, "tmx")
+	os.makedirs(tmx_folder, exist_ok=True)
+	for i, song in enumerate(songs):
+		util.music[i] = song
+
+	def read_tables():
+		for table in (bgm_table, *ai_tables):
+			table.read(rom)
+
+	def save_tmxs():
+		maps.made_tilesets.clear()
+		util.written.clear()
+		for track in tracks:
+			maps.save_tmx(track, tmx_folder)
+
+	def load_tmxs():
+		for track in tracks:
+			maps.load_tmx(GrandPrixTrack(track.ident, track.index, config=config), tmx_folder)
+
+	save_tmxs()
+	write_pmmusic(songs, tmx_folder)
+	export_folder = os.path.join(out, "export")
+	os.makedirs(export_folder, exist_ok=True)
+	export_args = (rom_fn, "x", "-o", export_folder, "-t", "-s", "-r", "--no-cache", "-F")
+
+	return [
+		("TileDecoder", lambda: [TileDecoder.from_bytes(b, height=10) for b in tile_data],
+			tile_size),
+		("SpriteDecoder", lambda: [SpriteDecoder.from_bytes(b, height=12) for b in sprite_data],
+			sprite_size),
+		("encode_tiles", lambda: [encode_tiles(im) for im in tile_images], tile_size),
+		("encode_sprites", lambda: [encode_sprites(im) for im in sprite_images], sprite_size),
+		("render_map", lambda: [
+			util.render_map(
+			t.metadata.width, t.metadata.height, t.tilemap, atlases[t.metadata.tileset_base]
+			) for t in tracks
+		], map_size),
+		("Table.read", read_tables, 0),
+		("TrackGhost.from_bin", lambda: [TrackGhost.from_bin(b) for b in ghost_bins], ghost_size),
+		("TrackGhost.from_string", lambda: [TrackGhost.from_string(s) for s in ghost_strings],
+			ghost_size),
+		("MinLibSound.from_pmmusic_mml", lambda: [
+			MinLibSound.from_pmmusic_mml(s.ident, mml) for s, mml in zip(songs, song_mml)
+		], song_size),
+		("MinLibSound.to_bin", lambda: [MinLibSound(s.ident, s.ops).to_bin() for s in songs],
+			song_size),
+		("MinLibSound.optimize_bin", lambda: [MinLibSound.optimize_bin(s.to_bin()) for s in songs],
+			song_size),
+		("write_pmmusic", lambda: write_pmmusic(songs, tmx_folder), song_size),
+		("read_pmmusic", lambda: read_pmmusic(tmx_folder), song_size),
+		("simulate", lambda: simulate(tracks), ghost_size),
+		("scan", lambda: scan(rom, known_ranges(rom, config)), len(rom)),
+		("save_tmx", save_tmxs, map_size),
+		("load_tmx", load_tmxs, map_size),
+		("export", lambda: run_editor(*export_args), len(rom)),
+		("import", lambda: run_editor(rom_fn, "import", "-n", "-f", export_folder), len(rom)),
+		("export --paletted", lambda: run_editor(*export_args, "--paletted"), len(rom)),
+	]
+
+
+def measure(fn: Callable[[], object], size: int, repeat: int) -> Result:
+	best = float("inf")
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fn()
+		best = min(best, time.perf_counter() - start)
+
+	# Tracing slows everything down, so it gets a run of its own
+	tracemalloc.start()
+	try:
+		fn()
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	return Result(best, size, peak)
+
+
+def format_size(n: float) -> str:
+	for unit in ("B", "KiB", "MiB"):
+		if n < 1024:
+			break
+		n /= 1024
+	return f"{n:.1f} {unit}"
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip())
+	parser.add_argument("--rom", help="Benchmark with this ROM instead of a synthetic one.")
+	parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic ROM.")
+	parser.add_argument(
+		"--repeat", "-r", type=int, default=5, help="Run each stage this many times, keep the best."
+	)
+	parser.add_argument("--stage", "-k", action="append", help="Only run stages with this name.")
+	parser.add_argument("--save", "-s", help="Write the results as JSON to this file.")
+	parser.add_argument("--baseline", "-b", help="Compare against results saved with --save.")
+	parser.add_argument(
+		"--threshold",
+		"-t",
+		type=float,
+		default=0.25,
+		help="Fraction a stage can be slower than the baseline before it's a regression."
+	)
+	args = parser.parse_args()
+
+	baseline: Dict[str, dict] = {}
+	if args.baseline:
+		with open(args.baseline, "rt", encoding="utf8") as f:
+			baseline = json.load(f)["stages"]
+
+	results: Dict[str, Result] = {}
+	regressions = []
+	with tempfile.TemporaryDirectory() as folder:
+		rom_fn, config = make_workspace(folder, args.rom, args.seed)
+		cwd = os.getcwd()
+		# The editor reads tracks.toml from the working directory
+		os.chdir(folder)
+		try:
+			with Rom.open(rom_fn) as rom:
+				stages = make_stages(rom, rom_fn, config, folder)
+				print(f"{'stage':<30}{'time':>12}{'throughput':>14}{'peak mem':>12}{'vs base':>10}")
+				for name, fn, size in stages:
+					if args.stage and name not in args.stage:
+						continue
+					res = results[name] = measure(fn, size, args.repeat)
+					line = (
+						f"{name:<30}{res.seconds * 1000:>10.2f}ms"
+						f"{format_size(res.throughput) + '/s' if size else '':>14}"
+						f"{format_size(res.peak):>12}"
+					)
+					if name in baseline:
+						ratio = res.seconds / baseline[name]["seconds"]
+						line += f"{ratio:>9.2f}x"
+						if ratio > 1 + args.threshold:
+							line += " REGRESSION"
+							regressions.append(name)
+					print(line)
+		finally:
+			os.chdir(cwd)
+
+	if args.save:
+		with open(args.save, "wt", encoding="utf8") as f:
+			json.dump({"stages": {k: v._asdict() for k, v in results.items()}}, f, indent="\t")
+
+	if regressions:
+		print(f"{len(regressions)} stage(s) regressed: {', '.join(regressions)}", file=sys.stderr)
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,97 @@
+"""
+Tracks unused space in the ROM so data which outgrew its place can be moved.
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .rom import Rom
+
+BANK_SIZE = 0x10000
+
+
+class NoSpaceError(Exception):
+	pass
+
+
+def bank_of(addr: int) -> int:
+	return addr & ~(BANK_SIZE - 1)
+
+
+class FreeSpace:
+	"""
+	Sorted, non-overlapping [start, end) ranges of the ROM which are known to be unused.
+	Ranges never cross a bank boundary, since data reached through 2-byte pointers
+	has to be in the pointer table's bank.
+	"""
+	regions: List[Tuple[int, int]]
+
+	def __init__(self):
+		self.regions = []
+
+	@classmethod
+	def scan(cls, rom: Rom, min_length: int = 0x20, margin: int = 4) -> "FreeSpace":
+		"""
+		Find the runs of 00 or FF at the end of each bank.
+		The first margin bytes of a run are left alone in case they end the data before it.
+		"""
+		ret = cls()
+		for bank in range(0, len(rom), BANK_SIZE):
+			data = np.frombuffer(rom.view(bank, min(BANK_SIZE, len(rom) - bank)), np.uint8)
+			fill = data[-1]
+			if fill not in (0x00, 0xff):
+				continue
+			used = np.flatnonzero(data != fill)
+			start = bank + int(used[-1]) + 1 + margin if len(used) else bank
+			end = bank + len(data)
+			if end - start >= min_length:
+				ret.free(start, end)
+		return ret
+
+	def __len__(self) -> int:
+		return sum(end - start for start, end in self.regions)
+
+	def free(self, start: int, end: int):
+		""" Mark [start, end) as unused. """
+		while start < end:
+			stop = min(end, bank_of(start) + BANK_SIZE)
+			self.regions.append((start, stop))
+			start = stop
+
+		merged: List[Tuple[int, int]] = []
+		for start, end in sorted(self.regions):
+			if merged and start <= merged[-1][1] and bank_of(start) == bank_of(merged[-1][0]):
+				merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+			else:
+				merged.append((start, end))
+		self.regions = merged
+
+	def claim(self, start: int, end: int):
+		""" Mark [start, end) as used. """
+		ret = []
+		for a, b in self.regions:
+			if b <= start or a >= end:
+				ret.append((a, b))
+				continue
+			if a < start:
+				ret.append((a, start))
+			if b > end:
+				ret.append((end, b))
+		self.regions = ret
+
+	def alloc(self, length: int, bank: Optional[int] = None) -> int:
+		"""
+		Claim the smallest free range which fits length bytes, within bank if given.
+		Return where it starts.
+		"""
+		fits = [
+			(b - a, a)
+			for a, b in self.regions
+			if b - a >= length and (bank is None or bank_of(a) == bank_of(bank))
+		]
+		if not fits:
+			where = "" if bank is None else f" in bank ${bank_of(bank) >> 16:02x}"
+			raise NoSpaceError(f"no room for {length} bytes{where}")
+		_, addr = min(fits)
+		self.claim(addr, addr + length)
+		return addr
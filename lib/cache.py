@@ -0,0 +1,109 @@
+import os
+import json
+import struct
+import hashlib
+import tempfile
+from typing import Any, List, Optional, Tuple
+
+from PIL import Image
+
+from .rom import Rom
+from .config import default_cache_folder
+
+_image_header = struct.Struct("<4sHH")
+
+
+class AssetCache:
+	"""
+	On-disk cache of decoded graphics and parsed tables for one ROM.
+	Entries are keyed by the ROM's digest, the address, and whatever parameters
+	the data was decoded with, so a changed ROM never sees stale entries.
+	Once the folder grows past max_size bytes, the least recently used entries are removed.
+	The folder is only looked through for that when what's been put since it last was could
+	have taken it past max_size.
+	"""
+	# Bytes in the folder as of the last eviction plus those put since, None until the first
+	size: Optional[int] = None
+
+	def __init__(self, folder: str, rom: Rom, max_size: int = 64 * 1024 * 1024):
+		self.folder = folder
+		self.max_size = max_size
+		self.digest = rom.digest()
+		os.makedirs(folder, exist_ok=True)
+
+	def key(self, kind: str, addr: int, *params: Any) -> str:
+		ident = f"{self.digest}:{kind}:{addr:06x}:{params!r}"
+		return hashlib.sha1(ident.encode("utf8")).hexdigest()
+
+	def _path(self, key: str) -> str:
+		return os.path.join(self.folder, key)
+
+	def get(self, key: str) -> Optional[bytes]:
+		fn = self._path(key)
+		try:
+			with open(fn, "rb") as f:
+				data = f.read()
+		except FileNotFoundError:
+			return None
+		# Modification time doubles as the last use time for eviction
+		os.utime(fn)
+		return data
+
+	def put(self, key: str, data: bytes):
+		fd, tmp = tempfile.mkstemp(prefix=".", dir=self.folder)
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(data)
+			os.replace(tmp, self._path(key))
+		except BaseException:
+			try:
+				os.remove(tmp)
+			except OSError:
+				pass
+			raise
+
+		# Entries put over old ones are counted twice, which only makes eviction look sooner
+		if self.size is not None:
+			self.size += len(data)
+		if self.size is None or self.size > self.max_size:
+			self.evict()
+
+	def evict(self):
+		entries: List[Tuple[float, int, str]] = []
+		total = 0
+		with os.scandir(self.folder) as it:
+			for entry in it:
+				if entry.is_file() and not entry.name.startswith("."):
+					st = entry.stat()
+					entries.append((st.st_mtime, st.st_size, entry.path))
+					total += st.st_size
+
+		entries.sort()
+		for _, size, fn in entries:
+			if total <= self.max_size:
+				break
+			try:
+				os.remove(fn)
+			except FileNotFoundError:
+				pass
+			total -= size
+		self.size = total
+
+	def get_image(self, key: str) -> Optional[Image.Image]:
+		data = self.get(key)
+		if data is None:
+			return None
+		mode, width, height = _image_header.unpack_from(data)
+		mode = mode.rstrip(b" ").decode("ascii")
+		return Image.frombytes(mode, (width, height), data[_image_header.size:])
+
+	def put_image(self, key: str, img: Image.Image):
+		header = _image_header.pack(img.mode.encode("ascii").ljust(4), img.width, img.height)
+		self.put(key, header + img.tobytes())
+
+	def get_json(self, key: str) -> Any:
+		data = self.get(key)
+		return None if data is None else json.loads(data.decode("utf8"))
+
+	def put_json(self, key: str, obj: Any):
+		self.put(key, json.dumps(obj).encode("utf8"))
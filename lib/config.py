@@ -0,0 +1,69 @@
+"""
+Loading tracks.toml, which is kept parsed in the cache folder so that it's only parsed again
+once it changes. Nothing here imports more than the standard library, so commands which only
+need the configuration start quickly.
+"""
+import os
+import json
+import hashlib
+from typing import Any, Dict, Optional, Tuple
+
+Settings = Dict[str, Any]
+
+# How tile layers can be stored in TMX files, the first is the default
+layer_formats = ("zlib", "csv")
+
+
+def default_cache_folder() -> str:
+	base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(base, "race-mini-editor")
+
+
+def load_config(
+	fn: str = "tracks.toml", folder: Optional[str] = None, cache: bool = True
+) -> Tuple[Settings, Dict[str, Settings]]:
+	"""
+	The top level settings in fn, and the arguments of each track in it, by name in order.
+	The parsed copy is used for as long as the modification time and size of fn are the same.
+	Without cache, fn is parsed and nothing is read from or written to the cache folder.
+	"""
+	st = os.stat(fn)
+	stamp = [st.st_mtime_ns, st.st_size, st.st_ino]
+	folder = default_cache_folder() if folder is None else folder
+	key = hashlib.sha1(f"config:{os.path.abspath(fn)}".encode("utf8")).hexdigest()
+	cached = os.path.join(folder, key)
+	if cache:
+		try:
+			with open(cached, "rt", encoding="utf8") as f:
+				obj = json.load(f)
+			if obj["stamp"] == stamp:
+				return obj["config"], obj["tracks"]
+		except (OSError, ValueError, KeyError):
+			pass
+
+	# tomlkit takes longer to import than everything else here does to run
+	import tomlkit
+	with open(fn, "rt", encoding="utf8") as f:
+		doc = tomlkit.loads(f.read())
+	data = json.dumps({
+		"stamp": stamp,
+		"config": {k: v for k, v in doc.items() if not isinstance(v, dict)},
+		"tracks": {k: v for k, v in doc.items() if isinstance(v, dict)},
+	})
+	# Written beside it and moved over it, so nothing ever reads half of it. If the folder
+	# can't be written to, it's parsed again next time.
+	tmp = os.path.join(folder, f".{key}.{os.getpid()}")
+	if cache:
+		try:
+			os.makedirs(folder, exist_ok=True)
+			with open(tmp, "wt", encoding="utf8") as f:
+				f.write(data)
+			os.replace(tmp, cached)
+		except OSError:
+			try:
+				os.remove(tmp)
+			except OSError:
+				pass
+
+	obj = json.loads(data)
+	return obj["config"], obj["tracks"]
@@ -1,10 +1,27 @@
-import struct
 from typing import BinaryIO
 
+import numpy as np
+
 from PIL import Image
 from PIL.ImageFile import PyDecoder
 
 
+def decode_tiles(b: bytes, width: int, height: int) -> np.ndarray:
+	"""
+	Expand 1bpp column-major tile data into an L pixel array of width x height.
+	Each row of tiles is width bytes, one per column, with the LSB at the top.
+	"""
+	rows = -(-len(b) // width)
+	data = np.zeros(rows * width, np.uint8)
+	data[:len(b)] = np.frombuffer(b, np.uint8)
+
+	bits = np.unpackbits(data.reshape(rows, 1, width), axis=1, bitorder="little")
+	pixels = np.zeros(width * height, np.uint8)
+	expanded = (bits ^ 1).reshape(-1)[:pixels.size]
+	pixels[:expanded.size] = expanded * 0xff
+	return pixels.reshape(height, width)
+
+
 class TileDecoder(PyDecoder):
 	def decode(self, b: bytes):
 		if len(b) % 8 != 0:
@@ -15,38 +32,46 @@ class TileDecoder(PyDecoder):
 		if width % 8 != 0:
 			raise Exception("canvas too smol")
 
-		raw = bytearray(width * self.state.ysize)
-
-		for i in range(0, len(b), width):
-			data = b[i:i + width]
-			plop_blanks = width - len(data)
-
-			if plop_blanks > 0:
-				data += b"\0" * plop_blanks
-
-			i *= 8
-			for m, x in zip((1, 2, 4, 8, 0x10, 0x20, 0x40, 0x80), range(i, i + width * 8, width)):
-				for d in data:
-					raw[x] = 0 if d & m else 0xff
-					x += 1
-
-		self.set_as_raw(bytes(raw))
+		self.set_as_raw(decode_tiles(b, width, self.state.ysize).tobytes())
 		return -1, 0
 
+	@staticmethod
+	def from_bytes(b: bytes, width: int = 16, height: int = 16) -> Image.Image:
+		return Image.frombytes("L", (width * 8, height * 8), b, "tile")
+
 	@staticmethod
 	def from_stream(f: BinaryIO, width: int = 16, height: int = 16) -> Image.Image:
-		return Image.frombytes("L", (width * 8, height * 8), f.read(width * height * 8), "tile")
+		return TileDecoder.from_bytes(f.read(width * height * 8), width, height)
 
 
 Image.register_decoder("tile", TileDecoder)
 
 
-def bigQ_into_bytearray(tile: int, mask: int, im: Image.Image, start_x: int, start_y: int):
-	cols = [((tile >> x) & 0xff, (mask >> x) & 0xff) for x in range(56, -1, -8)]
+def decode_sprites(b: bytes, width: int, height: int) -> np.ndarray:
+	"""
+	Expand 16x16 sprites into an LA pixel array of width x height, laid out in rows.
+	Each sprite is eight 8-byte column planes: mask UL, mask BL, data UL, data BL,
+	then the same again for the right half.
+	"""
+	per_row = width // 16
+	count = min(len(b) // 64, per_row * (height // 16))
+	data = np.frombuffer(b, np.uint8, count * 64).reshape(count, 8, 1, 8)
 
-	for m, y in zip((1, 2, 4, 8, 0x10, 0x20, 0x40, 0x80), range(start_y, start_y + 8)):
-		for (c, a), x in zip(cols, range(start_x, start_x + 8)):
-			im.putpixel((x, y), (0 if c & m else 0xff, 0 if a & m else 0xff))
+	# (sprite, x half, plane, y half, row, column)
+	bits = np.unpackbits(data, axis=2, bitorder="little").reshape(count, 2, 2, 2, 8, 8)
+	mask, data = bits.transpose(2, 0, 3, 4, 1, 5).reshape(2, count, 16, 16)
+	data = data & (mask ^ 1)
+
+	# Unfilled spots in the sheet stay fully transparent black
+	rows = -(-count // per_row)
+	sheet = np.zeros((2, rows * per_row, 16, 16), np.uint8)
+	sheet[0, :count] = (data ^ 1) * 0xff
+	sheet[1, :count] = (mask ^ 1) * 0xff
+	sheet = sheet.reshape(2, rows, per_row, 16, 16).transpose(1, 3, 2, 4, 0)
+
+	pixels = np.zeros((height, width, 2), np.uint8)
+	pixels[:rows * 16] = sheet.reshape(rows * 16, width, 2)
+	return pixels
 
 
 class SpriteDecoder(PyDecoder):
@@ -59,32 +84,16 @@ class SpriteDecoder(PyDecoder):
 		if width % 16 != 0:
 			raise Exception("canvas too smol")
 
-		x, y = 0, 0
-		bwidth = width // 16 * 64
-
-		for i in range(0, len(b), bwidth):
-			data = b[i:i + bwidth]
-
-			for j in range(0, len(data), 64):
-				m1, m2, d1, d2, m3, m4, d3, d4 = struct.unpack(">8Q", data[j:j + 64])
-				ul_data, bl_data, ur_data, br_data = d1 & ~m1, d2 & ~m2, d3 & ~m3, d4 & ~m4
-
-				bigQ_into_bytearray(ul_data, m1, self.im, x, y)
-				bigQ_into_bytearray(ur_data, m3, self.im, x + 8, y)
-				bigQ_into_bytearray(bl_data, m2, self.im, x, y + 8)
-				bigQ_into_bytearray(br_data, m4, self.im, x + 8, y + 8)
-				x += 16
-
-			x = 0
-			y += 16
-
+		self.set_as_raw(decode_sprites(b, width, self.state.ysize).tobytes(), "LA")
 		return -1, 0
 
+	@staticmethod
+	def from_bytes(b: bytes, width: int = 16, height: int = 16) -> Image.Image:
+		return Image.frombytes("LA", (width * 16, height * 16), b, "sprite")
+
 	@staticmethod
 	def from_stream(f: BinaryIO, width: int = 16, height: int = 16) -> Image.Image:
-		return Image.frombytes(
-			"LA", (width * 16, height * 16), f.read(width * height * 64), "sprite"
-		)
+		return SpriteDecoder.from_bytes(f.read(width * height * 64), width, height)
 
 
 Image.register_decoder("sprite", SpriteDecoder)
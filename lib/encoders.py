@@ -1,17 +1,73 @@
-from PIL.Image import Image
+from typing import Tuple
 
+import numpy as np
+from PIL import Image
 
-def encode_tiles(im: Image) -> bytes:
-	ret = bytearray()
-	bitmasks = (1, 2, 4, 8, 0x10, 0x20, 0x40, 0x80)
-	im = im.convert("1")
+# White then black, after a transparent entry for images with a mask
+_palette = (0xff, 0xff, 0xff, 0x00, 0x00, 0x00)
+_masked_palette = (0xff, 0xff, 0xff) + _palette
 
-	for base_y in range(0, im.height, 8):
-		for x in range(0, im.width):
-			pixel = 0
-			for m, y in zip(bitmasks, range(base_y, base_y + 8)):
-				if not im.getpixel((x, y)):
-					pixel |= m
-			ret.append(pixel)
 
-	return bytes(ret)
+def to_paletted(im: Image.Image) -> Image.Image:
+	"""
+	Convert a black and white L image to a 1 bit per pixel P image,
+	or an LA one to 2 bits per pixel with the first entry transparent.
+	"""
+	if im.mode == "LA":
+		px = np.asarray(im)
+		idx = np.where(px[..., 1] < 0x80, 0, np.where(px[..., 0] < 0x80, 2, 1))
+		ret = Image.fromarray(idx.astype(np.uint8), "P")
+		ret.putpalette(_masked_palette)
+		ret.info["transparency"] = 0
+	else:
+		ret = Image.fromarray((np.asarray(im.convert("L")) < 0x80).astype(np.uint8), "P")
+		ret.putpalette(_palette)
+	return ret
+
+
+def _palette_flags(im: Image.Image) -> Tuple[np.ndarray, np.ndarray]:
+	""" Whether each entry of a P image's palette is black, and whether it's transparent. """
+	rgb = np.zeros((0x100, 3), np.int32)
+	palette = np.array(im.getpalette() or [], np.int32).reshape(-1, 3)[:0x100]
+	rgb[:len(palette)] = palette
+	# The same weights as convert("L")
+	black = (rgb @ np.array((299, 587, 114))) // 1000 < 0x80
+
+	alpha = np.full(0x100, 0xff, np.int32)
+	transparency = im.info.get("transparency")
+	if isinstance(transparency, int):
+		alpha[transparency] = 0
+	elif isinstance(transparency, bytes):
+		alpha[:len(transparency)] = np.frombuffer(transparency, np.uint8)[:0x100]
+	return black, alpha < 0x80
+
+
+def encode_tiles(im: Image.Image) -> bytes:
+	if im.mode == "P":
+		# Exported paletted, so the palette says which pixels are black without converting
+		black, _ = _palette_flags(im)
+		pixels = black[np.asarray(im)]
+	else:
+		# True is white in mode 1, set bits are black
+		pixels = ~np.asarray(im.convert("1"))
+	rows = pixels.reshape(im.height // 8, 8, im.width)
+	return np.packbits(rows, axis=1, bitorder="little").tobytes()
+
+
+def encode_sprites(im: Image.Image) -> bytes:
+	if im.mode == "P":
+		black, clear = _palette_flags(im)
+		idx = np.asarray(im)
+		data, mask = black[idx], clear[idx]
+	else:
+		im = im.convert("LA")
+		# Set bits are black in the data plane and transparent in the mask plane
+		data = ~np.asarray(im.getchannel("L").convert("1"))
+		mask = ~np.asarray(im.getchannel("A").convert("1"))
+	data &= ~mask
+
+	rows, per_row = im.height // 16, im.width // 16
+	# (plane, sprite row, y half, row, sprite column, x half, column)
+	planes = np.stack((mask, data)).reshape(2, rows, 2, 8, per_row, 2, 8)
+	sprites = planes.transpose(1, 4, 5, 0, 2, 6, 3)
+	return np.packbits(sprites, axis=-1, bitorder="little").tobytes()
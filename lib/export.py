@@ -0,0 +1,135 @@
+import io
+import sys
+from contextlib import redirect_stdout
+from multiprocessing import Pool
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from PIL import Image
+
+from . import util
+from .maps import save_tmx
+from .manifest import ExportManifest
+from .util import write_tileset, write_spriteset, draw_track, draw_splash
+from .sound import MinLibSound
+from .structures import GrandPrixTrack
+
+
+class ExportOptions(NamedTuple):
+	folder: str
+	png: bool
+	tilesets: bool
+	spritesets: bool
+	render: bool
+	layer_format: str = "zlib"
+
+
+def export_track(track: GrandPrixTrack, opts: ExportOptions):
+	""" Export the files for a track which has already been read. """
+	if opts.render:
+		print(f"Rendering {track.ident}...")
+		draw_track(track, opts.folder)
+
+	if not opts.png:
+		print(f"Exporting track data for {track.ident}...")
+		save_tmx(track, opts.folder, opts.layer_format)
+
+	if opts.tilesets:
+		print(f"Exporting tilesets for {track.ident}...")
+		write_tileset(track.metadata.tileset_base, opts.folder)
+		write_tileset(track.metadata.preview_tileset_base, opts.folder)
+
+	if opts.spritesets:
+		print(f"Exporting sprite sheet for {track.ident}...")
+		write_spriteset(track.metadata.sprite_base, opts.folder)
+		print(f"Exporting splash screen for {track.ident}...")
+		draw_splash(track, opts.folder)
+
+
+def _shared_graphics(
+	tracks: Sequence[GrandPrixTrack], opts: ExportOptions
+) -> List[Tuple[str, int]]:
+	""" Tilesets and spritesets which more than one output might refer to. """
+	ret: Dict[Tuple[str, int], None] = {}
+	for track in tracks:
+		if not opts.png:
+			ret["tileset", track.config["titles_grand_prix_tileset"]] = None
+			ret["tileset", track.config["titles_menus_tileset"]] = None
+		if not opts.png or opts.tilesets:
+			ret["tileset", track.metadata.tileset_base] = None
+			ret["tileset", track.metadata.preview_tileset_base] = None
+		if opts.spritesets:
+			ret["spriteset", track.metadata.sprite_base] = None
+	return list(ret)
+
+
+def _init_worker(
+	tilesets: Dict[int, Image.Image], spritesets: Dict[int, Image.Image],
+	music: Dict[int, MinLibSound], manifest: Optional[ExportManifest],
+	tileset_sources: Dict[int, str], spriteset_sources: Dict[int, str], paletted: bool
+):
+	util.tilesets.update(tilesets)
+	util.spritesets.update(spritesets)
+	util.music.update(music)
+	util.manifest = manifest
+	util.tileset_sources.update(tileset_sources)
+	util.spriteset_sources.update(spriteset_sources)
+	util.paletted = paletted
+
+
+def _pop_manifest_updates() -> Dict[str, List]:
+	return util.manifest.pop_updates() if util.manifest else {}
+
+
+def _write_graphics(job: Tuple[str, int, str]) -> Tuple[str, Dict[str, List]]:
+	kind, base, folder = job
+	if kind == "tileset":
+		fn = write_tileset(base, folder)
+	else:
+		fn = write_spriteset(base, folder)
+	return fn, _pop_manifest_updates()
+
+
+def _export_track(
+	job: Tuple[GrandPrixTrack, ExportOptions, Set[str]]
+) -> Tuple[str, Dict[str, List]]:
+	track, opts, written = job
+	util.written.update(written)
+	out = io.StringIO()
+	with redirect_stdout(out):
+		export_track(track, opts)
+	return out.getvalue(), _pop_manifest_updates()
+
+
+def export_tracks(tracks: Sequence[GrandPrixTrack], opts: ExportOptions, jobs: int = 1):
+	"""
+	Export tracks which have already been read, using a pool of jobs processes if jobs > 1.
+	Shared graphics are written once before the tracks are fanned out, and the output
+	is the same as exporting them one by one.
+	"""
+	if jobs <= 1:
+		for track in tracks:
+			export_track(track, opts)
+		return
+
+	graphics = [
+		(kind, base, opts.folder)
+		for kind, base in _shared_graphics(tracks, opts)
+		if base in (util.tilesets if kind == "tileset" else util.spritesets)
+	]
+	initargs = (
+		util.tilesets, util.spritesets, util.music, util.manifest, util.tileset_sources,
+		util.spriteset_sources, util.paletted
+	)
+	with Pool(jobs, initializer=_init_worker, initargs=initargs) as pool:
+		written = set()
+		for fn, updates in pool.map(_write_graphics, graphics):
+			written.add(fn)
+			if util.manifest:
+				util.manifest.merge(updates)
+		util.written.update(written)
+
+		# Print progress in the same order as a serial export would
+		for out, updates in pool.imap(_export_track, [(track, opts, written) for track in tracks]):
+			sys.stdout.write(out)
+			if util.manifest:
+				util.manifest.merge(updates)
@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+from typing import Any, Dict, List
+
+
+def source_digest(*sources: Any) -> str:
+	"""
+	Digest of the data an output is made from.
+	Bytes-like sources are hashed as-is, anything else by its repr.
+	"""
+	h = hashlib.sha1()
+	for source in sources:
+		if isinstance(source, (bytes, bytearray, memoryview)):
+			h.update(len(source).to_bytes(4, "little"))
+			h.update(source)
+		else:
+			h.update(repr(source).encode("utf8"))
+		h.update(b"\0")
+	return h.hexdigest()
+
+
+class ExportManifest:
+	"""
+	Remembers which source data each file in an export folder was made from.
+	An output only needs to be made again if its sources changed, or if the file
+	was removed or changed since it was exported.
+	"""
+	filename = ".export_manifest.json"
+	# Bump this when the export format changes so everything gets remade
+	version = 1
+
+	entries: Dict[str, List]
+	updates: Dict[str, List]
+
+	def __init__(self, folder: str, force: bool = False):
+		"""
+		If force, every output counts as out of date, but is still recorded as it's written
+		so the next export can skip it.
+		"""
+		self.folder = folder
+		self.force = force
+		self.entries = {}
+		self.updates = {}
+		try:
+			with open(os.path.join(folder, self.filename), "rt", encoding="utf8") as f:
+				obj = json.load(f)
+			if obj.get("version") == self.version:
+				self.entries = obj["entries"]
+		except (FileNotFoundError, ValueError, KeyError):
+			pass
+
+	def fresh(self, fn: str, source: str) -> bool:
+		"""
+		Return whether fn is up to date with source.
+		If not, it's assumed the caller is about to write it.
+		"""
+		name = os.path.relpath(fn, self.folder)
+		if self.force:
+			self.updates[name] = [source]
+			return False
+		try:
+			st = os.stat(fn)
+		except FileNotFoundError:
+			st = None
+		entry = self.entries.get(name)
+		if st and entry == [source, st.st_size, st.st_mtime_ns]:
+			return True
+		self.updates[name] = [source]
+		return False
+
+	def merge(self, updates: Dict[str, List]):
+		""" Take updates made by another process. """
+		self.updates.update(updates)
+
+	def pop_updates(self) -> Dict[str, List]:
+		ret, self.updates = self.updates, {}
+		return ret
+
+	def save(self):
+		for name, entry in self.pop_updates().items():
+			try:
+				st = os.stat(os.path.join(self.folder, name))
+			except FileNotFoundError:
+				continue
+			self.entries[name] = [entry[0], st.st_size, st.st_mtime_ns]
+
+		with open(os.path.join(self.folder, self.filename), "wt", encoding="utf8") as f:
+			obj = {"version": self.version, "entries": self.entries}
+			json.dump(obj, f, indent=1, sort_keys=True)
@@ -1,31 +1,79 @@
 import os
 
-import tmxlib
-from tmxlib.fileio import TMXSerializer
-from tmxlib.tileset import ImageTileset
-from tmxlib.mapobject import RectangleObject
+import numpy as np
 
-from .util import tilesets, write_tileset, PokeImportError
+from .profiling import profiled
+from .tmx import MapObject, Tileset, TileMap
+from .util import (
+	tilesets, tileset_sources, write_tileset, write_behind, unchanged, PokeImportError
+)
 from .structures import TrackGhost, GrandPrixTrack, GrandPrixTrackMetaData
 
 made_tilesets = {}
 
+# Tile numbers in track tilesets which the game treats specially, and what it does with them
+# 0x50~0x60 never used, untested
+tile_types = (
+	(range(0x00, 0x50), "non-solid", None),
+	(range(0x60, 0x80), "solid", None),
+	(range(0x80, 0x84), "grass", "slows and causes a grass effect"),
+	(range(0x84, 0x88), "water", "swims if Pikachu collides with the ground inside it"),
+	(range(0x88, 0x90), "slowing", None),
+	(range(0x90, 0xa0), "one-way", "solid only from the top"),
+)
+
 
 def ts_name_to_addr(name: str) -> int:
 	return int(name.replace("tileset_", ""), 16)
 
 
-def make_tsx(addr: int, folder: str) -> ImageTileset:
+def make_tsx(addr: int, folder: str) -> Tileset:
 	if addr in made_tilesets:
 		return made_tilesets[addr]
-	img = tmxlib.image.open(write_tileset(addr, folder))
-	ts = ImageTileset(f"{addr:06x}", (8, 8), img, base_path=folder)
+	fn = write_tileset(addr, folder)
+	ts = Tileset(f"{addr:06x}", os.path.basename(fn), tilesets[addr].size, base_path=folder)
 	made_tilesets[addr] = ts
 	return ts
 
 
-def save_tmx(track: GrandPrixTrack, folder: str):
-	out = tmxlib.Map((track.metadata.width, track.metadata.height), (8, 8), base_path=folder)
+@profiled
+def save_tsx(addr: int, folder: str) -> str:
+	fn = os.path.join(folder, f"tileset_{addr:06x}.tsx")
+	make_tsx(addr, folder).save(fn)
+	return fn
+
+
+def _track_tileset(addr: int, folder: str) -> Tileset:
+	""" A tileset for the track layer, which marks what kind of ground each tile is. """
+	ts = make_tsx(addr, folder)
+	ret = Tileset(ts.name, ts.image, (ts.image_width, ts.image_height), base_path=folder)
+	for tiles, kind, note in tile_types:
+		for i in range(tiles.start, min(tiles.stop, ret.tile_count)):
+			ret.tile_properties[i] = {"type": kind}
+			if note:
+				ret.tile_properties[i]["note"] = note
+	return ret
+
+
+def _gids(tilemap: bytes, first_gid: int) -> np.ndarray:
+	return np.frombuffer(tilemap, np.uint8).astype(np.uint32) + first_gid
+
+
+@profiled
+def save_tmx(track: GrandPrixTrack, folder: str, layer_format: str = "zlib"):
+	fn = os.path.join(folder, f"{track.ident}.tmx")
+	bases = (
+		track.metadata.tileset_base, track.metadata.preview_tileset_base,
+		track.config["titles_grand_prix_tileset"], track.config["titles_menus_tileset"]
+	)
+	sources = (tileset_sources.get(b) for b in bases)
+	if unchanged(fn, track.source, track.bgm.ident, layer_format, *sources):
+		# Still make sure the tilesets it refers to exist
+		for base in bases:
+			write_tileset(base, folder)
+		return
+
+	out = TileMap(track.metadata.width, track.metadata.height)
 	out.properties["metadata base"] = f"${track.bases['metadata']:06x}"
 	out.properties["sprite base"] = f"${track.metadata.sprite_base:06x}"
 	out.properties["tilemap base"] = f"${track.metadata.tilemap_base:06x}"
@@ -36,86 +84,60 @@ def save_tmx(track: GrandPrixTrack, folder: str):
 	out.properties["ai hard"] = track.ai_hard.to_string()
 
 	# Make and add tilesets
-	tiles = make_tsx(track.metadata.tileset_base, folder)
-	preview_tiles = make_tsx(track.metadata.preview_tileset_base, folder)
-	out.tilesets.append(tiles)
-	out.tilesets.append(preview_tiles)
-
-	# Tile properties
-	for i in range(0x00, 0x50):
-		tiles[i].properties["type"] = "non-solid"
-	# 0x50~0x60 never used, untested
-	for i in range(0x60, 0x80):
-		tiles[i].properties["type"] = "solid"
-	for i in range(0x80, 0x84):
-		tiles[i].properties["type"] = "grass"
-		tiles[i].properties["note"] = "slows and causes a grass effect"
-	for i in range(0x84, 0x88):
-		tiles[i].properties["type"] = "water"
-		tiles[i].properties["note"] = "swims if Pikachu collides with the ground inside it"
-	for i in range(0x88, 0x90):
-		tiles[i].properties["type"] = "slowing"
-	for i in range(0x90, 0xa0):
-		tiles[i].properties["type"] = "one-way"
-		tiles[i].properties["note"] = "solid only from the top"
+	tiles = out.add_tileset(_track_tileset(track.metadata.tileset_base, folder))
+	preview_tiles = out.add_tileset(make_tsx(track.metadata.preview_tileset_base, folder))
 
 	# A layer for each concept
 	layer = out.add_layer("Track")
-	obj_layer = out.add_object_layer("Track objects", color=(1.0, 0.0, 0.0))
-	preview = out.add_layer("Preview")
+	obj_layer = out.add_object_layer("Track objects", color="#ff0000")
+	preview = out.add_layer("Preview", visible=False)
 
 	preview.properties["base"] = f"${track.metadata.preview_tilemap_base:06x}"
 
 	# Make starting position object
-	obj_layer.append(
-		RectangleObject(
-		obj_layer, (track.metadata.starting_x, track.metadata.starting_y),
-		pixel_size=(16, 16),
-		name="StartingPos"
-		)
+	obj_layer.objects.append(
+		MapObject("StartingPos", track.metadata.starting_x, track.metadata.starting_y, 16, 16)
 	)
 
-	pos = ((x, y) for y in range(track.metadata.height) for x in range(track.metadata.width))
-	for p, t in zip(pos, track.tilemap):
-		layer[p] = tiles[t]
+	tilemap = _gids(track.tilemap, tiles)[:len(layer.gids)]
+	layer.gids[:len(tilemap)] = tilemap
 
-	pos = ((x, y)
-		for y in range(track.metadata.preview_map_height)
-		for x in range(track.metadata.preview_map_width))
-	for p, t in zip(pos, track.preview_tilemap):
-		preview[p] = preview_tiles[t]
-	preview.visible = False
+	preview_width = track.metadata.preview_map_width
+	preview_height = track.metadata.preview_map_height
+	tilemap = _gids(track.preview_tilemap, preview_tiles)[:preview_width * preview_height]
+	block = np.zeros(preview_width * preview_height, np.uint32)
+	block[:len(tilemap)] = tilemap
+	preview.grid()[:preview_height, :preview_width] = block.reshape(preview_height, preview_width)
 
 	# Add titles as available
-	titles = out.add_layer("Titles")
-
-	title_gp_tiles = make_tsx(track.config["titles_grand_prix_tileset"], folder)
-	out.tilesets.append(title_gp_tiles)
+	titles = out.add_layer("Titles", visible=False)
+	grid = titles.grid()
 
+	title_gp_tiles = out.add_tileset(make_tsx(track.config["titles_grand_prix_tileset"], folder))
 	title_idx = track.index * 8
-	for x, t in enumerate(range(title_idx, title_idx + 8)):
-		titles[x, 0] = title_gp_tiles[t]
+	grid[0, :8] = np.arange(title_idx, title_idx + 8) + title_gp_tiles
 
-	title_rank_tiles = make_tsx(track.config["titles_menus_tileset"], folder)
-	out.tilesets.append(title_rank_tiles)
+	title_rank_tiles = out.add_tileset(make_tsx(track.config["titles_menus_tileset"], folder))
 
 	titles.properties["rank tilemap base"] = f"${track.bases['title_ranking']:06x}"
-	for x, t in enumerate(track.title_ranking_tilemap):
-		titles[x, 1] = title_rank_tiles[t]
+	grid[1, :8] = _gids(track.title_ranking_tilemap, title_rank_tiles)
 
 	titles.properties["ditto tilemap base"] = f"${track.bases['title_ditto']:06x}"
-	for x, t in enumerate(track.title_ditto_tilemap):
-		titles[x, 2] = title_rank_tiles[t]
+	grid[2, :8] = _gids(track.title_ditto_tilemap, title_rank_tiles)
 
-	titles.visible = False
+	write_behind(out.save, fn, layer_format)
 
-	fn = os.path.join(folder, f"{track.ident}.tmx")
-	out.save(fn, serializer=TMXSerializer((1, 1)), base_path=folder)
 
+def _leading_tiles(gids: np.ndarray) -> int:
+	""" Count tiles before the first empty one. """
+	empty = np.flatnonzero(gids == 0)
+	return int(empty[0]) if len(empty) else len(gids)
 
+
+@profiled
 def load_tmx(track: GrandPrixTrack, folder: str, sounds: dict = {}):
 	fn = os.path.join(folder, f"{track.ident}.tmx")
-	tmap: tmxlib.Map = tmxlib.Map.open(fn)
+	tmap = TileMap.open(fn)
 	pika = tmap.layers["Track objects"]["StartingPos"]
 	layer = tmap.layers["Track"]
 	preview = tmap.layers["Preview"]
@@ -129,18 +151,16 @@ def load_tmx(track: GrandPrixTrack, folder: str, sounds: dict = {}):
 		track.bases["title_ditto"] = int(titles.properties["ditto tilemap base"].lstrip("$"), 16)
 		track.bases["title_ranking"] = int(titles.properties["rank tilemap base"].lstrip("$"), 16)
 
-	for i in range(0, tmap.width):
-		if not preview[i, 0]:
-			break
-	preview_width = i
-
-	for i in range(0, tmap.height):
-		if not preview[0, i]:
-			break
-	preview_height = i
+	preview_grid = preview.grid()
+	preview_width = _leading_tiles(preview_grid[0])
+	preview_height = _leading_tiles(preview_grid[:, 0])
 
-	layer_tileset = ts_name_to_addr(layer[0, 0].tileset.name)
-	preview_tileset = ts_name_to_addr(preview[0, 0].tileset.name)
+	if not layer.gids[0] or not preview.gids[0]:
+		raise PokeImportError(f"{fn}: the top left tile of the track and preview must be set")
+	layer_tiles = tmap.tileset_of(int(layer.gids[0]))
+	preview_tiles = tmap.tileset_of(int(preview.gids[0]))
+	layer_tileset = ts_name_to_addr(layer_tiles.name)
+	preview_tileset = ts_name_to_addr(preview_tiles.name)
 
 	if "background music" in tmap.properties:
 		# TODO: assume track_# for now, change to a method of rebuilding the table later
@@ -157,8 +177,8 @@ def load_tmx(track: GrandPrixTrack, folder: str, sounds: dict = {}):
 		width=tmap.width,
 		height=tmap.height,
 		bg_music=bg_music,
-		starting_x=round(pika.pixel_x),
-		starting_y=round(pika.pixel_y),
+		starting_x=round(pika.x),
+		starting_y=round(pika.y),
 		unk2=int(tmap.properties["unknown 2"]),
 		sprite_base=int(tmap.properties["sprite base"].lstrip("$"), 16),
 		preview_tileset_base=preview_tileset,
@@ -171,12 +191,12 @@ def load_tmx(track: GrandPrixTrack, folder: str, sounds: dict = {}):
 	track.ai_normal = TrackGhost.from_string(tmap.properties["ai normal"])
 	track.ai_hard = TrackGhost.from_string(tmap.properties["ai hard"])
 
-	track.tilemap = b"".join(t.number.to_bytes(1, "little") for t in layer.all_tiles())
-	track.preview_tilemap = b"".join(
-		t.number.to_bytes(1, "little") for t in preview.all_tiles() if t
-	)
+	track.tilemap = tmap.tile_numbers(layer.gids).astype(np.uint8).tobytes()
+	track.preview_tilemap = tmap.tile_numbers(preview.gids[preview.gids != 0]).astype(
+		np.uint8
+	).tobytes()
 
-	tilesets[layer_tileset] = layer[0, 0].tileset.image.pil_image
-	tilesets[preview_tileset] = preview[0, 0].tileset.image.pil_image
+	tilesets[layer_tileset] = layer_tiles.open_image()
+	tilesets[preview_tileset] = preview_tiles.open_image()
 
 	# TODO: name tilemap
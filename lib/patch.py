@@ -0,0 +1,123 @@
+import os
+import zlib
+import struct
+from itertools import groupby
+from typing import Iterator, Tuple
+
+from .profiling import profiled
+from .rom import RomJournal
+from .util import PokeImportError
+
+# Merging changes closer than this is cheaper than starting a new record
+IPS_GAP = 4
+BPS_GAP = 2
+
+# An RLE record is 8 bytes, so runs must be longer than that to be worth it
+IPS_MIN_RUN = 9
+IPS_MAX_SIZE = 0xffff
+IPS_EOF = 0x454f46
+
+BPS_SOURCE_READ = 0
+BPS_TARGET_READ = 1
+
+
+def _ips_records(data: bytes, start: int, end: int) -> Iterator[Tuple[int, int, bytes]]:
+	"""
+	Split data[start:end] into (address, run length, literal bytes) records.
+	Run records have no literal bytes, literal records have no run length.
+	"""
+	literal = start
+	addr = start
+	for value, run in groupby(data[start:end]):
+		length = sum(1 for _ in run)
+		if length >= IPS_MIN_RUN:
+			for i in range(literal, addr, IPS_MAX_SIZE):
+				yield i, 0, bytes(data[i:min(i + IPS_MAX_SIZE, addr)])
+			for i in range(addr, addr + length, IPS_MAX_SIZE):
+				yield i, min(IPS_MAX_SIZE, addr + length - i), bytes((value, ))
+			literal = addr + length
+		addr += length
+	for i in range(literal, end, IPS_MAX_SIZE):
+		yield i, 0, bytes(data[i:min(i + IPS_MAX_SIZE, end)])
+
+
+def make_ips(journal: RomJournal) -> bytes:
+	ret = bytearray(b"PATCH")
+	for start, end in journal.dirty_ranges(IPS_GAP):
+		if end > 0x1000000:
+			raise PokeImportError("IPS patches can only address the first 16 MiB")
+		for addr, run, data in _ips_records(journal.data, start, end):
+			if addr == IPS_EOF:
+				# This offset would read as the end of the patch, so cover it from a byte sooner
+				ret += struct.pack(">IH", addr - 1, 2)[1:] + journal.data[addr - 1:addr + 1]
+				addr += 1
+				if run:
+					run -= 1
+					if not run:
+						continue
+				else:
+					data = data[1:]
+					if not data:
+						continue
+			ret += struct.pack(">I", addr)[1:]
+			if run:
+				ret += struct.pack(">HH", 0, run) + data
+			else:
+				ret += struct.pack(">H", len(data)) + data
+	ret += b"EOF"
+	return bytes(ret)
+
+
+def _bps_number(n: int) -> bytes:
+	ret = bytearray()
+	while True:
+		x = n & 0x7f
+		n >>= 7
+		if n == 0:
+			ret.append(0x80 | x)
+			return bytes(ret)
+		ret.append(x)
+		n -= 1
+
+
+def _bps_action(action: int, length: int) -> bytes:
+	return _bps_number(((length - 1) << 2) | action)
+
+
+def make_bps(journal: RomJournal) -> bytes:
+	source, target = journal.original, bytes(journal.data)
+	ret = bytearray(b"BPS1")
+	ret += _bps_number(len(source))
+	ret += _bps_number(len(target))
+	ret += _bps_number(0)  # no metadata
+
+	# Unchanged bytes are read from the same spot in the source
+	pos = 0
+	for start, end in journal.dirty_ranges(BPS_GAP):
+		if start > pos:
+			ret += _bps_action(BPS_SOURCE_READ, start - pos)
+		ret += _bps_action(BPS_TARGET_READ, end - start)
+		ret += target[start:end]
+		pos = end
+	if len(target) > pos:
+		ret += _bps_action(BPS_SOURCE_READ, len(target) - pos)
+
+	ret += struct.pack("<II", zlib.crc32(source), zlib.crc32(target))
+	ret += struct.pack("<I", zlib.crc32(ret))
+	return bytes(ret)
+
+
+patch_formats = {".ips": make_ips, ".bps": make_bps}
+
+
+@profiled
+def write_patch(journal: RomJournal, fn: str) -> int:
+	ext = os.path.splitext(fn)[1].lower()
+	try:
+		make = patch_formats[ext]
+	except KeyError:
+		raise PokeImportError(
+			f"unknown patch format {ext or fn}, expected one of: {', '.join(patch_formats)}"
+		) from None
+	with open(fn, "wb") as f:
+		return f.write(make(journal))
@@ -0,0 +1,197 @@
+"""
+Optional timing and allocation tracking of the export and import stages.
+Functions are marked with @profiled and only pay for a flag check until start is called.
+"""
+import os
+import json
+import time
+import functools
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+F = TypeVar("F", bound=Callable)
+
+active = False
+
+
+class Counters:
+	""" Bytes of the ROM read through Rom.read and bounded views, and written to journals. """
+	__slots__ = ("rom_read", "rom_written")
+
+	def __init__(self):
+		self.rom_read = 0
+		self.rom_written = 0
+
+
+counters = Counters()
+
+
+class Event:
+	__slots__ = ("name", "args", "start", "end", "before", "after", "peak")
+
+	def __init__(self, name: str, args: Dict[str, Any]):
+		self.name = name
+		self.args = args
+		self.peak = 0
+		self.before = _sample()
+		self.start = time.perf_counter()
+
+	def stop(self):
+		self.end = time.perf_counter()
+		self.after = _sample()
+
+	def deltas(self) -> Dict[str, int]:
+		return {k: self.after[k] - self.before[k] for k in self.before if k != "traced"}
+
+
+events: List[Event] = []
+_stack: List[Event] = []
+_origin = 0.0
+_reset_peak = getattr(tracemalloc, "reset_peak", None)
+
+
+def _io_counters() -> Dict[str, int]:
+	""" Bytes this process read and wrote through system calls, where the OS tells us. """
+	try:
+		with open("/proc/self/io", "rt") as f:
+			fields = dict(line.split(":", 1) for line in f)
+		return {"io_read": int(fields["rchar"]), "io_written": int(fields["wchar"])}
+	except (OSError, KeyError, ValueError):
+		return {"io_read": 0, "io_written": 0}
+
+
+def _sample() -> Dict[str, int]:
+	ret = _io_counters()
+	ret["rom_read"] = counters.rom_read
+	ret["rom_written"] = counters.rom_written
+	ret["traced"] = tracemalloc.get_traced_memory()[0]
+	return ret
+
+
+def _update_peak():
+	""" Fold the peak since the last reset into every open stage. """
+	peak = tracemalloc.get_traced_memory()[1]
+	for event in _stack:
+		event.peak = max(event.peak, peak - event.before["traced"])
+	if _reset_peak:
+		_reset_peak()
+
+
+class _Stage:
+	def __init__(self, name: str, args: Dict[str, Any]):
+		self.name = name
+		self.args = args
+
+	def __enter__(self):
+		_update_peak()
+		event = Event(self.name, self.args)
+		_stack.append(event)
+		events.append(event)
+
+	def __exit__(self, *exc):
+		_update_peak()
+		_stack.pop().stop()
+
+
+class _NoStage:
+	def __enter__(self):
+		pass
+
+	def __exit__(self, *exc):
+		pass
+
+
+_no_stage = _NoStage()
+
+
+def stage(name: str, **args):
+	""" Context manager which records what happens inside it as a stage, while profiling. """
+	return _Stage(name, args) if active else _no_stage
+
+
+def profiled(fn: Optional[F] = None, *, name: Optional[str] = None):
+	""" Record each call of the decorated function as a stage, while profiling. """
+	def wrap(fn: F) -> F:
+		stage_name = name or fn.__qualname__
+
+		@functools.wraps(fn)
+		def wrapper(*args, **kwargs):
+			if not active:
+				return fn(*args, **kwargs)
+			with _Stage(stage_name, {}):
+				return fn(*args, **kwargs)
+
+		return wrapper
+
+	return wrap(fn) if fn else wrap
+
+
+def start():
+	global active, _origin
+	events.clear()
+	_stack.clear()
+	tracemalloc.start()
+	_origin = time.perf_counter()
+	active = True
+
+
+def stop():
+	global active
+	while _stack:
+		_update_peak()
+		_stack.pop().stop()
+	active = False
+	tracemalloc.stop()
+
+
+def report() -> Dict[str, Any]:
+	""" Totals for each stage name, in the order they first ran. """
+	stages: Dict[str, Dict[str, Any]] = {}
+	for event in events:
+		totals = stages.setdefault(
+			event.name, {
+			"calls": 0,
+			"seconds": 0.0,
+			"rom_read": 0,
+			"rom_written": 0,
+			"io_read": 0,
+			"io_written": 0,
+			"peak": 0,
+			}
+		)
+		totals["calls"] += 1
+		totals["seconds"] += event.end - event.start
+		for k, v in event.deltas().items():
+			totals[k] += v
+		totals["peak"] = max(totals["peak"], event.peak)
+	return {"stages": stages}
+
+
+def chrome_trace() -> Dict[str, Any]:
+	""" The stages as complete events, for chrome://tracing or Perfetto. """
+	pid = os.getpid()
+	trace = []
+	for event in events:
+		args = dict(event.args)
+		args.update(event.deltas())
+		args["peak"] = event.peak
+		trace.append({
+			"name": event.name,
+			"ph": "X",
+			"ts": (event.start - _origin) * 1e6,
+			"dur": (event.end - event.start) * 1e6,
+			"pid": pid,
+			"tid": 0,
+			"args": args,
+		})
+	return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+def save(prefix: str) -> List[str]:
+	""" Write the report to prefix.json and the trace to prefix.trace.json. """
+	ret = []
+	for fn, obj in ((f"{prefix}.json", report()), (f"{prefix}.trace.json", chrome_trace())):
+		with open(fn, "wt", encoding="utf8") as f:
+			json.dump(obj, f, indent="\t")
+		ret.append(fn)
+	return ret
@@ -0,0 +1,200 @@
+import os
+import mmap
+import hashlib
+import struct
+import tempfile
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from . import profiling
+
+
+class Rom:
+	"""
+	Read access to a ROM image without going through file objects.
+	When opened from a file, the image is memory-mapped and views are zero-copy.
+	"""
+	data: Union[bytes, bytearray, mmap.mmap]
+
+	def __init__(self, data: Union[bytes, bytearray, mmap.mmap]):
+		self.data = data
+
+	@classmethod
+	def open(cls, fn: str) -> "Rom":
+		with open(fn, "rb") as f:
+			return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+	def close(self):
+		if isinstance(self.data, mmap.mmap):
+			self.data.close()
+
+	def __enter__(self) -> "Rom":
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def __len__(self) -> int:
+		return len(self.data)
+
+	def digest(self) -> str:
+		return hashlib.sha1(self.data).hexdigest()
+
+	def view(self, addr: int, length: Optional[int] = None) -> memoryview:
+		""" Zero-copy view of length bytes at addr, or until the end of the ROM. """
+		mv = memoryview(self.data)
+		if length is None:
+			return mv[addr:]
+		profiling.counters.rom_read += length
+		return mv[addr:addr + length]
+
+	def read(self, addr: int, length: int) -> bytes:
+		profiling.counters.rom_read += length
+		return bytes(self.data[addr:addr + length])
+
+	def find(self, sub: bytes, start: int, end: Optional[int] = None) -> int:
+		return self.data.find(sub, start, len(self.data) if end is None else end)
+
+	def u8(self, addr: int) -> int:
+		return self.data[addr]
+
+	def u16(self, addr: int) -> int:
+		return struct.unpack_from("<H", self.data, addr)[0]
+
+	def u24(self, addr: int) -> int:
+		lo, hi = struct.unpack_from("<HB", self.data, addr)
+		return (hi << 16) | lo
+
+	def ptr2b(self, table_base: int, idx: int) -> int:
+		""" Read entry idx of a table of 2-byte pointers into the table's own bank. """
+		return (table_base & 0xff0000) | self.u16(table_base + idx * 2)
+
+	def ptr3b(self, table_base: int, idx: int) -> int:
+		""" Read entry idx of a table of 3-byte pointers. """
+		return self.u24(table_base + idx * 3)
+
+
+class RomJournal(Rom):
+	"""
+	Writable in-memory copy of a ROM which remembers what was written to it.
+	Writers use it like a file (seek/tell/write) and readers use it like a Rom.
+	Nothing touches the disk until commit, which only writes bytes that changed.
+	"""
+	original: bytes
+	written: List[Tuple[int, int]]
+
+	# Changed ranges closer than this are written together
+	coalesce_gap = 8
+
+	def __init__(self, rom: Rom):
+		self.original = bytes(rom.data)
+		super().__init__(bytearray(self.original))
+		self.pos = 0
+		self.written = []
+
+	def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+		if whence == os.SEEK_CUR:
+			offset += self.pos
+		elif whence == os.SEEK_END:
+			offset += len(self.data)
+		self.pos = offset
+		return offset
+
+	def tell(self) -> int:
+		return self.pos
+
+	def write(self, b: bytes) -> int:
+		end = self.pos + len(b)
+		if end > len(self.data):
+			raise ValueError(
+				f"write of {len(b)} bytes at ${self.pos:06x} is past the end of the ROM"
+			)
+		self.data[self.pos:end] = b
+		profiling.counters.rom_written += len(b)
+		if end > self.pos:
+			self.written.append((self.pos, end))
+		self.pos = end
+		return len(b)
+
+	def _written_spans(self) -> List[Tuple[int, int]]:
+		spans = []
+		for start, end in sorted(self.written):
+			if spans and start <= spans[-1][1]:
+				spans[-1] = (spans[-1][0], max(end, spans[-1][1]))
+			else:
+				spans.append((start, end))
+		return spans
+
+	def dirty_ranges(self, gap: int = 0) -> List[Tuple[int, int]]:
+		"""
+		Return [start, end) ranges which differ from the original ROM.
+		Ranges separated by gap bytes or less are merged.
+		"""
+		original = np.frombuffer(self.original, np.uint8)
+		current = np.frombuffer(self.data, np.uint8)
+		ranges = []
+		for start, end in self._written_spans():
+			diff = np.flatnonzero(original[start:end] != current[start:end]) + start
+			if not diff.size:
+				continue
+			breaks = np.flatnonzero(np.diff(diff) > gap + 1)
+			starts = np.concatenate(((diff[0], ), diff[breaks + 1]))
+			ends = np.concatenate((diff[breaks], (diff[-1], ))) + 1
+			for a, b in zip(starts.tolist(), ends.tolist()):
+				if ranges and a - ranges[-1][1] <= gap:
+					ranges[-1] = (ranges[-1][0], b)
+				else:
+					ranges.append((a, b))
+		return ranges
+
+	def changes(self, gap: int = 0) -> List[Tuple[int, bytes]]:
+		""" Return (address, new bytes) for every range which differs from the original. """
+		return [(a, bytes(self.data[a:b])) for a, b in self.dirty_ranges(gap)]
+
+	def report(self) -> List[str]:
+		ret = []
+		total = 0
+		for a, b in self.dirty_ranges():
+			ret.append(f"${a:06x}~${b - 1:06x} ({b - a} bytes)")
+			total += b - a
+		ret.append(f"{total} bytes would change in {len(ret)} ranges")
+		return ret
+
+	def revert(self):
+		""" Undo everything written since the journal was made or last committed. """
+		for start, end in self._written_spans():
+			self.data[start:end] = self.original[start:end]
+		self.written.clear()
+
+	@profiling.profiled
+	def commit(self, fn: str, atomic: bool = False) -> int:
+		"""
+		Write changes to fn, which should be the file the original was read from.
+		If atomic, the new image is written to a temporary file which then replaces fn.
+		Returns the number of bytes written.
+		"""
+		if atomic:
+			folder = os.path.dirname(os.path.abspath(fn))
+			fd, tmp = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=folder)
+			try:
+				with os.fdopen(fd, "wb") as f:
+					written = f.write(self.data)
+					f.flush()
+					os.fsync(f.fileno())
+				if os.path.exists(fn):
+					os.chmod(tmp, os.stat(fn).st_mode & 0o7777)
+				os.replace(tmp, fn)
+			except BaseException:
+				os.unlink(tmp)
+				raise
+		else:
+			written = 0
+			with open(fn, "r+b") as f:
+				for addr, data in self.changes(self.coalesce_gap):
+					f.seek(addr)
+					written += f.write(data)
+
+		self.original = bytes(self.data)
+		self.written.clear()
+		return written
@@ -0,0 +1,187 @@
+"""
+Look through the whole ROM for tilesets and spritesets no table is known to point to.
+Every byte offset is scored as the start of a tile and of a sprite at once:
+
+* Tiles are 8 bytes, one per column, and neighbouring pixels of something drawn are more often
+  the same than not, where code and tables change about as many bits as their density predicts.
+* Sprites keep their data clear wherever the mask is transparent, which other data only does
+  when it's too sparse to tell.
+
+Runs of offsets which score well a row apart become the candidates, ranked by score and size.
+"""
+from typing import Iterable, List, NamedTuple, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from .decoders import decode_tiles, decode_sprites
+from .profiling import profiled
+from .rom import Rom
+
+TILE_SIZE = 8
+SPRITE_SIZE = 64
+# Units averaged together, and the fewest a candidate can have
+TILE_WINDOW = 16
+SPRITE_WINDOW = 4
+# Windows whose mean score is this or more look drawn. Even thin text only has a fifth fewer
+# changes than random data, where sprite masks rarely overlap their data at all.
+TILE_THRESHOLD = 0.12
+SPRITE_THRESHOLD = 0.5
+# Tiles and sprites with fewer changes expected by chance are too sparse to judge
+MIN_EXPECTED = 4
+
+popcount = np.array([bin(i).count("1") for i in range(0x100)], np.int32)
+
+
+class Candidate(NamedTuple):
+	kind: str  # "tileset" or "spriteset"
+	start: int
+	end: int
+	# Mean score of the tiles or sprites in it which weren't blank, from 0 to 1
+	score: float
+
+	@property
+	def count(self) -> int:
+		return (self.end - self.start) // (TILE_SIZE if self.kind == "tileset" else SPRITE_SIZE)
+
+	@property
+	def rank(self) -> float:
+		""" Score, weighted towards bigger candidates. """
+		return self.score * float(np.log2(1 + self.count))
+
+	@property
+	def target(self) -> str:
+		""" What to pass to the export to see it. """
+		return f"{self.kind}:{self.start:06x}"
+
+
+def _window_sums(values: np.ndarray, length: int) -> np.ndarray:
+	""" Sum of values[i:i + length] for every i it fits at. """
+	sums = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+	return sums[length:] - sums[:-length]
+
+
+def tile_scores(data: np.ndarray) -> np.ndarray:
+	"""
+	How much the 8 bytes at each offset look like a tile, from 0 to 1, or NaN if they're too
+	sparse or uniform to tell. It's how many fewer pixels differ from the one beside and below
+	them than would for random bits of the same density.
+	"""
+	across = _window_sums(popcount[data[1:] ^ data[:-1]], TILE_SIZE - 1)
+	down = _window_sums(popcount[(data ^ (data >> 1)) & 0x7f], TILE_SIZE)[:len(across)]
+	density = _window_sums(popcount[data], TILE_SIZE)[:len(across)] / (TILE_SIZE * 8)
+	expected = 2 * (TILE_SIZE - 1) * 8 * 2 * density * (1 - density)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		ret = np.clip(1 - (across + down) / expected, 0, 1)
+	ret[expected < MIN_EXPECTED] = np.nan
+	return ret
+
+
+def sprite_scores(data: np.ndarray) -> np.ndarray:
+	"""
+	How much the 64 bytes at each offset look like a sprite, from 0 to 1, or NaN if they're too
+	sparse to tell. It's how many fewer data bits are set under the transparent part of the mask
+	than would be by chance.
+	"""
+	n = len(data) - SPRITE_SIZE + 1
+	# Each half is 16 bytes of mask followed by 16 bytes of data
+	overlaps = _window_sums(popcount[data[16:] & data[:-16]], 16)
+	overlap = overlaps[:n] + overlaps[32:32 + n]
+	bits = _window_sums(popcount[data], 16)
+	mask = bits[:n] + bits[32:32 + n]
+	drawn = bits[16:16 + n] + bits[48:48 + n]
+	expected = mask * drawn / 256
+	with np.errstate(divide="ignore", invalid="ignore"):
+		ret = np.clip(1 - overlap / expected, 0, 1)
+	ret[expected < MIN_EXPECTED] = np.nan
+	return ret
+
+
+def _runs(flags: np.ndarray) -> List[Tuple[int, int]]:
+	""" [start, end) of each run of True in flags. """
+	edges = np.flatnonzero(np.diff(np.concatenate(([0], flags.astype(np.int8), [0]))))
+	return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+def _candidates(
+	kind: str, scores: np.ndarray, claimed: np.ndarray, size: int, window: int, threshold: float
+) -> Iterable[Candidate]:
+	""" Runs of units which score well on average, at every phase. """
+	claimed = _window_sums(claimed, size) > 0
+	kernel = np.ones(window, np.int64)
+	for phase in range(size):
+		units = scores[phase::size]
+		if len(units) < window:
+			continue
+		blocked = claimed[phase::size][:len(units)]
+		valid = ~np.isnan(units) & ~blocked
+		values = np.where(valid, units, 0)
+		sums = np.convolve(values, kernel, "valid")
+		counts = np.convolve(valid, kernel, "valid")
+		good = (counts >= 2) & (np.convolve(blocked, kernel, "valid") == 0)
+		good &= sums >= threshold * counts
+		covered = np.convolve(good, kernel)[:len(units)] > 0
+
+		for a, b in _runs(covered):
+			# Trim what doesn't look drawn off either end
+			drawn = np.flatnonzero(valid[a:b] & (values[a:b] >= threshold))
+			a, b = a + int(drawn[0]), a + int(drawn[-1]) + 1
+			if b - a >= window:
+				score = float(values[a:b][valid[a:b]].mean())
+				yield Candidate(kind, phase + a * size, phase + b * size, score)
+
+
+@profiled
+def scan(rom: Rom, known: Iterable[Tuple[int, int]] = ()) -> List[Candidate]:
+	"""
+	Candidate tilesets and spritesets outside of the known ranges, best first.
+	Where candidates overlap, the better is kept, and spritesets before tilesets, since sprites
+	are also drawn and so look like tiles too.
+	"""
+	data = np.frombuffer(rom.view(0), np.uint8)
+	claimed = np.zeros(len(data), np.int8)
+	for start, end in known:
+		claimed[max(start, 0):max(end, 0)] = 1
+
+	found: List[Candidate] = []
+	taken = np.zeros(len(data), bool)
+	for kind, scores, size, window, threshold in (
+		("spriteset", sprite_scores(data), SPRITE_SIZE, SPRITE_WINDOW, SPRITE_THRESHOLD),
+		("tileset", tile_scores(data), TILE_SIZE, TILE_WINDOW, TILE_THRESHOLD),
+	):
+		candidates = _candidates(kind, scores, claimed, size, window, threshold)
+		for c in sorted(candidates, key=lambda c: c.rank, reverse=True):
+			if not taken[c.start:c.end].any():
+				taken[c.start:c.end] = True
+				found.append(c)
+	return sorted(found, key=lambda c: c.rank, reverse=True)
+
+
+def contact_sheet(
+	rom: Rom, candidates: Iterable[Candidate], columns: int = 6, rows: int = 8
+) -> Image.Image:
+	"""
+	Thumbnails of the first rows of each candidate, captioned with its address.
+	Sprites are shown at half size over grey, so both kinds are 128 pixels wide.
+	"""
+	cell_width, cell_height, caption = 128, rows * 8, 12
+	candidates = list(candidates)
+	lines = -(-len(candidates) // columns)
+	ret = Image.new("L", (columns * (cell_width + 4), lines * (cell_height + caption + 4)), 0xff)
+	draw = ImageDraw.Draw(ret)
+	for i, c in enumerate(candidates):
+		x, y = i % columns * (cell_width + 4), i // columns * (cell_height + caption + 4)
+		if c.kind == "tileset":
+			length = min(c.end - c.start, 16 * rows * TILE_SIZE)
+			height = -(-length // (16 * TILE_SIZE)) * 8
+			thumb = Image.fromarray(decode_tiles(rom.read(c.start, length), 128, height))
+		else:
+			length = min(c.end - c.start, 16 * rows * SPRITE_SIZE)
+			height = -(-length // (16 * SPRITE_SIZE)) * 16
+			pixels = decode_sprites(rom.read(c.start, length), 256, height)
+			thumb = Image.new("L", (256, height), 0x80)
+			thumb.paste(Image.fromarray(pixels[..., 0]), mask=Image.fromarray(pixels[..., 1]))
+			thumb = thumb.resize((128, height // 2), Image.NEAREST)
+		ret.paste(thumb, (x, y))
+		draw.text((x, y + cell_height), f"{c.kind[0]} ${c.start:06x}", fill=0)
+	return ret
@@ -0,0 +1,212 @@
+"""
+Replay AI ghosts over their tracks without the game, to find ones which get stuck or never finish.
+Every ghost is stepped at once, one element of each array per ghost.
+The physics are an approximation of the game's, meant to tell a working ghost from
+one which runs into a wall, not to predict exact times.
+"""
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .maps import tile_types
+from .profiling import profiled
+from .structures import TrackGhost, GrandPrixTrack
+
+TILE = 8
+# Size of a character, whose position is their bottom left corner like StartingPos
+WIDTH = 16
+HEIGHT = 16
+# The flag is where the last 12 columns, which repeat the first 12, start
+FINISH_COLUMNS = 12
+
+# Speeds are in pixels per tick, and gravity in pixels per tick per tick. These are guesses
+# which haven't been tuned until the ROM's own ghosts all finish, so failures are only warnings.
+RUN_SPEED = 1.0
+DASH_SPEED = 2.0
+SLOW_FACTOR = 0.5
+JUMP_SPEED = -3.5
+GRAVITY = 0.25
+MAX_FALL = 4.0
+SWIM_SPEED = 0.75
+SWIM_STROKE = -1.5
+SWIM_GRAVITY = 0.0625
+
+# How long a ghost can go without getting further right before it's stuck
+STUCK_TICKS = 120
+
+difficulties = ("easy", "normal", "hard")
+
+# Tile number to a flag for its kind, so several kinds can be tested for at once
+kinds = tuple(kind for _, kind, _ in tile_types)
+kind_of = np.zeros(0x100, np.uint8)
+for tiles, kind, _ in tile_types:
+	kind_of[tiles.start:tiles.stop] = 1 << kinds.index(kind)
+NON_SOLID, SOLID, GRASS, WATER, SLOWING, ONE_WAY = (
+	1 << kinds.index(k) for k in ("non-solid", "solid", "grass", "water", "slowing", "one-way")
+)
+# Rows of open space above the map, which is more than anyone can jump
+SKY = 8
+
+
+class GhostReport(NamedTuple):
+	track: str
+	difficulty: str
+	# Tick the ghost reached the flag on, or None if it didn't
+	finish: Optional[int]
+	# Tick and position of every time it went STUCK_TICKS without getting further right
+	stuck: List[Tuple[int, int, int]]
+	# Tick and position of every time it ran into a wall
+	collisions: List[Tuple[int, int, int]]
+	# Tick the ghost's inputs ran out on
+	duration: int
+
+	@property
+	def ok(self) -> bool:
+		return self.finish is not None and not self.stuck
+
+	def __str__(self) -> str:
+		ret = [f"{self.track} {self.difficulty}:"]
+		if self.finish is None:
+			ret.append(f"didn't finish in {self.duration} ticks,")
+		else:
+			ret.append(f"finished in {self.finish} ticks,")
+		ret.append(f"{len(self.collisions)} collision(s)")
+		lines = [" ".join(ret)]
+		for tick, x, y in self.stuck:
+			lines.append(f"  stuck at ({x}, {y}) on tick {tick}")
+		return "\n".join(lines)
+
+
+def _kind_grids(tracks: Sequence[GrandPrixTrack]) -> np.ndarray:
+	"""
+	Kinds of every tile of every track, padded to the biggest size.
+	Each is surrounded by solid tiles, except for SKY rows of open space above it,
+	so nothing can leave the map. Tile (x, y) is at [SKY + y, 1 + x].
+	"""
+	height = max(t.metadata.height for t in tracks)
+	width = max(t.metadata.width for t in tracks)
+	ret = np.full((len(tracks), SKY + height + 1, width + 2), SOLID, np.uint8)
+	ret[:, :SKY, 1:-1] = NON_SOLID
+	for i, track in enumerate(tracks):
+		w, h = track.metadata.width, track.metadata.height
+		tiles = np.zeros(w * h, np.uint8)
+		tilemap = np.frombuffer(track.tilemap, np.uint8)[:w * h]
+		tiles[:len(tilemap)] = tilemap
+		ret[i, SKY:SKY + h, 1:1 + w] = kind_of[tiles.reshape(h, w)]
+	return ret
+
+
+def _key_timeline(ghosts: Sequence[TrackGhost]) -> np.ndarray:
+	""" The keys each ghost holds on each tick, END after it runs out. """
+	ret = np.full((len(ghosts), max(g.duration for g in ghosts) + 1), TrackGhost.END, np.uint8)
+	for i, ghost in enumerate(ghosts):
+		keys, ticks = np.frombuffer(ghost.data, np.uint8).reshape(-1, 2).T
+		held = keys != TrackGhost.END
+		timeline = np.repeat(keys[held], ticks[held])
+		ret[i, :len(timeline)] = timeline
+	return ret
+
+
+@profiled
+def simulate(tracks: Sequence[GrandPrixTrack]) -> List[GhostReport]:
+	""" Replay every difficulty's ghost of each track, in that order. """
+	if not tracks:
+		return []
+	grids = _kind_grids(tracks)
+	ghosts = [getattr(t, f"ai_{d}") for t in tracks for d in difficulties]
+	timeline = _key_timeline(ghosts)
+	n = len(ghosts)
+
+	track = np.repeat(np.arange(len(tracks)), len(difficulties))
+	width = np.repeat([t.metadata.width * TILE for t in tracks], len(difficulties))
+	finish_x = width - FINISH_COLUMNS * TILE
+	x = np.repeat([float(t.metadata.starting_x) for t in tracks], len(difficulties))
+	y = np.repeat([float(t.metadata.starting_y) for t in tracks], len(difficulties))
+	vy = np.zeros(n)
+	grounded = np.zeros(n, bool)
+	swimming = np.zeros(n, bool)
+	blocked = np.zeros(n, bool)
+	running = np.ones(n, bool)
+	finish = np.full(n, -1)
+	best_x = x.copy()
+	progress = np.zeros(n, int)
+
+	stuck: List[List[Tuple[int, int, int]]] = [[] for _ in range(n)]
+	collisions: List[List[Tuple[int, int, int]]] = [[] for _ in range(n)]
+
+	_, rows, columns = grids.shape
+	flat = grids.ravel()
+	offset = track * rows * columns
+
+	def kind_at(px: np.ndarray, py: np.ndarray) -> np.ndarray:
+		tx = np.clip(px // TILE + 1, 0, columns - 1).astype(int)
+		ty = np.clip(py // TILE + SKY, 0, rows - 1).astype(int)
+		return flat[offset + ty * columns + tx]
+
+	def any_kind(ks: Sequence[np.ndarray], want: int) -> np.ndarray:
+		ret = ks[0]
+		for k in ks[1:]:
+			ret = ret | k
+		return (ret & want) != 0
+
+	for tick in range(timeline.shape[1]):
+		keys = timeline[:, tick]
+		running &= keys != TrackGhost.END
+		if not running.any():
+			break
+
+		# Where the body is decides how fast it moves
+		body = [kind_at(x + WIDTH / 2, y - HEIGHT / 2), kind_at(x + WIDTH / 2, y - 1)]
+		in_water = any_kind(body, WATER)
+		slowed = any_kind(body, GRASS | SLOWING)
+		jump = (keys & TrackGhost.A) != 0
+		swimming = (swimming | (in_water & grounded)) & ~(jump & grounded)
+
+		direction = ((keys & TrackGhost.RIGHT) != 0).astype(int) - ((keys & TrackGhost.LEFT) != 0)
+		speed = np.where((keys & TrackGhost.B) != 0, DASH_SPEED, RUN_SPEED)
+		speed = np.where(slowed, speed * SLOW_FACTOR, speed)
+		speed = np.where(swimming, np.minimum(speed, SWIM_SPEED), speed)
+
+		# Move sideways unless there's a wall in the way
+		new_x = x + direction * speed
+		edge = np.where(direction > 0, new_x + WIDTH - 1, new_x)
+		wall = any_kind([kind_at(edge, y - d) for d in (HEIGHT, HEIGHT / 2 + 1, 1)], SOLID)
+		hit = running & wall & (direction != 0)
+		for i in np.flatnonzero(hit & ~blocked):
+			collisions[i].append((tick, int(x[i]), int(y[i])))
+		blocked = hit
+		x = np.where(running & ~hit, new_x, x)
+
+		# Then fall or jump
+		vy = np.where(running & jump & (grounded | swimming),
+			np.where(swimming, SWIM_STROKE, JUMP_SPEED), vy)
+		vy = np.minimum(vy + np.where(swimming, SWIM_GRAVITY, GRAVITY), MAX_FALL)
+		new_y = y + vy
+		feet = [kind_at(x + d, new_y) for d in (2, WIDTH / 2, WIDTH - 3)]
+		top = new_y // TILE * TILE
+		landed = running & (vy > 0) & (
+			any_kind(feet, SOLID) | (any_kind(feet, ONE_WAY) & (y <= top))
+		)
+		head = [kind_at(x + d, new_y - HEIGHT) for d in (2, WIDTH / 2, WIDTH - 3)]
+		bumped = running & (vy < 0) & any_kind(head, SOLID)
+		y = np.where(landed, top, np.where(bumped, y, np.where(running, new_y, y)))
+		vy = np.where(landed | bumped, 0.0, vy)
+		grounded = landed
+
+		moved = x > best_x + 1
+		best_x = np.where(moved, x, best_x)
+		progress = np.where(moved, tick, progress)
+		for i in np.flatnonzero(running & (tick - progress == STUCK_TICKS)):
+			stuck[i].append((tick, int(x[i]), int(y[i])))
+
+		done = running & (x >= finish_x)
+		finish = np.where(done, tick, finish)
+		running &= ~done
+
+	return [
+		GhostReport(
+			t.ident, d, None if finish[i] < 0 else int(finish[i]), stuck[i], collisions[i],
+			ghosts[i].duration
+		)
+		for i, (t, d) in enumerate((t, d) for t in tracks for d in difficulties)
+	]
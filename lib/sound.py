@@ -1,10 +1,10 @@
 import os
 import re
 import string
-import textwrap
-from typing import BinaryIO, Dict, Sequence
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple
 
-from .util import PokeImportError, PokeImportWarning
+from .profiling import profiled
+from .util import PokeImportError, PokeImportWarning, unchanged
 
 
 class MinLibSound:
@@ -49,165 +49,346 @@ class MinLibSound:
 
 	mml_to_op = {v: k for k, v in op_to_mml.items()}
 
-	_splitter = re.compile(r'(/\*[\s\S]+?\*/)|//.*|(xx..)|(\d+\.*)|(/(?!\*)|[^\d.\s/]+)')
+	# Tables the compiler looks things up in
+	notes = {
+		name: i
+		for i, name in enumerate(("c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"))
+	}
+	lowest_octave = 2
+	rest = mml_to_op["r"]
+	lengths = {v[1:]: k for k, v in op_to_mml.items() if isinstance(v, str) and v[0] == "l"}
+	# Ops which can take a length, by how they may be written
+	pending_ops = {"r": "r", "l": "l", "]": "]"}
+	for i, name in enumerate("cdefgab"):
+		pending_ops.update({
+			name: name,
+			f"{name}#": f"{name}#",
+			f"{name}+": f"{name}#",
+			f"{name}-": f"{'cdefgab'[i - 1]}#",
+		})
+	del i, name
+	# Ops which take a number and become one byte, eg. w128
+	numbered_ops = {k: v for k, v in mml_to_op.items() if isinstance(k, str) and k[0] in "w%"}
+	# Ops which take a number but can't be compiled yet
+	unsupported_numbered_ops = frozenset("\\/vqs")
+	effect_ops = frozenset("tdapsrx")
+
+	# Ops which set something the notes and rests after them use, to which thing they set
+	state_ops = {k: v[0] for k, v in op_to_mml.items() if isinstance(v, str) and v[0] in "lw%"}
+	loop_start = mml_to_op["["]
+	loop_end = mml_to_op["]"]
 
-	def __init__(self, ident: str):
+	# Comments, raw bytes, numbers, and anything else. Without groups, as they're slower
+	_splitter = re.compile(r'/\*[\s\S]+?\*/|//.*|xx..|\d+\.*|/(?!\*)|[^\d.\s/]+')
+
+	def __init__(self, ident: str, ops: Sequence[str] = ()):
 		self.ident = ident
-		self.ops: Sequence[str] = []
+		self._ops: Optional[List[str]] = list(ops)
+		self._bin: Optional[bytes] = None
+		# Why the ops can't be compiled, raised when the bytes are asked for
+		self._error: Optional[str] = None
+
+	@property
+	def ops(self) -> List[str]:
+		""" The song as MML ops. Songs compiled from MML get these by decoding their bytes. """
+		if self._ops is None:
+			self._ops = self.from_bin(self.ident, self.to_bin()).ops
+		return self._ops
+
+	@ops.setter
+	def ops(self, ops: List[str]):
+		self._ops = ops
+		self._bin = None
+		self._error = None
 
 	@classmethod
 	def from_bin(cls, ident: str, raw: bytes) -> "MinLibSound":
 		ret = cls(ident)
 		for i, x in enumerate(raw):
 			op = cls.op_to_mml.get(x, f"xx{x:02x}")
-			(ret.ops.extend if isinstance(op, tuple) else ret.ops.append)(op)
+			(ret._ops.extend if isinstance(op, tuple) else ret._ops.append)(op)
+		ret._bin = bytes(raw)
 		return ret
 
 	def to_bin(self) -> bytes:
-		ret = bytearray()
-		cur_o = "o??"
-		for op in self.ops:
-			with_o = ""
-			try:
-				if op[0] == "o":
-					cur_o = op
-				elif op == "<":
-					cur_o = f"o{int(cur_o[1:]) - 1}"
-				elif op == ">":
-					cur_o = f"o{int(cur_o[1:]) + 1}"
-				elif op[0] in "cdefgab":
-					op, l = (op[:2], op[2:]) if op[1:2] == "#" else (op[0], op[1:])
-					if l:
-						ret.append(self.mml_to_op[f"l{l}"])
-					with_o = f" with octave {cur_o}"
-					ret.append(self.mml_to_op[(cur_o, op)])
-				elif op[0] == "r":
-					l = op[1:]
-					if l:
-						ret.append(self.mml_to_op[f"l{l}"])
-					ret.append(self.mml_to_op["r"])
-				elif op.startswith("xx"):
-					ret.append(int(op[2:], 16))
-				else:
-					ret.append(self.mml_to_op[op])
-			except KeyError:
-				raise PokeImportError(f"no way to compile {op}{with_o}") from None
-		return bytes(ret)
-
-	def optimize(self):
-		# TODO: detect odd lengths out in a sequence or like permutate and find shortest idk?
-		# or maybe split normalize and optimize, then we can find common patterns?
-		# yapf: disable
-		current: Dict[str, str] = {
-			"l": "", "w": "", "%": "", "o": "",
-			# Not generated (yet?)
-			"v": "", "q": "", "s": "",
-		}
-		# yapf: enable
-
-		new_ops = []
+		if self._bin is None:
+			self._bin, self._error = self._compile(" ".join(self._ops))
+		if self._error:
+			raise PokeImportError(self._error)
+		return self._bin
+
+	def optimize(self) -> int:
+		""" Make the song smaller without changing how it sounds, returning how much smaller. """
+		raw = self.to_bin()
+		new = self.optimize_bin(raw)
+		if len(new) < len(raw):
+			self._ops = None
+			self._bin = new
+		return len(raw) - len(new)
+
+	@classmethod
+	def optimize_bin(cls, raw: bytes) -> bytes:
+		"""
+		Drop the length, tempo, and % changes which can't be heard: those which are changed again
+		before anything plays, and those which set what's already set.
+		Songs with bytes this doesn't know are left alone, as they may be arguments to something.
+		"""
+		if any(x not in cls.op_to_mml for x in raw):
+			return raw
+		ops = list(raw)
+		while True:
+			size = len(ops)
+			ops = cls._drop_repeated(cls._drop_unused(ops))
+			if len(ops) == size:
+				return bytes(ops)
+
+	@classmethod
+	def _drop_unused(cls, ops: List[int]) -> List[int]:
+		""" Drop state changes which are changed again before any note or rest uses them. """
+		state_ops = cls.state_ops
+		starts = [i for i, op in enumerate(ops) if op == cls.loop_start]
+		keep = [True] * len(ops)
+		for kind in set(state_ops.values()):
+			# Whether what's set before each op gets used. ] goes back to a [, which one is
+			# unclear so it's any of them, so this repeats until that settles
+			looped = False
+			while True:
+				used = [True] * (len(ops) + 1)
+				for i in range(len(ops) - 1, -1, -1):
+					op = ops[i]
+					if op == cls.loop_end:
+						used[i] = looped
+					elif op == cls.loop_start or op in state_ops and state_ops[op] != kind:
+						used[i] = used[i + 1]
+					else:
+						used[i] = state_ops.get(op) != kind
+				if any(used[i] for i in starts) == looped:
+					break
+				looped = not looped
+			for i, op in enumerate(ops):
+				if state_ops.get(op) == kind and not used[i + 1]:
+					keep[i] = False
+		return [op for op, k in zip(ops, keep) if k]
+
+	@classmethod
+	def _drop_repeated(cls, ops: List[int]) -> List[int]:
+		""" Drop state changes to what's already set. """
+		state_ops = cls.state_ops
+		starts = [i for i, op in enumerate(ops) if op == cls.loop_start]
+		keep = [True] * len(ops)
+		for kind in set(state_ops.values()):
+			# What's set at a [ is unknown unless the loop ends with the same thing set,
+			# which can change what the loop ends with, so this repeats until that settles
+			unknown = set()
+			while True:
+				value: Optional[int] = None
+				# What's set before each op
+				before = []
+				ends = []
+				for i, op in enumerate(ops):
+					if i in unknown:
+						value = None
+					before.append(value)
+					if state_ops.get(op) == kind:
+						value = op
+					elif op == cls.loop_end:
+						ends.append(value)
+						value = None
+				more = {i for i in starts if any(before[i] != end for end in ends)} - unknown
+				if not more:
+					break
+				unknown |= more
+			for i, op in enumerate(ops):
+				if state_ops.get(op) == kind and before[i] == op:
+					keep[i] = False
+		return [op for op, k in zip(ops, keep) if k]
+
+	def iter_pmmusic_mml(self) -> Iterator[str]:
+		octave = ""
 		for op in self.ops:
-			o = op[0]
-			if o == "x":
-				# TODO: effects
-				new_ops.append(op)
-			elif o in "olw%":
-				a = op[1:]
-				if current[o] != a:
-					new_ops.append(op)
-					current[o] = a
-			else:
-				new_ops.append(op)
-		self.ops = new_ops
+			if op[0] == "o":
+				# Octaves are only needed when they change, they don't compile to anything
+				if op == octave:
+					continue
+				octave = op
+			elif op in ("<", ">"):
+				octave = ""
+			yield f"/*{op}*/" if op.startswith("xx") else op
 
 	def to_pmmusic_mml(self) -> str:
-		return " ".join(f"/*{op}*/" if op.startswith("xx") else op for op in self.ops)
+		return " ".join(self.iter_pmmusic_mml())
 
 	@classmethod
-	def from_pmmusic_mml(cls, ident: str, s: str) -> "MinLibSound":
-		def next_token(command: str, expect: str = "") -> str:
-			comment = "//"
-			while comment:
-				try:
-					comment, xx, numeric, op = next(it).groups()
-				except StopIteration:
-					raise PokeImportError("unexpected end of MML")
-			if expect == "#" and not numeric.isdecimal():
-				raise PokeImportError(f"expected numeric argument to {command}, got {n}")
-			return xx or numeric or op
-
+	def from_pmmusic_mml(
+		cls, ident: str, s: str, macros: Optional[Dict[str, str]] = None
+	) -> "MinLibSound":
 		ret = cls(ident)
-		it = cls._splitter.finditer(s)
-		last_op = ""
+		ret._ops = None
+		ret._bin, ret._error = cls._compile(s, macros)
+		return ret
 
-		for mo in it:
-			comment: str
-			xx: str
-			numeric: str
-			op: str
-			comment, xx, numeric, op = mo.groups()
-			if numeric:
-				if last_op:
-					ret.ops.append(last_op + numeric)
-					last_op = ""
-					continue
-				raise PokeImportError(f"numeric with no command: {numeric}")
+	@classmethod
+	def _expand(
+		cls, tokens: List[str], macros: Dict[str, str], using: Tuple[str, ...] = ()
+	) -> List[str]:
+		""" Replace the macros in tokens with their tokens. """
+		ret = []
+		for token in tokens:
+			if token not in macros:
+				ret.append(token)
+			elif token in using:
+				raise PokeImportError(f"macro {token} uses itself")
+			else:
+				ret.extend(
+					cls._expand(cls._splitter.findall(macros[token]), macros, (*using, token))
+				)
+		return ret
+
+	@classmethod
+	def _compile(
+		cls, s: str, macros: Optional[Dict[str, str]] = None
+	) -> Tuple[bytes, Optional[str]]:
+		"""
+		Compile MML straight to bytes in one pass.
+		Mistakes in the MML are raised, but ops which are fine MML that this can't compile
+		are returned as the error, so that songs which are never imported don't need to compile.
+		"""
+		out = bytearray()
+		append = out.append
+		error: Optional[str] = None
+		octave: Optional[int] = None
+		lengths, notes, pending_ops, rest = cls.lengths, cls.notes, cls.pending_ops, cls.rest
+		tokens = cls._splitter.findall(s)
+		it = iter(cls._expand(tokens, macros) if macros else tokens)
+
+		def next_token(command: str, numeric: bool = True) -> str:
+			for token in it:
+				if not token.startswith(("/*", "//")):
+					break
+			else:
+				raise PokeImportError("unexpected end of MML")
+			if numeric and not token.isdecimal():
+				raise PokeImportError(f"expected numeric argument to {command}, got {token}")
+			return token
+
+		def pending(op: str, n: str) -> Optional[str]:
+			""" Compile an op which may take a length, returning why not if it can't be. """
+			if n and op != "]":
+				if n not in lengths:
+					return f"no way to compile l{n}"
+				append(lengths[n])
+			if op in notes:
+				note = -1 if octave is None else (octave - cls.lowest_octave) * 12 + notes[op]
+				if not 0 <= note < rest:
+					return (
+						f"no way to compile {op} with octave "
+						f"o{'??' if octave is None else octave}"
+					)
+				append(note)
+			elif op == "r":
+				append(rest)
+			elif op == "]":
+				if n:
+					return f"no way to compile ]{n}"
+				append(cls.mml_to_op["]"])
+			elif op != "l":
+				return f"no way to compile {op} with octave o{'??' if octave is None else octave}"
+			return None
+
+		last_op = ""
+		for op in it:
+			if op[0].isdecimal():
+				if not last_op:
+					raise PokeImportError(f"numeric with no command: {op}")
+				if not error:
+					error = pending(last_op, op)
+				last_op = ""
+				continue
 			elif last_op:
 				if last_op == "l":
-					raise PokeImportError(f"expected numeric argument to l, got {n}")
-				ret.ops.append(last_op)
+					raise PokeImportError("expected numeric argument to l")
+				if not error:
+					error = pending(last_op, "")
 				last_op = ""
 
-			if comment:
-				if comment.startswith("/*xx"):
-					op = comment[2:-2]
-				else:
+			if op in pending_ops:
+				last_op = pending_ops[op]
+				continue
+			elif op.startswith(("/*", "//")):
+				if not op.startswith("/*xx"):
 					continue
+				op = op[2:-2]
 
-			if op[0] == "x" and op[1] in "tdapsrx":
-				# TODO: effects
+			if op[0] == "x" and op[1:2] in cls.effect_ops:
 				if op.startswith("xx"):
-					op, n = op[:2], op[2:]
+					n = op[2:]
 					if len(n) != 2 or any(c not in string.hexdigits for c in n):
 						raise PokeImportError(f"bad argument to xx: {n}")
-				elif op != "xd":
-					n = next_token(op, "#")
-					if op == "xa":
-						if next_token("xa") != ":":
-							raise PokeImportError("xa expects two arguments, xaN:M")
-						m = next_token("xa", "#")
-						n = f"{n}:{m}"
-				ret.ops.append(f"{op}{n}")
-			elif op[0] in "cdefgab" and op[1:] in ("#", "+", "-", "") or op in ("r", "l", "]"):
-				if op[1:] == "-":
-					last_op = f"{'cdefgab'['cdefgab'.index(op[0]) - 1]}#"
+					append(int(n, 16))
+					continue
+				# TODO: effects
+				n = "" if op == "xd" else next_token(op)
+				if op == "xa":
+					if next_token("xa", False) != ":":
+						raise PokeImportError("xa expects two arguments, xaN:M")
+					n = f"{n}:{next_token('xa')}"
+				error = error or f"no way to compile {op}{n}"
+			elif op in ("%", "w", "o") or op in cls.unsupported_numbered_ops:
+				n = next_token(op)
+				if op == "o":
+					octave = int(n)
+				elif op + n in cls.numbered_ops:
+					append(cls.numbered_ops[op + n])
 				else:
-					last_op = op.replace("+", "#")
-			elif op in ("%", "\\", "/", "v", "w", "o", "q", "s"):
-				n = next_token(op, "#")
-				if op in "\\/":
-					n = str(255 * int(n) // 100)
-				ret.ops.append(op + n)
+					if op in "\\/":
+						n = str(255 * int(n) // 100)
+					error = error or f"no way to compile {op}{n}"
 			elif op == "!":
-				n = next_token(op, "#")
-				if next_token("!") != ":":
+				n = next_token(op)
+				if next_token("!", False) != ":":
 					raise PokeImportError("! expects two arguments, !N:M")
-				m = next_token("!", "#")
-				ret.ops.append(f"!{n}:{m}")
-			elif len(op) == 1 and op in "<>[;" + string.ascii_uppercase:
-				# TODO: Macros
-				ret.ops.append(op)
+				m = next_token("!")
+				error = error or f"no way to compile !{n}:{m}"
+			elif op in ("<", ">"):
+				if octave is None:
+					error = error or f"no way to compile {op} with octave o??"
+				else:
+					octave += 1 if op == ">" else -1
+			elif op in ("[", ";"):
+				append(cls.mml_to_op[op])
+			elif len(op) == 1 and op in string.ascii_uppercase:
+				error = error or f"no macro {op}"
 			else:
 				raise PokeImportError(f"unknown MML command: {op}")
+
 		if last_op == "l":
-			raise PokeImportError(f"expected numeric argument to l, got {n}")
-		elif last_op:
-			ret.ops.append(last_op)
-		return ret
+			raise PokeImportError("expected numeric argument to l")
+		elif last_op and not error:
+			error = pending(last_op, "")
+		return bytes(out), error
 
 
+def _write_wrapped(f: TextIO, words: Iterable[str], width: int = 70):
+	""" Write words in tab indented lines of up to width characters, like textwrap. """
+	line: List[str] = []
+	length = 1
+	for word in words:
+		if line and length + 1 + len(word) > width:
+			f.write("\t" + " ".join(line) + "\n")
+			line.clear()
+			length = 1
+		length += len(word) + (1 if line else 0)
+		line.append(word)
+	f.write("\t" + " ".join(line) + "\n" if line else "\n")
+
+
+@profiled
 def write_pmmusic(bgms: Sequence[MinLibSound], folder: str):
-	with open(os.path.join(folder, "sounds.pmmusic"), "wt", encoding="utf8") as f:
+	fn = os.path.join(folder, "sounds.pmmusic")
+	if unchanged(fn, *((bgm.ident, bgm.ops) for bgm in bgms)):
+		return
+
+	with open(fn, "wt", encoding="utf8") as f:
 		f.write("TITLE Pokémon Race mini\n")
 		f.write("DESCRIPTION Dumped from the ROM\n")
 		f.write("/* Edit this to change the music.\n")
@@ -216,59 +397,90 @@ def write_pmmusic(bgms: Sequence[MinLibSound], folder: str):
 		f.write(" */\n")
 
 		for bgm in bgms:
-			#bgm.optimize()
-			mml = "\n".join(
-				textwrap.wrap(bgm.to_pmmusic_mml(), initial_indent="\t", subsequent_indent="\t")
-			)
-			f.write(f"\nPAT {bgm.ident} {{\n{mml}\n}}\n")
+			f.write(f"\nPAT {bgm.ident} {{\n")
+			_write_wrapped(f, bgm.iter_pmmusic_mml())
+			f.write("}\n")
 
 
-def read_pmmusic(folder: str) -> Dict[str, MinLibSound]:
-	music = {}
-	with open(os.path.join(folder, "sounds.pmmusic"), "rt", encoding="utf8") as f:
-		collecting = ""
-		collection = []
-		collection_name = ""
-		for line in f:
-			line = line.strip()
-			if not line:
-				continue
+# Directives which don't change what's imported
+_ignored_directives = frozenset({
+	"TITLE", "COMPOSER", "PROGRAMMER", "DESCRIPTION", "OUTFORMAT", "VARHEADER", "OUTHEADER",
+	"OUTFILE"
+})
 
-			if collecting:
-				if line[0] == "}":
-					if collecting == "pattern":
-						music[collection_name] = MinLibSound.from_pmmusic_mml(
-							collection_name, " ".join(collection)
-						)
-					collecting = ""
-				else:
-					collection.append(line)
-					continue
 
-			if line.startswith("VOLLVL") or line.startswith("VOLLEVEL"):
-				if line.split()[1] == "system":
+def _read_block(lines: Iterator[str]) -> str:
+	""" The lines of a pattern or macro, up to the one starting with }. """
+	ret = []
+	for line in lines:
+		if line.startswith("}"):
+			return "\n".join(ret)
+		elif line:
+			ret.append(line)
+	raise PokeImportError("missing } before the end of the file")
+
+
+def iter_pmmusic(
+	fn: str, macros: Optional[Dict[str, str]] = None, _including: Tuple[str, ...] = ()
+) -> Iterator[MinLibSound]:
+	"""
+	Compile each pattern of a pmmusic file as soon as it's read.
+	INCLUDEd files are read where they're included and share their macros,
+	which have to be defined before the patterns using them.
+	"""
+	fn = os.path.abspath(fn)
+	if fn in _including:
+		raise PokeImportError(f"{fn} includes itself")
+	macros = {} if macros is None else macros
+
+	with open(fn, "rt", encoding="utf8") as f:
+		lines = (line.strip() for line in f)
+		for line in lines:
+			if not line or line.startswith("//"):
+				continue
+			elif line.startswith("/*"):
+				while "*/" not in line:
+					line = next(lines, "*/")
+				continue
+
+			directive, *args = line.split()
+			if directive in ("VOLLVL", "VOLLEVEL"):
+				if args[:1] == ["system"]:
 					# TODO: convert to mml
 					raise PokeImportError("does not support VOLLVL system yet")
-			elif line.startswith("OCTREV") or line.startswith("OCTAVEREV"):
-				if line.split()[1] == "yes":
+			elif directive in ("OCTREV", "OCTAVEREV"):
+				if args[:1] == ["yes"]:
 					# TODO: invert
 					raise PokeImportError("does not support 'OCTREV yes' yet")
-			elif line.startswith("SHORTQ") or line.startswith("SHORTQUANTIZE"):
-				if line.split()[1] == "yes":
+			elif directive in ("SHORTQ", "SHORTQUANTIZE"):
+				if args[:1] == ["yes"]:
 					# TODO: invert
 					raise PokeImportError("does not support 'SHORTQ yes' yet")
 			# TODO: do we need warning for MTIME/MBPM?
-			elif line.startswith("PAT") or line.startswith("PATTERN"):
-				_, collection_name, lbrace, *comments = line.split()
-				assert lbrace == "{"  # It's required by pmmusic so idc
-				collecting = "pattern"
-				collection.clear()
-			# TODO: BGM, SFX, *_T, MACRO, INCLUDE
-			elif line.split()[0] not in {"TITLE", "COMPOSER", "PROGRAMMER", "DESCRIPTION",
-				"OUTFORMAT", "VARHEADER", "OUTHEADER", "OUTFILE"}:
-				PokeImportWarning(f"unknown or unsupported directive {line.split()[0]}")
-
-	return music
+			elif directive in ("PAT", "PATTERN"):
+				if args[1:2] != ["{"]:
+					raise PokeImportError(f"expected {directive} name {{")
+				yield MinLibSound.from_pmmusic_mml(args[0], _read_block(lines), macros)
+			elif directive == "MACRO":
+				if not args or len(args[0]) != 1 or args[0] not in string.ascii_uppercase:
+					raise PokeImportError("macros must be named with one capital letter")
+				elif args[1:2] == ["{"]:
+					macros[args[0]] = _read_block(lines)
+				else:
+					macros[args[0]] = " ".join(args[1:])
+			elif directive == "INCLUDE":
+				included = line[len(directive):].strip().strip('"')
+				yield from iter_pmmusic(
+					os.path.join(os.path.dirname(fn), included), macros, (*_including, fn)
+				)
+			# TODO: BGM, SFX, *_T
+			elif directive not in _ignored_directives:
+				PokeImportWarning(f"unknown or unsupported directive {directive}").warn()
+
+
+@profiled
+def read_pmmusic(folder: str) -> Dict[str, MinLibSound]:
+	return {bgm.ident: bgm for bgm in iter_pmmusic(os.path.join(folder, "sounds.pmmusic"))}
 
 
 # TODO: midi? wav? 3MLe's format?
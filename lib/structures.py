@@ -1,19 +1,26 @@
 import re
 import struct
-from typing import Any, BinaryIO, Dict, NamedTuple, Optional, Sequence, Tuple
-
-from .util import music, tilesets, load_tileset, spritesets, load_spriteset, PokeImportError
+from bisect import bisect_right
+from itertools import accumulate
+from typing import (
+	Any, BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+)
+
+from .util import (
+	music, tilesets, load_tileset, spritesets, load_spriteset, PokeImportError, Table
+)
 from .sound import MinLibSound
-from .encoders import encode_tiles
+from .rom import Rom
+from .profiling import profiled
+from .manifest import source_digest
 
 
 def to3b(x: int):
 	return x.to_bytes(3, "little")
 
 
-def read2b_base(f: BinaryIO, table_base: int, idx: int) -> int:
-	f.seek(table_base + idx * 2)
-	return (table_base & 0xff0000) + int.from_bytes(f.read(2), "little")
+def read2b_base(rom: Rom, table_base: int, idx: int) -> int:
+	return rom.ptr2b(table_base, idx)
 
 
 def write2b_base_and_seek(f: BinaryIO, table_base: int, idx: int, addr: int):
@@ -85,32 +92,84 @@ class TrackGhost:
 	}
 	# yapf: enable
 
-	def __init__(self):
-		self.ops: Sequence[Tuple[int, int]] = []
+	# Key value of the op which ends the ghost
+	END = 0xff
+
+	__slots__ = ("data", "_starts")
+
+	def __init__(self, data: bytes = b"\xff\x00"):
+		"""
+		data is the ghost as it is in the ROM: pairs of keys and how many ticks they're held for,
+		up to and including the END op.
+		"""
+		self.data = bytes(data)
+		self._starts: Optional[List[int]] = None
+
+	def __len__(self) -> int:
+		return len(self.data) // 2
+
+	def __iter__(self) -> Iterator[Tuple[int, int]]:
+		it = iter(self.data)
+		return zip(it, it)
+
+	def __eq__(self, other) -> bool:
+		return isinstance(other, TrackGhost) and self.data == other.data
+
+	def __hash__(self) -> int:
+		return hash(self.data)
+
+	@property
+	def keys(self) -> memoryview:
+		return memoryview(self.data)[0::2]
+
+	@property
+	def ticks(self) -> memoryview:
+		return memoryview(self.data)[1::2]
+
+	@property
+	def starts(self) -> List[int]:
+		""" The tick each op starts on, then the tick the ghost ends on. """
+		if self._starts is None:
+			self._starts = [0, *accumulate(self.ticks)]
+		return self._starts
+
+	@property
+	def duration(self) -> int:
+		return self.starts[-1]
+
+	def keys_at(self, tick: int) -> Optional[int]:
+		""" Return the keys held on tick, or None if the ghost has ended by then. """
+		i = bisect_right(self.starts, tick) - 1
+		if i < 0 or i >= len(self) or self.data[2 * i] == self.END:
+			return None
+		return self.data[2 * i]
 
 	@classmethod
-	def from_bin(cls, source: BinaryIO) -> "TrackGhost":
-		ret = cls()
+	def from_bin(cls, source: Union[bytes, memoryview]) -> "TrackGhost":
+		""" Read a ghost from the start of source, which can run past its end. """
+		window = 0x100
 		while True:
-			data = source.read(10)
-			for i in range(0, 10, 2):
-				keys = data[i]
-				ticks = data[i + 1]
-				ret.ops.append((keys, ticks))
-				if keys == 0xff:
-					source.seek(-(10 - i + 2), 1)
-					return ret
+			chunk = bytes(source[:window])
+			end = chunk.find(b"\xff")
+			# Only keys count, which are at even offsets
+			while end > 0 and end & 1:
+				end = chunk.find(b"\xff", end + 1)
+			if 0 <= end < len(chunk) - 1:
+				length = end + 2
+				break
+			if window >= len(source):
+				length = len(source) & ~1
+				break
+			window *= 4
+		return cls(source[:length])
 
 	def to_bin(self) -> bytes:
-		ret = bytearray()
-		for op in self.ops:
-			ret.extend(op)
-		return bytes(ret)
+		return self.data
 
 	def to_string(self):
 		ret = []
 		last_dir = 0
-		for keys, ticks in self.ops:
+		for keys, ticks in self:
 			op = []
 			if keys == 0:
 				op.append("r")
@@ -149,7 +208,7 @@ class TrackGhost:
 		# ↞ dash left
 		# ↠ dash right
 		# ↳x typical jump dash, [(1, 8), (0, 16), (64, x)]
-		ret = cls()
+		ret = bytearray()
 		matched = cls._splitter.finditer(s)
 		for mo in matched:
 			arrows: str = mo.group(0)
@@ -164,17 +223,19 @@ class TrackGhost:
 				raise PokeImportError(f"Expected tick count, found {ticks}")
 
 			ticks_i = int(ticks)
+			if ticks_i > 0xff:
+				raise PokeImportError(f"Tick count {ticks} is more than 255")
 			if arrows[0] == "↥" and all(x in "ABC" for x in arrows[1:]):
-				value = ret.ops[-1][0] | cls.A
+				value = ret[-2] | cls.A
 				if "B" in arrows:
 					value |= cls.B
 				if "C" in arrows:
 					value |= cls.C
-				ret.ops.append((value, ticks_i))
+				ret.extend((value, ticks_i))
 			elif arrows in ("↠", "»"):
-				ret.ops.append((cls.RIGHT | cls.B, ticks_i))
+				ret.extend((cls.RIGHT | cls.B, ticks_i))
 			elif arrows in ("↞", "«"):
-				ret.ops.append((cls.LEFT | cls.B, ticks_i))
+				ret.extend((cls.LEFT | cls.B, ticks_i))
 			else:
 				direction = 0
 				for a in arrows:
@@ -188,10 +249,10 @@ class TrackGhost:
 						direction |= cls.arrow_to_dir[a]
 					except KeyError:
 						raise PokeImportError(f"Key {a} is unknown.")
-				ret.ops.append((direction, ticks_i))
+				ret.extend((direction, ticks_i))
 
-		ret.ops.append((0xff, 0))
-		return ret
+		ret.extend((cls.END, 0))
+		return cls(ret)
 
 
 class SpriteAttrs(NamedTuple):
@@ -269,24 +330,27 @@ class GrandPrixTrack:
 	ai_normal: TrackGhost
 	ai_hard: TrackGhost
 
+	# Digest of the ROM data this was read from, if it was
+	source: Optional[str] = None
+
 	def __init__(self, ident: str, index: int, *, config: Dict[str, Any]):
 		self.bases = {}
 		self.ident = ident
 		self.index = index
 		self.config = config
 
-	def read(self, f: BinaryIO):
+	@profiled
+	def read(self, rom: Rom):
 		idx, config = self.index, self.config
-		metadata_base = read2b_base(f, config["metadata_array_base"], idx)
-		title_ditto_base = read2b_base(f, config["titles_nobar_tilemaps_array_base"], idx)
-		title_ranking_base = read2b_base(f, config["titles_bar_tilemaps_array_base"], idx)
+		metadata_base = rom.ptr2b(config["metadata_array_base"], idx)
+		title_ditto_base = rom.ptr2b(config["titles_nobar_tilemaps_array_base"], idx)
+		title_ranking_base = rom.ptr2b(config["titles_bar_tilemaps_array_base"], idx)
 
-		f.seek(config["track_screens_array_base"] + 2 * idx)
-		splash_map_base = 0x070000 | int.from_bytes(f.read(2), "little")
+		splash_map_base = 0x070000 | rom.u16(config["track_screens_array_base"] + 2 * idx)
 
-		ai_easy_base = read2b_base(f, config["ai_easy_table_base"], idx)
-		ai_normal_base = read2b_base(f, config["ai_normal_table_base"], idx)
-		ai_hard_base = read2b_base(f, config["ai_hard_table_base"], idx)
+		ai_easy_base = rom.ptr2b(config["ai_easy_table_base"], idx)
+		ai_normal_base = rom.ptr2b(config["ai_normal_table_base"], idx)
+		ai_hard_base = rom.ptr2b(config["ai_hard_table_base"], idx)
 
 		self.bases = {
 			"ai_easy": ai_easy_base,
@@ -298,54 +362,48 @@ class GrandPrixTrack:
 			"splash_map": splash_map_base,
 		}
 
-		f.seek(splash_map_base)
-		splash_map_data = f.read(12 * 4)
+		splash_map_data = rom.view(splash_map_base, 12 * 4)
 		self.splash_spritemap = [
 			SpriteAttrs.from_bin(splash_map_data[i:i + 4]) for i in range(0, 12 * 4, 4)
 		]
 
-		f.seek(ai_easy_base)
-		self.ai_easy = TrackGhost.from_bin(f)
-
-		f.seek(ai_normal_base)
-		self.ai_normal = TrackGhost.from_bin(f)
+		self.ai_easy = TrackGhost.from_bin(rom.view(ai_easy_base))
+		self.ai_normal = TrackGhost.from_bin(rom.view(ai_normal_base))
+		self.ai_hard = TrackGhost.from_bin(rom.view(ai_hard_base))
 
-		f.seek(ai_hard_base)
-		self.ai_hard = TrackGhost.from_bin(f)
+		self.metadata = GrandPrixTrackMetaData.from_bin(rom.view(metadata_base, 23))
+		load_tileset(rom, self.metadata.tileset_base, height=10)
+		load_tileset(rom, self.metadata.preview_tileset_base)
 
-		f.seek(metadata_base)
-		self.metadata = GrandPrixTrackMetaData.from_bin(f.read(23))
-		load_tileset(f, self.metadata.tileset_base, height=10)
-		load_tileset(f, self.metadata.preview_tileset_base)
-
-		f.seek(self.metadata.tilemap_base)
-		self.tilemap = f.read(self.metadata.width * self.metadata.height)
-		f.seek(self.metadata.preview_tilemap_base)
-		self.preview_tilemap = f.read(
+		self.tilemap = rom.read(
+			self.metadata.tilemap_base, self.metadata.width * self.metadata.height
+		)
+		self.preview_tilemap = rom.read(
+			self.metadata.preview_tilemap_base,
 			self.metadata.preview_map_width * self.metadata.preview_map_height
 		)
 
 		# right-aligned
-		f.seek(title_ditto_base)
-		self.title_ditto_tilemap = f.read(8)
+		self.title_ditto_tilemap = rom.read(title_ditto_base, 8)
 
 		# right-aligned and double lined (screen border)
-		f.seek(title_ranking_base)
-		self.title_ranking_tilemap = f.read(8)
+		self.title_ranking_tilemap = rom.read(title_ranking_base, 8)
 
-		load_spriteset(f, self.metadata.sprite_base, height=12)
+		load_spriteset(rom, self.metadata.sprite_base, height=12)
 
+		self.source = source_digest(
+			self.bases, self.metadata.to_bin(), self.tilemap, self.preview_tilemap,
+			self.title_ditto_tilemap, self.title_ranking_tilemap, splash_map_data,
+			self.ai_easy.to_bin(), self.ai_normal.to_bin(), self.ai_hard.to_bin()
+		)
+
+	@profiled
 	def write(self, f: BinaryIO, update_out: dict):
 		idx, config = self.index, self.config
 
 		write2b_base_and_seek(f, config["metadata_array_base"], idx, self.bases["metadata"])
 		f.write(self.metadata.to_bin())
 
-		f.seek(self.metadata.tileset_base)
-		f.write(encode_tiles(self.tileset))
-		f.seek(self.metadata.preview_tileset_base)
-		f.write(encode_tiles(self.preview_tileset))
-
 		f.seek(self.metadata.tilemap_base)
 		f.write(self.tilemap)
 		f.seek(self.metadata.preview_tilemap_base)
@@ -371,3 +429,55 @@ class GrandPrixTrack:
 	@property
 	def preview_tileset(self):
 		return tilesets[self.metadata.preview_tileset_base]
+
+
+def known_ranges(rom: Rom, config: Dict[str, Any]) -> List[Tuple[int, int]]:
+	"""
+	The [start, end) ranges of everything tracks.toml leads to: the tables and what they point
+	to, and the metadata, maps and graphics of every track.
+	"""
+	count = config["track_count"]
+	ret = [
+		(config[key], config[key] + 2 * count) for key in (
+		"audio_table_base", "metadata_array_base", "track_screens_array_base",
+		"titles_nobar_tilemaps_array_base", "titles_bar_tilemaps_array_base"
+		)
+	]
+	ret.append((config["ai_table_base"], config["ai_table_base"] + 2 * 3))
+
+	tables = [Table(config["audio_table_base"], count, (b"\xf0", b"\xf2"))]
+	for i in (0, 1, 2):
+		tables.append(Table(read2b_base(rom, config["ai_table_base"], i), count, b"\xff\x00"))
+	for table in tables:
+		table.read(rom)
+		ret.append((table.base, table.base + 2 * count))
+		if table.indices:
+			ret.append(table.block())
+
+	# Sizes are what GrandPrixTrack.read and the export load
+	for key, rows in (("titles_grand_prix_tileset", 8), ("titles_menus_tileset", 16)):
+		ret.append((config[key], config[key] + rows * 16 * 8))
+	for base in config["track_screens_gfx_bases"]:
+		ret.append((base, base + 15 * 16 * 64))
+
+	for idx in range(count):
+		metadata_base = rom.ptr2b(config["metadata_array_base"], idx)
+		m = GrandPrixTrackMetaData.from_bin(rom.view(metadata_base, 23))
+		ret += [
+			(metadata_base, metadata_base + 23),
+			(m.tileset_base, m.tileset_base + 10 * 16 * 8),
+			(m.preview_tileset_base, m.preview_tileset_base + 16 * 16 * 8),
+			(m.sprite_base, m.sprite_base + 12 * 16 * 64),
+			(m.tilemap_base, m.tilemap_base + m.width * m.height),
+			(
+			m.preview_tilemap_base,
+			m.preview_tilemap_base + m.preview_map_width * m.preview_map_height
+			),
+		]
+		for key in ("titles_nobar_tilemaps_array_base", "titles_bar_tilemaps_array_base"):
+			base = rom.ptr2b(config[key], idx)
+			ret.append((base, base + 8))
+		splash_map_base = 0x070000 | rom.u16(config["track_screens_array_base"] + 2 * idx)
+		ret.append((splash_map_base, splash_map_base + 12 * 4))
+
+	return ret
@@ -0,0 +1,181 @@
+"""
+Generate a ROM image with the layout described by tracks.toml, filled with random but
+well-formed data, for benchmarking and trying things out without the real ROM.
+"""
+import random
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+from .structures import TrackGhost, to3b
+
+ROM_SIZE = 0x80000
+BANK_SIZE = 0x10000
+
+# Sizes of the graphics GrandPrixTrack.read and the export load
+TRACK_TILESET_SIZE = 10 * 16 * 8
+PREVIEW_TILESET_SIZE = 16 * 16 * 8
+TRACK_SPRITESET_SIZE = 12 * 16 * 64
+SPLASH_SPRITESET_SIZE = 15 * 16 * 64
+TITLES_GRAND_PRIX_TILESET_SIZE = 8 * 16 * 8
+TITLES_MENUS_TILESET_SIZE = 16 * 16 * 8
+
+# Inputs which survive TrackGhost.to_string and from_string unchanged
+_ghost_keys = (
+	0, TrackGhost.RIGHT, TrackGhost.LEFT, TrackGhost.UP, TrackGhost.DOWN,
+	TrackGhost.RIGHT | TrackGhost.B, TrackGhost.LEFT | TrackGhost.B
+)
+
+
+class _Space:
+	""" Hands out non-overlapping ranges of the ROM, optionally within a given bank. """
+	def __init__(self, size: int):
+		self.size = size
+		self.used: List[Tuple[int, int]] = []
+
+	def reserve(self, addr: int, length: int) -> int:
+		self.used.append((addr, addr + length))
+		self.used.sort()
+		return addr
+
+	def alloc(self, length: int, bank: Optional[int] = None) -> int:
+		start, end = (0x2000, self.size) if bank is None else (bank, bank + BANK_SIZE)
+		addr = start
+		for a, b in self.used:
+			if b <= addr:
+				continue
+			if a >= addr + length:
+				break
+			addr = b
+		if addr + length > end:
+			raise ValueError(f"no room for {length} bytes in ${start:06x}~${end - 1:06x}")
+		return self.reserve(addr, length)
+
+
+def _song(rnd: random.Random) -> bytes:
+	ret = bytearray((rnd.choice((0xb0, 0xb2, 0xb4)), 0x82))
+	for _ in range(rnd.randrange(16, 96)):
+		r = rnd.random()
+		if r < 0.1:
+			ret.append(rnd.randrange(0x80, 0x89))
+		elif r < 0.2:
+			ret.append(0x49)
+		else:
+			ret.append(rnd.randrange(0x0c, 0x3c))
+	ret.append(0xf0)
+	return bytes(ret)
+
+
+def _ghost(rnd: random.Random) -> bytes:
+	ret = bytearray()
+	for _ in range(rnd.randrange(8, 48)):
+		ret += bytes((rnd.choice(_ghost_keys), rnd.randrange(1, 255)))
+	return bytes(ret + b"\xff\x00")
+
+
+def make_rom(config: Dict[str, Any], seed: int = 0, size: int = ROM_SIZE) -> bytes:
+	"""
+	Make a ROM with everything the tables in config point to.
+	Tracks in the same group of four share their graphics, like the cups do.
+	"""
+	rnd = random.Random(seed)
+	count = config["track_count"]
+	rom = bytearray(b"\xff" * size)
+	space = _Space(size)
+
+	def put(addr: int, data: bytes):
+		rom[addr:addr + len(data)] = data
+
+	def noise(length: int) -> bytes:
+		return rnd.getrandbits(length * 8).to_bytes(length, "little")
+
+	def bank(addr: int) -> int:
+		return addr & 0xff0000
+
+	def sprites(length: int) -> bytes:
+		# Each half of a sprite is 16 bytes of mask then 16 of data, which is clear under the mask
+		ret = bytearray(noise(length))
+		for i in range(0, length, 32):
+			for j in range(i, i + 16):
+				ret[j + 16] &= ~ret[j] & 0xff
+		return bytes(ret)
+
+	def ptr(addr: int) -> bytes:
+		return struct.pack("<H", addr & 0xffff)
+
+	# Fixed tables and graphics
+	for key in (
+		"audio_table_base", "metadata_array_base", "track_screens_array_base",
+		"titles_nobar_tilemaps_array_base", "titles_bar_tilemaps_array_base"
+	):
+		space.reserve(config[key], 2 * count)
+	space.reserve(config["ai_table_base"], 2 * 3)
+	for base in config["track_screens_gfx_bases"]:
+		put(space.reserve(base, SPLASH_SPRITESET_SIZE), sprites(SPLASH_SPRITESET_SIZE))
+	for key, length in (
+		("titles_grand_prix_tileset", TITLES_GRAND_PRIX_TILESET_SIZE),
+		("titles_menus_tileset", TITLES_MENUS_TILESET_SIZE),
+	):
+		put(space.reserve(config[key], length), noise(length))
+
+	# Music
+	for i in range(count):
+		song = _song(rnd)
+		addr = space.alloc(len(song), bank(config["audio_table_base"]))
+		put(config["audio_table_base"] + 2 * i, ptr(addr))
+		put(addr, song)
+
+	# AI, one table per difficulty
+	for difficulty in range(3):
+		table = space.alloc(2 * count, bank(config["ai_table_base"]))
+		put(config["ai_table_base"] + 2 * difficulty, ptr(table))
+		for i in range(count):
+			ghost = _ghost(rnd)
+			addr = space.alloc(len(ghost), bank(table))
+			put(table + 2 * i, ptr(addr))
+			put(addr, ghost)
+
+	for i in range(count):
+		# Titles
+		for key in ("titles_nobar_tilemaps_array_base", "titles_bar_tilemaps_array_base"):
+			addr = space.alloc(8, bank(config[key]))
+			put(config[key] + 2 * i, ptr(addr))
+			put(addr, bytes(rnd.randrange(0x100) for _ in range(8)))
+
+		# Splash screen sprite map, always in bank 7
+		addr = space.alloc(12 * 4, 0x070000)
+		put(config["track_screens_array_base"] + 2 * i, ptr(addr))
+		put(
+			addr,
+			b"".join(
+			bytes((16 * (j % 6), 16 * (j // 6), j, 0x08)) for j in range(12)
+			)
+		)
+
+	# Tracks
+	for i in range(count):
+		if i % 4 == 0:
+			tileset = space.alloc(TRACK_TILESET_SIZE)
+			preview_tileset = space.alloc(PREVIEW_TILESET_SIZE)
+			spriteset = space.alloc(TRACK_SPRITESET_SIZE)
+			put(tileset, noise(TRACK_TILESET_SIZE))
+			put(preview_tileset, noise(PREVIEW_TILESET_SIZE))
+			put(spriteset, sprites(TRACK_SPRITESET_SIZE))
+
+		width, height = rnd.randrange(64, 160), rnd.randrange(24, 48)
+		tilemap = space.alloc(width * height)
+		put(tilemap, bytes(rnd.randrange(0xa0) for _ in range(width * height)))
+
+		preview_width, preview_height = 24, 10
+		preview_tilemap = space.alloc(preview_width * preview_height)
+		put(preview_tilemap, noise(preview_width * preview_height))
+
+		metadata = struct.pack(
+			"<3s3s6B3s3s3s2B", to3b(tileset), to3b(tilemap), width, height, i,
+			rnd.randrange(16, 64), rnd.randrange(16, 64), 0, to3b(spriteset),
+			to3b(preview_tileset), to3b(preview_tilemap), preview_width, preview_height
+		)
+		addr = space.alloc(len(metadata), bank(config["metadata_array_base"]))
+		put(config["metadata_array_base"] + 2 * i, ptr(addr))
+		put(addr, metadata)
+
+	return bytes(rom)
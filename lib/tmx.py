@@ -0,0 +1,390 @@
+"""
+Reading and writing Tiled maps (TMX) and tilesets (TSX).
+Only what this editor uses is supported: orthogonal maps, tilesets made from a single image,
+tile layers, and object layers of rectangles. Layer data is converted straight to and from
+arrays of global tile IDs without building an object per tile.
+"""
+import os
+import zlib
+import gzip
+import base64
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+from typing import Dict, IO, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+TMX_VERSION = "1.2"
+
+# Tiled stores flipping and rotation in the top bits of global tile IDs
+GID_MASK = 0x0fffffff
+
+Properties = Dict[str, str]
+
+
+class TmxError(Exception):
+	pass
+
+
+class Tileset:
+	"""
+	A tileset made from one image. source is set when the tileset is stored in its own TSX,
+	and image is relative to the folder of whichever file the tileset is stored in.
+	"""
+	def __init__(
+		self,
+		name: str,
+		image: str,
+		image_size: Tuple[int, int],
+		tile_size: Tuple[int, int] = (8, 8),
+		*,
+		base_path: str = ".",
+		source: Optional[str] = None
+	):
+		self.name = name
+		self.image = image
+		self.image_width, self.image_height = image_size
+		self.tile_width, self.tile_height = tile_size
+		self.base_path = base_path
+		self.source = source
+		self.first_gid = 1
+		self.tile_properties: Dict[int, Properties] = {}
+
+	@property
+	def columns(self) -> int:
+		return self.image_width // self.tile_width
+
+	@property
+	def tile_count(self) -> int:
+		return self.columns * (self.image_height // self.tile_height)
+
+	def image_path(self) -> str:
+		path = os.path.join(self.base_path, self.image)
+		if not os.path.exists(path) and os.path.exists(self.image):
+			# Written relative to the working directory by old versions
+			return self.image
+		return path
+
+	def open_image(self) -> Image.Image:
+		with Image.open(self.image_path()) as img:
+			img.load()
+		return img
+
+	def _write(self, f: IO[str], indent: str, first_gid: Optional[int] = None):
+		f.write(
+			f"{indent}<tileset{_attrs(firstgid=first_gid, name=self.name)}"
+			f"{_attrs(tilewidth=self.tile_width, tileheight=self.tile_height)}"
+			f"{_attrs(tilecount=self.tile_count, columns=self.columns)}>\n"
+		)
+		f.write(
+			f"{indent} <image"
+			f"{_attrs(source=self.image, width=self.image_width, height=self.image_height)}/>\n"
+		)
+		for tile, props in sorted(self.tile_properties.items()):
+			if props:
+				f.write(f"{indent} <tile{_attrs(id=tile)}>\n")
+				_write_properties(f, props, indent + "  ")
+				f.write(f"{indent} </tile>\n")
+		f.write(f"{indent}</tileset>\n")
+
+	def save(self, fn: str):
+		""" Write as a TSX. """
+		with open(fn, "wt", encoding="utf8") as f:
+			f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+			self._write(f, "")
+
+	@classmethod
+	def _from_element(cls, elem: ElementTree.Element, base_path: str) -> "Tileset":
+		image = elem.find("image")
+		if image is None:
+			raise TmxError(f"tileset {elem.get('name')} has no image")
+		ret = cls(
+			elem.get("name", ""),
+			image.get("source"),
+			(int(image.get("width", 0)), int(image.get("height", 0))),
+			(int(elem.get("tilewidth")), int(elem.get("tileheight"))),
+			base_path=base_path,
+		)
+		if not ret.image_width or not ret.image_height:
+			with Image.open(ret.image_path()) as img:
+				ret.image_width, ret.image_height = img.size
+		for tile in elem.iterfind("tile"):
+			props = _read_properties(tile)
+			if props:
+				ret.tile_properties[int(tile.get("id"))] = props
+		return ret
+
+	@classmethod
+	def open(cls, fn: str) -> "Tileset":
+		""" Read a TSX. """
+		root = ElementTree.parse(fn).getroot()
+		if root.tag != "tileset":
+			raise TmxError(f"{fn} is not a TSX file")
+		return cls._from_element(root, os.path.dirname(fn))
+
+
+class TileLayer:
+	""" A layer of global tile IDs, 0 being no tile. """
+	def __init__(
+		self,
+		name: str,
+		width: int,
+		height: int,
+		gids: Optional[np.ndarray] = None,
+		*,
+		visible: bool = True
+	):
+		self.name = name
+		self.width = width
+		self.height = height
+		self.gids = np.zeros(width * height, np.uint32) if gids is None else gids
+		self.visible = visible
+		self.properties: Properties = {}
+
+	def grid(self) -> np.ndarray:
+		""" The tile IDs as a (height, width) view. """
+		return self.gids.reshape(self.height, self.width)
+
+	def _write(self, f: IO[str], layer_format: str):
+		f.write(
+			f" <layer{_attrs(name=self.name, width=self.width, height=self.height)}"
+			f"{'' if self.visible else _attrs(visible=0)}>\n"
+		)
+		_write_properties(f, self.properties, "  ")
+		if layer_format == "csv":
+			rows = self.grid().tolist()
+			f.write('  <data encoding="csv">\n')
+			f.write(",\n".join(",".join(map(str, row)) for row in rows))
+			f.write("\n</data>\n")
+		elif layer_format == "zlib":
+			data = zlib.compress(self.gids.astype("<u4").tobytes())
+			f.write('  <data encoding="base64" compression="zlib">\n')
+			f.write(f"   {base64.b64encode(data).decode('ascii')}\n")
+			f.write("  </data>\n")
+		else:
+			raise TmxError(f"unknown layer format {layer_format}")
+		f.write(" </layer>\n")
+
+	@classmethod
+	def _from_element(cls, elem: ElementTree.Element) -> "TileLayer":
+		width, height = int(elem.get("width")), int(elem.get("height"))
+		data = elem.find("data")
+		if data is None:
+			raise TmxError(f"layer {elem.get('name')} has no data")
+
+		encoding, compression = data.get("encoding"), data.get("compression")
+		if encoding == "csv":
+			gids = np.array(data.text.replace(",", " ").split(), np.uint32)
+		elif encoding == "base64":
+			raw = base64.b64decode(data.text.strip())
+			if compression == "zlib":
+				raw = zlib.decompress(raw)
+			elif compression == "gzip":
+				raw = gzip.decompress(raw)
+			elif compression:
+				raise TmxError(f"unsupported layer compression {compression}")
+			gids = np.frombuffer(raw, "<u4").astype(np.uint32)
+		elif encoding is None:
+			gids = np.array([int(tile.get("gid", 0)) for tile in data.iterfind("tile")], np.uint32)
+		else:
+			raise TmxError(f"unsupported layer encoding {encoding}")
+
+		if len(gids) != width * height:
+			raise TmxError(
+				f"layer {elem.get('name')} has {len(gids)} tiles, expected {width * height}"
+			)
+		ret = cls(
+			elem.get("name"), width, height, gids & GID_MASK, visible=elem.get("visible") != "0"
+		)
+		ret.properties = _read_properties(elem)
+		return ret
+
+
+class MapObject(NamedTuple):
+	"""
+	A rectangle. y is its bottom edge, where the TMX file has its top edge, the same as tmxlib
+	0.2.1 which earlier versions of the editor used, so StartingPos comes out where it did.
+	"""
+	name: str
+	x: float
+	y: float
+	width: float = 0
+	height: float = 0
+	type: str = ""
+
+
+class ObjectLayer:
+	def __init__(self, name: str, color: Optional[str] = None, *, visible: bool = True):
+		self.name = name
+		self.color = color
+		self.visible = visible
+		self.objects: List[MapObject] = []
+		self.properties: Properties = {}
+
+	def __getitem__(self, name: str) -> MapObject:
+		for obj in self.objects:
+			if obj.name == name:
+				return obj
+		raise KeyError(name)
+
+	def _write(self, f: IO[str], first_id: int):
+		f.write(
+			f" <objectgroup{_attrs(name=self.name, color=self.color)}"
+			f"{'' if self.visible else _attrs(visible=0)}>\n"
+		)
+		_write_properties(f, self.properties, "  ")
+		for i, obj in enumerate(self.objects, first_id):
+			f.write(
+				f"  <object{_attrs(id=i, name=obj.name, type=obj.type or None)}"
+				f"{_attrs(x=_num(obj.x), y=_num(obj.y - obj.height))}"
+				f"{_attrs(width=_num(obj.width), height=_num(obj.height))}/>\n"
+			)
+		f.write(" </objectgroup>\n")
+
+	@classmethod
+	def _from_element(cls, elem: ElementTree.Element) -> "ObjectLayer":
+		ret = cls(elem.get("name"), elem.get("color"), visible=elem.get("visible") != "0")
+		ret.properties = _read_properties(elem)
+		for obj in elem.iterfind("object"):
+			height = float(obj.get("height", 0))
+			ret.objects.append(
+				MapObject(
+					obj.get("name", ""), float(obj.get("x")),
+					float(obj.get("y")) + height, float(obj.get("width", 0)), height,
+					obj.get("type", "")
+				)
+			)
+		return ret
+
+
+Layer = Union[TileLayer, ObjectLayer]
+
+
+class TileMap:
+	def __init__(self, width: int, height: int, tile_size: Tuple[int, int] = (8, 8)):
+		self.width = width
+		self.height = height
+		self.tile_width, self.tile_height = tile_size
+		self.properties: Properties = {}
+		self.tilesets: List[Tileset] = []
+		self.layers: Dict[str, Layer] = {}
+
+	def add_tileset(self, tileset: Tileset) -> int:
+		""" Add tileset if it isn't already, and return its first global tile ID. """
+		if tileset not in self.tilesets:
+			last = self.tilesets[-1] if self.tilesets else None
+			tileset.first_gid = last.first_gid + last.tile_count if last else 1
+			self.tilesets.append(tileset)
+		return tileset.first_gid
+
+	def add_layer(self, name: str, **kwargs) -> TileLayer:
+		layer = self.layers[name] = TileLayer(name, self.width, self.height, **kwargs)
+		return layer
+
+	def add_object_layer(self, name: str, color: Optional[str] = None, **kwargs) -> ObjectLayer:
+		layer = self.layers[name] = ObjectLayer(name, color, **kwargs)
+		return layer
+
+	def tileset_of(self, gid: int) -> Tileset:
+		for tileset in reversed(self.tilesets):
+			if gid >= tileset.first_gid:
+				return tileset
+		raise TmxError(f"no tileset has tile {gid}")
+
+	def tile_numbers(self, gids: np.ndarray) -> np.ndarray:
+		""" Convert global tile IDs to numbers within their own tilesets. """
+		firsts = np.array([ts.first_gid for ts in self.tilesets], np.uint32)
+		if not len(firsts):
+			return gids.copy()
+		which = np.searchsorted(firsts, gids, side="right") - 1
+		return gids - firsts[np.maximum(which, 0)]
+
+	def save(self, fn: str, layer_format: str = "zlib"):
+		with open(fn, "wt", encoding="utf8") as f:
+			f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+			f.write(
+				f"<map{_attrs(version=TMX_VERSION, orientation='orthogonal')}"
+				f"{_attrs(renderorder='right-down', width=self.width, height=self.height)}"
+				f"{_attrs(tilewidth=self.tile_width, tileheight=self.tile_height)}>\n"
+			)
+			_write_properties(f, self.properties, " ")
+			for tileset in self.tilesets:
+				if tileset.source:
+					attrs = _attrs(firstgid=tileset.first_gid, source=tileset.source)
+					f.write(f" <tileset{attrs}/>\n")
+				else:
+					tileset._write(f, " ", tileset.first_gid)
+
+			next_id = 1
+			for layer in self.layers.values():
+				if isinstance(layer, ObjectLayer):
+					layer._write(f, next_id)
+					next_id += len(layer.objects)
+				else:
+					layer._write(f, layer_format)
+			f.write("</map>\n")
+
+	@classmethod
+	def open(cls, fn: str) -> "TileMap":
+		root = ElementTree.parse(fn).getroot()
+		if root.tag != "map":
+			raise TmxError(f"{fn} is not a TMX file")
+		if root.get("orientation", "orthogonal") != "orthogonal" or root.get("infinite") == "1":
+			raise TmxError(f"{fn} must be a finite, orthogonal map")
+
+		base_path = os.path.dirname(fn)
+		ret = cls(
+			int(root.get("width")), int(root.get("height")),
+			(int(root.get("tilewidth")), int(root.get("tileheight")))
+		)
+		ret.properties = _read_properties(root)
+		for elem in root:
+			if elem.tag == "tileset":
+				source = elem.get("source")
+				if source:
+					tileset = Tileset.open(os.path.join(base_path, source))
+					tileset.source = source
+				else:
+					tileset = Tileset._from_element(elem, base_path)
+				tileset.first_gid = int(elem.get("firstgid", 1))
+				ret.tilesets.append(tileset)
+			elif elem.tag == "layer":
+				layer = TileLayer._from_element(elem)
+				ret.layers[layer.name] = layer
+			elif elem.tag == "objectgroup":
+				layer = ObjectLayer._from_element(elem)
+				ret.layers[layer.name] = layer
+		ret.tilesets.sort(key=lambda ts: ts.first_gid)
+		return ret
+
+
+def _num(x: float) -> Union[int, float]:
+	return int(x) if x == int(x) else x
+
+
+def _attrs(**attrs) -> str:
+	return "".join(f" {k}={quoteattr(str(v))}" for k, v in attrs.items() if v is not None)
+
+
+def _write_properties(f: IO[str], props: Properties, indent: str):
+	if not props:
+		return
+	f.write(f"{indent}<properties>\n")
+	for name, value in props.items():
+		if "\n" in value:
+			# Tiled keeps multiline values as text
+			f.write(f"{indent} <property{_attrs(name=name)}>{escape(value)}</property>\n")
+		else:
+			f.write(f"{indent} <property{_attrs(name=name, value=value)}/>\n")
+	f.write(f"{indent}</properties>\n")
+
+
+def _read_properties(elem: ElementTree.Element) -> Properties:
+	ret = {}
+	props = elem.find("properties")
+	if props is not None:
+		for prop in props.iterfind("property"):
+			value = prop.get("value")
+			ret[prop.get("name")] = (prop.text or "") if value is None else value
+	return ret
@@ -2,20 +2,46 @@ import os
 import json
 import struct
 import warnings
-from typing import BinaryIO, Dict, Iterator, List, Sequence, Union, TYPE_CHECKING
+from typing import (
+	BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple, Union,
+	TYPE_CHECKING
+)
 
+import numpy as np
 from PIL import Image
 
 from .decoders import TileDecoder, SpriteDecoder
-from .encoders import encode_tiles
+from .encoders import encode_tiles, encode_sprites, to_paletted
+from .rom import Rom, RomJournal
+from .profiling import profiled
+from .manifest import source_digest
+from .alloc import FreeSpace, NoSpaceError
 
 if TYPE_CHECKING:
+	from .cache import AssetCache
+	from .manifest import ExportManifest
+	from .writer import WriteBehind
 	from .sound import MinLibSound
 	from .structures import GrandPrixTrack, SpriteAttrs
 
 music: Dict[int, "MinLibSound"] = {}
 tilesets: Dict[int, Image.Image] = {}
 spritesets: Dict[int, Image.Image] = {}
+# Graphics files already exported this run, so shared ones are only written once
+written: Set[str] = set()
+# Tilesets sliced into tiles for render_map, by base
+atlases: Dict[int, np.ndarray] = {}
+# Set to skip decoding assets which were decoded by a previous run
+cache: Optional["AssetCache"] = None
+# Set to skip exporting files whose source data hasn't changed since the last export
+manifest: Optional["ExportManifest"] = None
+# Digests of the ROM data each graphic was loaded from
+tileset_sources: Dict[int, str] = {}
+spriteset_sources: Dict[int, str] = {}
+# Set to save PNGs as 1 or 2 bit paletted images instead of 8 bit L or LA ones
+paletted = False
+# Set to save files on other threads while the export goes on
+writer: Optional["WriteBehind"] = None
 
 
 class PokeImportError(Exception):
@@ -27,37 +53,141 @@ class PokeImportWarning(Warning):
 		warnings.warn(self, stacklevel=2)
 
 
-def load_tileset(f: BinaryIO, base: int, height=16):
+def unchanged(fn: str, *sources) -> bool:
+	""" Whether fn was already exported from the same sources, see ExportManifest. """
+	if manifest is None or any(source is None for source in sources):
+		return False
+	return manifest.fresh(fn, source_digest(*sources))
+
+
+def png_unchanged(fn: str, *sources) -> bool:
+	""" unchanged for a PNG, which also has to be paletted or not like it was before. """
+	return unchanged(fn, *sources, "paletted") if paletted else unchanged(fn, *sources)
+
+
+def write_behind(fn: Callable[..., object], *args):
+	""" Call fn with args on the writer if there is one, otherwise now. """
+	if writer is None:
+		fn(*args)
+	else:
+		writer.submit(fn, *args)
+
+
+def _save_png(img: Image.Image, fn: str, paletted: bool):
+	if paletted:
+		# Compressing images this small harder costs next to nothing
+		to_paletted(img).save(fn, compress_level=9)
+	else:
+		img.save(fn)
+
+
+def save_png(img: Image.Image, fn: str):
+	""" Save img, which mustn't be changed afterwards since it may be saved later. """
+	write_behind(_save_png, img, fn, paletted)
+
+
+def _cached_image(
+	kind: str, base: int, height: int, decode: Callable[[], Image.Image]
+) -> Image.Image:
+	if cache is None:
+		return decode()
+	key = cache.key(kind, base, height)
+	img = cache.get_image(key)
+	if img is None:
+		img = decode()
+		cache.put_image(key, img)
+	return img
+
+
+@profiled
+def load_tileset(rom: Rom, base: int, height=16):
 	if base not in tilesets:
-		f.seek(base)
-		tilesets[base] = TileDecoder.from_stream(f, height=height)
+		tileset_sources[base] = source_digest(height, rom.view(base, 16 * height * 8))
+		tilesets[base] = _cached_image(
+			"tileset", base, height,
+			lambda: TileDecoder.from_bytes(rom.view(base, 16 * height * 8), height=height)
+		)
 
 
-def save_tileset(f: BinaryIO, base: int):
-	if base in tilesets:
-		raw = encode_tiles(tilesets[base])
-		f.seek(base)
-		f.write(raw)
+@profiled
+def save_tileset(f: RomJournal, base: int) -> int:
+	"""
+	Write only the tiles of the tileset which differ from what's in f at base,
+	and return how many did.
+	"""
+	if base not in tilesets:
+		return 0
+	tiles = np.frombuffer(encode_tiles(tilesets[base]), np.uint8).reshape(-1, 8)
+	current = np.frombuffer(f.view(base, tiles.size), np.uint8)
+	# Tiles past the end of the ROM count as changed, so writing them fails like it should
+	changed = np.ones(len(tiles), bool)
+	n = len(current) // 8
+	changed[:n] = (tiles[:n] != current[:n * 8].reshape(n, 8)).any(axis=1)
+
+	edges = np.flatnonzero(np.diff(np.concatenate(([0], changed.astype(np.int8), [0]))))
+	for start, end in zip(edges[::2].tolist(), edges[1::2].tolist()):
+		f.seek(base + start * 8)
+		f.write(tiles[start:end].tobytes())
+	return int(changed.sum())
 
 
+@profiled
 def write_tileset(tileset: int, folder: str) -> str:
-	img = tilesets[tileset]
 	fn = os.path.join(folder, f"tileset_{tileset:06x}.png")
-	img.save(fn)
+	if fn not in written:
+		if not png_unchanged(fn, tileset_sources.get(tileset)):
+			save_png(tilesets[tileset], fn)
+		written.add(fn)
 	return fn
 
 
-def load_spriteset(f: BinaryIO, base: int, height=16) -> Image.Image:
+@profiled
+def load_spriteset(rom: Rom, base: int, height=16) -> Image.Image:
 	if base not in spritesets:
-		f.seek(base)
-		spritesets[base] = SpriteDecoder.from_stream(f, height=height)
+		spriteset_sources[base] = source_digest(height, rom.view(base, 16 * height * 64))
+		spritesets[base] = _cached_image(
+			"spriteset", base, height,
+			lambda: SpriteDecoder.from_bytes(rom.view(base, 16 * height * 64), height=height)
+		)
 	return spritesets[base]
 
 
-def write_spriteset(spriteset: int, folder: str):
-	img = spritesets[spriteset]
+@profiled
+def save_spriteset(f: BinaryIO, base: int):
+	if base in spritesets:
+		raw = encode_sprites(spritesets[base])
+		f.seek(base)
+		f.write(raw)
+
+
+@profiled
+def write_spriteset(spriteset: int, folder: str) -> str:
 	fn = os.path.join(folder, f"spriteset_{spriteset:06x}.png")
-	img.save(fn)
+	if fn not in written:
+		if not png_unchanged(fn, spriteset_sources.get(spriteset)):
+			save_png(spritesets[spriteset], fn)
+		written.add(fn)
+	return fn
+
+
+@profiled
+def read_spriteset(spriteset: int, folder: str, height=16) -> bool:
+	fn = os.path.join(folder, f"spriteset_{spriteset:06x}.png")
+	if not os.path.exists(fn):
+		return False
+	img = Image.open(fn)
+	if img.size != (16 * 16, height * 16):
+		raise PokeImportError(
+			f"spriteset ${spriteset:06x} must be {16 * 16}x{height * 16}"
+			f", got {img.width}x{img.height}"
+		)
+	# Paletted images are encoded as they are
+	if img.mode == "P":
+		img.load()
+		spritesets[spriteset] = img
+	else:
+		spritesets[spriteset] = img.convert("LA")
+	return True
 
 
 def write_info(track: "GrandPrixTrack", folder: str):
@@ -66,17 +196,38 @@ def write_info(track: "GrandPrixTrack", folder: str):
 		json.dump(dict(track.metadata._asdict()), f, indent=4, sort_keys=True)
 
 
-def render_map(width: int, height: int, map: Sequence[int], tileset: Image.Image) -> Image.Image:
-	width_tiles = tileset.width // 8
-	img = Image.new("L", (width * 8, height * 8))
-	for i, tile in enumerate(map):
-		x = (i % width) * 8
-		y = (i // width) * 8
-		set_x = (tile % width_tiles) * 8
-		set_y = (tile // width_tiles) * 8
-		t = tileset.crop((set_x, set_y, set_x + 8, set_y + 8))
-		img.paste(t, (x, y, x + 8, y + 8))
-	return img
+def tile_atlas(tileset: Image.Image) -> np.ndarray:
+	""" Slice tileset into a (tiles + 1, 8, 8) array. The extra tile is blank. """
+	width_tiles, height_tiles = tileset.width // 8, tileset.height // 8
+	px = np.asarray(tileset.convert("L"))[:height_tiles * 8, :width_tiles * 8]
+	tiles = px.reshape(height_tiles, 8, width_tiles, 8).swapaxes(1, 2).reshape(-1, 8, 8)
+	return np.concatenate((tiles, np.zeros((1, 8, 8), np.uint8)))
+
+
+def load_atlas(base: int) -> np.ndarray:
+	if base not in atlases:
+		atlases[base] = tile_atlas(tilesets[base])
+	return atlases[base]
+
+
+def render_map(
+	width: int, height: int, map: Sequence[int], tileset: Union[Image.Image, np.ndarray]
+) -> Image.Image:
+	""" Render a tilemap with a tileset image, or an atlas of it from tile_atlas. """
+	atlas = tile_atlas(tileset) if isinstance(tileset, Image.Image) else tileset
+	blank = len(atlas) - 1
+
+	if isinstance(map, (bytes, bytearray, memoryview)):
+		tiles = np.frombuffer(map, np.uint8)
+	else:
+		tiles = np.array(map, np.int64)
+	# Cells past the end of the map, or tiles past the end of the tileset, are left blank
+	tiles = tiles[:width * height]
+	idx = np.full(width * height, blank, np.intp)
+	idx[:len(tiles)] = np.where(tiles < blank, tiles, blank)
+
+	px = atlas[idx].reshape(height, width, 8, 8).swapaxes(1, 2).reshape(height * 8, width * 8)
+	return Image.fromarray(np.ascontiguousarray(px), "L")
 
 
 def render_spritemap(
@@ -103,28 +254,62 @@ def render_spritemap(
 	return img
 
 
+@profiled
 def draw_track(track: "GrandPrixTrack", folder: str):
+	sources = (
+		track.source,
+		tileset_sources.get(track.metadata.tileset_base),
+		tileset_sources.get(track.metadata.preview_tileset_base),
+		tileset_sources.get(track.config["titles_grand_prix_tileset"]),
+		tileset_sources.get(track.config["titles_menus_tileset"]),
+	)
+
 	fn = os.path.join(folder, f"{track.ident}_render.png")
-	img = render_map(track.metadata.width, track.metadata.height, track.tilemap, track.tileset)
-	img.save(fn)
+	if not png_unchanged(fn, *sources):
+		img = render_map(
+			track.metadata.width, track.metadata.height, track.tilemap,
+			load_atlas(track.metadata.tileset_base)
+		)
+		save_png(img, fn)
 
 	fn = os.path.join(folder, f"{track.ident}_preview_render.png")
-	img = render_map(
-		track.metadata.preview_map_width, track.metadata.preview_map_height, track.preview_tilemap,
-		track.preview_tileset
-	)
-	img.save(fn)
+	if not png_unchanged(fn, *sources):
+		img = render_map(
+			track.metadata.preview_map_width, track.metadata.preview_map_height,
+			track.preview_tilemap, load_atlas(track.metadata.preview_tileset_base)
+		)
+		save_png(img, fn)
 
 	fn = os.path.join(folder, f"{track.ident}_titles.png")
-	title_idx = track.title_index * 8
+	if png_unchanged(fn, *sources):
+		return
+	title_idx = track.index * 8
+	title_gp = load_atlas(track.config["titles_grand_prix_tileset"])
+	title_rank = load_atlas(track.config["titles_menus_tileset"])
 	img = Image.new("L", (64, 24))
-	title = render_map(8, 1, list(range(title_idx, title_idx + 8)), tilesets[TITLES_GRANDPRIX])
+	title = render_map(8, 1, list(range(title_idx, title_idx + 8)), title_gp)
 	img.paste(title, (0, 0, 64, 8))
-	title = render_map(8, 1, track.title_ranking_tilemap, tilesets[TITLES_RANKING])
+	title = render_map(8, 1, track.title_ranking_tilemap, title_rank)
 	img.paste(title, (0, 8, 64, 16))
-	title = render_map(8, 1, track.title_ditto_tilemap, tilesets[TITLES_RANKING])
+	title = render_map(8, 1, track.title_ditto_tilemap, title_rank)
 	img.paste(title, (0, 16, 64, 24))
-	img.save(fn)
+	save_png(img, fn)
+
+
+@profiled
+def draw_splash(track: "GrandPrixTrack", folder: str):
+	fn = os.path.join(folder, f"splash_{track.ident}.png")
+	bases = track.config["track_screens_gfx_bases"]
+	if png_unchanged(fn, track.source, *(spriteset_sources.get(base) for base in bases)):
+		return
+
+	splash1, splash2 = (spritesets[base] for base in bases)
+	im1 = render_spritemap(6, 2, track.splash_spritemap, splash1)
+	im2 = render_spritemap(6, 2, track.splash_spritemap, splash2)
+	img = Image.new("LA", (im1.width, im1.height * 2))
+	img.paste(im1, (0, 0, im1.width, im1.height))
+	img.paste(im2, (0, im1.height, im2.width, im1.height + im2.height))
+	save_png(img, fn)
 
 
 class BaseTable:
@@ -143,9 +328,8 @@ class BaseTable:
 		self.bsize = bsize
 		self.indices: List[int] = []
 
-	def read(self, f: BinaryIO):
-		f.seek(self.base)
-		raw = f.read(self.count * self.bsize)
+	def read(self, rom: Rom):
+		raw = rom.view(self.base, self.count * self.bsize)
 		res = struct.unpack(["B", "H", "HB"][self.bsize - 1] * self.count, raw)
 		if self.bsize == 3:
 			self.indices = [(hi << 16) | lo for lo, hi in zip(res[::2], res[1::2])]
@@ -155,13 +339,35 @@ class BaseTable:
 		else:
 			raise Exception("show me a use of 1 byte tables")
 
-	def read_entry(self, f: BinaryIO, idx: int) -> bytes:
+	def read_entry(self, rom: Rom, idx: int) -> bytes:
 		raise NotImplementedError
 
-	def iter_entries(self, f: BinaryIO) -> Iterator[bytes]:
+	def iter_entries(self, rom: Rom) -> Iterator[bytes]:
 		raise NotImplementedError
 
 
+class TableIndex(NamedTuple):
+	"""
+	Where the entries of a Table are, by their position in the table.
+	Entry i's data is at starts[i] up to data_ends[i], and the space it owns goes up to ends[i].
+	Anything between the two is padding. Entries sharing data with another own no space.
+	"""
+	starts: List[int]
+	data_ends: List[int]
+	ends: List[int]
+
+	def lengths(self) -> List[int]:
+		return [end - start for start, end in zip(self.starts, self.ends)]
+
+	def padding(self) -> List[Tuple[int, int]]:
+		""" Return [start, end) ranges which entries own but don't use, by address. """
+		return sorted(
+			(data_end, end)
+			for start, data_end, end in zip(self.starts, self.data_ends, self.ends)
+			if end > data_end
+		)
+
+
 class Table(BaseTable):
 	""" A table for poiting to variable-length data. """
 	def __init__(
@@ -173,74 +379,146 @@ class Table(BaseTable):
 		if any(len(e) != self.end_length for e in self.ending):
 			raise Exception("for now, all expected endings must be the same length")
 		self.lengths: List[int] = []
+		self.index = TableIndex([], [], [])
 
 	def _parity(self, x: int) -> bool:
 		assert x <= 0x3fff
 		return bool(sum(map(int, f"{x:b}")) & 1)
 
-	def read(self, f: BinaryIO):
-		super().read(f)
-
-		lookup = {idx: i for i, idx in enumerate(self.indices)}
-		self.lengths = [0] * len(self.indices)
-
-		prev = 0
-		for idx in sorted(self.indices):
-			if prev:
-				self.lengths[lookup[prev]] = idx - prev
-			prev = idx
-
-		f.seek(idx)
-		while f.read(self.end_length) not in self.ending:
-			pass
-
-		maybe_padding = f.read(1)[0]
-		maybe_parity = maybe_padding & 0x40
-		if maybe_padding & 0x80:
-			maybe_padding = ((maybe_padding & 0x3f) << 8) | f.read(1)[0]
+	@profiled
+	def read(self, rom: Rom):
+		if cache is not None:
+			key = cache.key("table-index", self.base, self.count, self.bsize, self.ending)
+			cached = cache.get_json(key)
+			if cached is not None:
+				self.indices = cached[0]
+				self._set_index(TableIndex(*cached[1:]))
+				return
+
+		self._read(rom)
+
+		if cache is not None:
+			cache.put_json(key, [self.indices, *self.index])
+
+	def _set_index(self, index: "TableIndex"):
+		self.index = index
+		self.lengths = index.lengths()
+
+	def _ending_hits(self, data: np.ndarray) -> np.ndarray:
+		""" Offsets in data where any of the endings starts, aligned or not. """
+		n = len(data) - self.end_length + 1
+		if n <= 0:
+			return np.zeros(0, np.intp)
+		hit = np.zeros(n, bool)
+		for ending in self.ending:
+			match = np.ones(n, bool)
+			for j, b in enumerate(ending):
+				match &= data[j:j + n] == b
+			hit |= match
+		return np.flatnonzero(hit)
+
+	def _data_end(self, hits: np.ndarray, offset: int, start: int, end: int) -> Optional[int]:
+		"""
+		Return the address after the first ending in [start, end) which is a whole number
+		of endings from start. hits are from _ending_hits of data which begins at offset.
+		"""
+		for pos in hits[np.searchsorted(hits, start - offset):].tolist():
+			pos += offset
+			if pos + self.end_length > end:
+				break
+			if (pos - start) % self.end_length == 0:
+				return pos + self.end_length
+		return None
+
+	def _read_padding(self, rom: Rom, pos: int) -> int:
+		"""
+		Return the length of the padding block at pos, or 0 if there isn't one.
+		Padding starts with its length, including the length itself, in 6 or 14 bits.
+		Bit 7 of the first byte is set for the 14 bit form and bit 6 is the length's parity.
+		The rest are 00s.
+		"""
+		if pos >= len(rom):
+			return 0
+		head = rom.u8(pos)
+		if head & 0x80:
+			if pos + 1 >= len(rom):
+				return 0
+			length = ((head & 0x3f) << 8) | rom.u8(pos + 1)
 			length_size = 2
 		else:
+			length = head & 0x3f
 			length_size = 1
 
-		if bool(self._parity(maybe_padding)) == bool(maybe_parity):
-			# Padding probably exists of length maybe_padding, including the bytes read.
-			maybe_padding -= length_size
-			padding = f.read(maybe_padding)
-			if any(p for p in padding):
-				# If they're not all 00s, this wasn't padding
-				f.seek(-(maybe_padding + length_size), 1)
-
-		self.lengths[lookup[idx]] = f.tell() - idx
-
-	def _read_entry(self, f: BinaryIO, length: int) -> bytes:
-		ret = f.read(length)
-		# trim to true ending, if there's any padding to ignore
-		for j in range(self.end_length, len(ret), self.end_length):
-			if ret[j - self.end_length:j] in self.ending:
-				return ret[:j]
-		return b""
-
-	def read_entry(self, f: BinaryIO, idx: int) -> bytes:
-		f.seek(self.indices[idx])
-		return self._read_entry(f, self.lengths[idx])
-
-	def iter_entries(self, f: BinaryIO) -> Iterator[bytes]:
+		if self._parity(length) != bool(head & 0x40) or length < length_size:
+			return 0
+		if any(rom.view(pos + length_size, length - length_size)):
+			return 0
+		return length
+
+	def _read(self, rom: Rom):
+		super().read(rom)
 		if not self.indices:
+			self._set_index(TableIndex([], [], []))
 			return
 
-		it = iter(sorted(zip(self.indices, self.lengths, range(len(self.indices)))))
-		base, length, i = next(it)
-		f.seek(base)
-		yield i, f.read(length)
-		for _, length, i in it:
-			yield i, self._read_entry(f, length)
+		# Entries own the space up to the next entry. If several point to the same place,
+		# only the last one owns it.
+		addrs = sorted(set(self.indices))
+		owner = {idx: i for i, idx in enumerate(self.indices)}
+		space_ends = dict(zip(addrs, addrs[1:]))
+
+		# Find where each entry's data ends with one search over all but the last
+		data_ends = {}
+		first, last = addrs[0], addrs[-1]
+		hits = self._ending_hits(np.frombuffer(rom.view(first, last - first), np.uint8))
+		for addr in addrs[:-1]:
+			end = self._data_end(hits, first, addr, space_ends[addr])
+			data_ends[addr] = addr if end is None else end
+
+		# The last entry's data ends with the first ending after it, wherever that is
+		window = 0x100
+		while True:
+			data = np.frombuffer(rom.view(last, window), np.uint8)
+			end = self._data_end(self._ending_hits(data), last, last, last + len(data))
+			if end is not None:
+				break
+			if last + window >= len(rom):
+				raise Exception(f"no ending found for the table entry at ${last:06x}")
+			window *= 4
+		data_ends[last] = end
+
+		# Padding longer than fits in one block is split over several full ones
+		padding = self._read_padding(rom, end)
+		end += padding
+		while padding == 0x3fff:
+			padding = self._read_padding(rom, end)
+			end += padding
+		space_ends[last] = end
+
+		self._set_index(
+			TableIndex(
+				list(self.indices),
+				[data_ends[idx] for idx in self.indices],
+				[space_ends[idx] if owner[idx] == i else idx for i, idx in enumerate(self.indices)],
+			)
+		)
+
+	def read_entry(self, rom: Rom, idx: int) -> bytes:
+		start = self.index.starts[idx]
+		return rom.read(start, self.index.data_ends[idx] - start)
+
+	def iter_entries(self, rom: Rom) -> Iterator[bytes]:
+		for _, i in sorted(zip(self.indices, range(len(self.indices)))):
+			yield i, self.read_entry(rom, i)
 
 	def _write_padding(self, f: BinaryIO, length: int) -> int:
+		if length > 0x3fff:
+			return self._write_padding(f, 0x3fff) + self._write_padding(f, length - 0x3fff)
 		if length:
 			parity = 0x40 if self._parity(length) else 0x00
 
 			if length > 0x3f:
-				written = f.write(bytes((parity | (length >> 8), length & 0xff)))
+				written = f.write(bytes((0x80 | parity | (length >> 8), length & 0xff)))
 				length -= 2
 			else:
 				written = f.write(bytes((parity | length, )))
@@ -249,6 +527,7 @@ class Table(BaseTable):
 			return written + f.write(padding)
 		return 0
 
+	@profiled
 	def write_entry(self, f: BinaryIO, idx: int, data: bytes, pad_extra: bool = True) -> int:
 		if len(data) <= self.lengths[idx]:
 			f.seek(self.indices[idx])
@@ -261,19 +540,30 @@ class Table(BaseTable):
 
 			return written
 
+	@profiled
 	def write_all_entries(self, f: BinaryIO, data: Sequence[bytes], pad_extra: bool = True) -> int:
 		assert len(data) <= self.count
-		f.seek(sorted(self.indices)[0])
+		start, end = self.block()
+		return self._write_block(f, start, data, end - start if pad_extra else 0)
+
+	def _write_block(self, f: BinaryIO, addr: int, data: Sequence[bytes], size: int = 0) -> int:
+		"""
+		Write data contiguously from addr, padded out to size, and point the table at it.
+		Entries with the same data as an earlier one point to that instead.
+		"""
+		f.seek(addr)
 		written = 0
 		new_indices = []
+		placed: Dict[bytes, int] = {}
 		for raw in data:
-			new_indices.append(f.tell())
-			written += f.write(raw)
+			if raw not in placed:
+				placed[raw] = f.tell()
+				written += f.write(raw)
+			new_indices.append(placed[raw])
 
 		# Calculate padding section, if any
-		if pad_extra:
-			pad_length = sum(self.lengths) - written
-			written += self._write_padding(f, pad_length)
+		if size > written:
+			written += self._write_padding(f, size - written)
 
 		# Write new table
 		f.seek(self.base)
@@ -286,6 +576,60 @@ class Table(BaseTable):
 
 		return written
 
+	def block(self) -> Tuple[int, int]:
+		""" The [start, end) range of the ROM the entries and their padding are in. """
+		return min(self.index.starts), max(self.index.ends)
+
+	def reserve(self, space: FreeSpace):
+		"""
+		Claim the pointers and entries from space, except the padding after the last entry,
+		which is free for anything to use.
+		"""
+		space.claim(self.base, self.base + self.count * self.bsize)
+		if self.indices:
+			start, end = self.block()
+			space.claim(start, end)
+			last = self.index.ends.index(end)
+			space.free(self.index.data_ends[last], end)
+
+	@profiled
+	def update(self, f: BinaryIO, data: Dict[int, bytes], space: Optional[FreeSpace] = None) -> int:
+		"""
+		Write the entries in data, by their index, wherever they fit.
+		Return how, as check_conflicts does, except 0 means the entries were all moved
+		somewhere in space, and the space they were in was freed.
+		Whatever the entries now cover is claimed from space, since they may have grown into
+		padding reserve left free.
+		"""
+		res = self.check_conflicts({i: len(raw) for i, raw in data.items()})
+		if res == 1:
+			for idx, raw in data.items():
+				self.write_entry(f, idx, raw, False)
+				if space is not None:
+					space.claim(self.indices[idx], self.indices[idx] + len(raw))
+			return res
+
+		entries = [
+			data[i] if i in data else self.read_entry(f, i) for i in range(len(self.indices))
+		]
+		start, end = self.block()
+		if res == 2:
+			self._write_block(f, start, entries, end - start)
+			if space is not None:
+				space.claim(start, start + len(b"".join(dict.fromkeys(entries))))
+		elif space is None:
+			raise NoSpaceError("the entries don't fit where they are")
+		else:
+			size = len(b"".join(set(entries)))
+			space.free(start, end)
+			try:
+				addr = space.alloc(size, self.base if self.bsize == 2 else None)
+			except NoSpaceError:
+				space.claim(start, end)
+				raise
+			self._write_block(f, addr, entries)
+		return res
+
 	def check_conflicts(self, lengths: Dict[int, int]) -> int:
 		"""
 		Return value:
@@ -305,17 +649,9 @@ class TableFixed(BaseTable):
 		super().__init__(base, count, bsize)
 		self.entry_size = entry_size
 
-	def read_entry(self, f: BinaryIO, idx: int) -> bytes:
-		f.seek(self.indices[idx])
-		return f.read(self.entry_size)
+	def read_entry(self, rom: Rom, idx: int) -> bytes:
+		return rom.read(self.indices[idx], self.entry_size)
 
-	def iter_entries(self, f: BinaryIO) -> Iterator[bytes]:
-		if not self.indices:
-			return
-
-		it = sorted(zip(self.indices, range(len(self.indices))))
-		base, i = next(it)
-		f.seek(base)
-		yield i, f.read(self.entry_size)
-		for _, i in it:
-			yield i, f.read(self.entry_size)
+	def iter_entries(self, rom: Rom) -> Iterator[bytes]:
+		for base, i in sorted(zip(self.indices, range(len(self.indices)))):
+			yield i, rom.read(base, self.entry_size)
@@ -0,0 +1,49 @@
+"""
+Polling a folder for changed files, which needs nothing outside the standard library and works
+the same everywhere, at the cost of noticing changes up to an interval late.
+"""
+import os
+import time
+from typing import Dict, Iterator, List, Tuple
+
+Snapshot = Dict[str, Tuple[int, int]]
+
+# Kinds of files which imports read
+extensions = (".tmx", ".tsx", ".png", ".pmmusic")
+
+
+def snapshot(folder: str) -> Snapshot:
+	""" Modification time and size of each file under folder which imports read. """
+	ret = {}
+	for root, _, files in os.walk(folder):
+		for name in files:
+			if name.endswith(extensions):
+				fn = os.path.join(root, name)
+				try:
+					st = os.stat(fn)
+				except FileNotFoundError:
+					continue
+				ret[fn] = (st.st_mtime_ns, st.st_size)
+	return ret
+
+
+def changes(folder: str, interval: float = 0.5, settle: float = 0.1) -> Iterator[List[str]]:
+	"""
+	Yield the files which were added, changed, or removed since last time, forever.
+	They're only yielded once nothing has changed for settle seconds, so that files which
+	are still being saved aren't read halfway through.
+	"""
+	before = snapshot(folder)
+	while True:
+		time.sleep(interval)
+		now = snapshot(folder)
+		if now == before:
+			continue
+		while True:
+			time.sleep(settle)
+			later = snapshot(folder)
+			if later == now:
+				break
+			now = later
+		yield sorted(fn for fn in before.keys() | now.keys() if before.get(fn) != now.get(fn))
+		before = now
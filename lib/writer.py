@@ -0,0 +1,68 @@
+"""
+Save files on a few threads while the export goes on to the next thing.
+PIL and zlib let go of the GIL while they compress, so saving one track's PNGs overlaps with
+decoding and rendering the next.
+"""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from .profiling import profiled
+
+
+class WriteBehind:
+	"""
+	Runs writes on up to threads threads. Once pending writes are queued or running, submit
+	waits for one to finish, so what's waiting to be written can't pile up in memory.
+	With no threads, each write is done as it's submitted.
+	"""
+	error: Optional[BaseException] = None
+
+	def __init__(self, threads: int = 2, pending: int = 8):
+		self.pending = pending
+		self.slots = threading.BoundedSemaphore(pending)
+		self.pool = ThreadPoolExecutor(threads, thread_name_prefix="writer") if threads else None
+
+	def __enter__(self) -> "WriteBehind":
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def _done(self, future: Future):
+		if future.exception() is not None and self.error is None:
+			self.error = future.exception()
+		self.slots.release()
+
+	def submit(self, fn: Callable[..., object], *args):
+		""" Call fn with args on a writer thread, and raise if an earlier write failed. """
+		self._raise()
+		if self.pool is None:
+			fn(*args)
+			return
+		self.slots.acquire()
+		try:
+			future = self.pool.submit(fn, *args)
+		except BaseException:
+			self.slots.release()
+			raise
+		future.add_done_callback(self._done)
+
+	def _raise(self):
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise error
+
+	@profiled
+	def wait(self):
+		""" Wait for every write so far to finish, and raise the first error any of them had. """
+		for _ in range(self.pending):
+			self.slots.acquire()
+		for _ in range(self.pending):
+			self.slots.release()
+		self._raise()
+
+	def close(self):
+		""" Let what was submitted finish and stop the threads. """
+		if self.pool is not None:
+			self.pool.shutdown(wait=True)
@@ -3,38 +3,221 @@
 import os
 import sys
 import argparse
-from typing import Dict
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence
 from collections import OrderedDict
 
-import tomlkit
-from PIL import Image
+from lib import profiling
+from lib.config import load_config, layer_formats
 
-from lib.maps import save_tmx, load_tmx
-from lib.util import (
-	music, load_tileset, save_tileset, load_spriteset, write_tileset, write_spriteset, draw_track,
-	render_spritemap, Table, PokeImportError
-)
-from lib.sound import write_pmmusic, read_pmmusic, MinLibSound
-from lib.structures import GrandPrixTrack, read2b_base
+# Everything else is imported by the commands which use it, so that the others start quickly
+if TYPE_CHECKING:
+	from lib.rom import RomJournal
+	from lib.structures import GrandPrixTrack
 
 
 class Error(Exception):
 	pass
 
 
-tracks: Dict[str, GrandPrixTrack] = OrderedDict()
-track_types = {"GrandPrixTrack": GrandPrixTrack}
+tracks: Dict[str, "GrandPrixTrack"] = OrderedDict()
+# Loaded before the arguments are parsed, so --no-cache is looked for by hand
+config, track_args = load_config("tracks.toml", cache="--no-cache" not in sys.argv)
+
+
+def load_tracks():
+	""" Make the tracks, once a command needs more than their names. """
+	from lib.structures import GrandPrixTrack
+	track_types = {"GrandPrixTrack": GrandPrixTrack}
+	for name, kwargs in track_args.items():
+		if name not in tracks:
+			kwargs = dict(kwargs)
+			tracks[name] = track_types[kwargs.pop("class")](name, **kwargs, config=config)
+
+
+def import_tracks(
+	f: "RomJournal", folder: str, imports: Sequence[str], explicit: bool = False,
+	check_ai: bool = False, optimize_music: bool = False
+):
+	"""
+	Import the named tracks from folder into f, with the music and sprite sheets.
+	Missing TMX files are only reported for tracks which were named explicitly.
+	"""
+	from lib.maps import load_tmx
+	from lib.util import music, save_tileset, save_spriteset, read_spriteset, Table
+	from lib.alloc import FreeSpace, NoSpaceError
+	from lib.simulate import simulate
+	from lib.sound import read_pmmusic
+	from lib.structures import known_ranges, read2b_base
+
+	sounds = read_pmmusic(folder)
+	for k, v in sounds.items():
+		if k.startswith("track_"):
+			music[int(k[6:])] = v
+
+	update = {"ai": set(), "music": set(), "tilesets": set(), "spritesets": set()}
+	for i in imports:
+		if i not in tracks:
+			print(f"No track named {i}", file=sys.stderr)
+			continue
+		try:
+			track = tracks[i]
+			load_tmx(track, folder)
+			track.write(f, update)
+			print(f"Imported {track.ident}")
+		except FileNotFoundError:
+			if explicit:
+				print(f"No TMX for track {i}", file=sys.stderr)
+				continue
+
+	# The replay's physics haven't been checked against the stock ghosts, so a ghost it says
+	# doesn't finish may well be fine in the game, and is reported without stopping the import
+	if check_ai:
+		failed = [
+			r for r in simulate(sorted(update["ai"], key=lambda t: t.index)) if not r.ok
+		]
+		for report in failed:
+			print(report, file=sys.stderr)
+		if failed:
+			print(f"{len(failed)} AI ghost(s) didn't finish when replayed", file=sys.stderr)
+
+	# Only the tiles of the title tilesets which differ from the ROM's are written
+	changed = save_tileset(f, config["titles_grand_prix_tileset"])
+	changed += save_tileset(f, config["titles_menus_tileset"])
+	print(f"Wrote {changed} changed tile(s) of title tilesets")
+
+	# Everything the tables point to is claimed before any of them can move
+	bgm_table = Table(config["audio_table_base"], config["track_count"], (b"\xf0", b"\xf2"))
+	ai_tables = [
+		Table(read2b_base(f, config["ai_table_base"], i), config["track_count"], b"\xff\x00")
+		for i in (0, 1, 2)
+	]
+	# along with everything else tracks.toml leads to, whose blank tiles and sprites look free
+	space = FreeSpace.scan(f)
+	for start, end in known_ranges(f, config):
+		space.claim(start, end)
+	for table in (bgm_table, *ai_tables):
+		table.read(f)
+		table.reserve(space)
+
+	# Import music
+	raws = {}
+	for m in update["music"]:
+		if m.ident.startswith("track_"):
+			idx = int(m.ident[6:])
+			raws[idx] = music[idx].to_bin()
+
+	# Tables are read again in case one before them moved into their padding
+	bgm_table.read(f)
+	# Songs which changed are optimized, so that edits are more likely to fit in place
+	for idx in sorted(raws):
+		if optimize_music or raws[idx] != bgm_table.read_entry(f, idx):
+			saved = music[idx].optimize()
+			if saved:
+				raws[idx] = music[idx].to_bin()
+				print(f"Optimized track_{idx}, saved {saved} byte(s)")
+	try:
+		res = bgm_table.update(f, raws, space)
+	except NoSpaceError as err:
+		raise Error(f"Cannot import music, {err}") from None
+	if res == 1:
+		for idx in raws:
+			print(f"Wrote sound data track_{idx}")
+	elif res == 2:
+		print("Rewrote music table")
+	else:
+		print("Moved music data to free space")
+
+	# Import AI
+	raws = [{}, {}, {}]
+	mapping = {}
+	track: GrandPrixTrack
+	for track in update["ai"]:
+		raws[0][track.index] = track.ai_easy.to_bin()
+		raws[1][track.index] = track.ai_normal.to_bin()
+		raws[2][track.index] = track.ai_hard.to_bin()
+		mapping[track.index] = track.ident
+
+	for difficulty, ai_table in enumerate(ai_tables):
+		diff_name = ["easy", "normal", "hard"][difficulty]
+		ai_table.read(f)
+		try:
+			res = ai_table.update(f, raws[difficulty], space)
+		except NoSpaceError as err:
+			raise Error(f"Cannot import AI for {diff_name} mode, {err}") from None
+		if res == 1:
+			print(f"Wrote AI data for {diff_name} mode...")
+			for idx in raws[difficulty]:
+				print(f"...{mapping[idx]}")
+		elif res == 2:
+			print(f"Rewrote {diff_name} AI table")
+		else:
+			print(f"Moved {diff_name} AI data to free space")
+
+	# Import tilesets, TODO: ensure correct size
+	changed = sum(save_tileset(f, base) for base in update["tilesets"])
+	print(f"Wrote {changed} changed tile(s) of track tilesets")
+
+	# Import sprite sheets which were exported with -s
+	for base in sorted(update["spritesets"]):
+		if read_spriteset(base, folder, height=12):
+			save_spriteset(f, base)
+			print(f"Wrote spriteset ${base:06x}")
+	for base in config["track_screens_gfx_bases"]:
+		if read_spriteset(base, folder, height=15):
+			save_spriteset(f, base)
+			print(f"Wrote splash screen spriteset ${base:06x}")
+
+
+def tracks_affected(changed: Sequence[str]) -> Optional[List[str]]:
+	"""
+	The tracks to import again once the files in changed have changed, or None if no imports
+	read any of them. The sprite sheets of the splash screens are imported with any track.
+	"""
+	names = set()
+	relevant = False
+	for fn in changed:
+		stem, ext = os.path.splitext(os.path.basename(fn))
+		kind, _, hex_addr = stem.partition("_")
+		if ext == ".pmmusic":
+			return list(tracks.keys())
+		elif ext == ".tmx" and stem in tracks:
+			names.add(stem)
+			relevant = True
+		elif kind in ("tileset", "spriteset") and ext in (".png", ".tsx"):
+			try:
+				addr = int(hex_addr, 16)
+			except ValueError:
+				continue
+			relevant = True
+			for name, track in tracks.items():
+				metadata = getattr(track, "metadata", None)
+				if metadata is None:
+					continue
+				elif kind == "tileset":
+					bases = (metadata.tileset_base, metadata.preview_tileset_base)
+				else:
+					bases = (metadata.sprite_base, )
+				if addr in bases:
+					names.add(name)
+	return [name for name in tracks if name in names] if relevant else None
 
-with open("tracks.toml") as f:
-	obj = tomlkit.loads(f.read())
-	config = {k: v for k, v in obj.items() if not isinstance(v, dict)}
-	for key, kwargs in obj.items():
-		if isinstance(kwargs, dict):
-			t = kwargs.pop("class")
-			tracks[key] = track_types[t](key, **kwargs, config=config)
 
 parser = argparse.ArgumentParser(description="Import and export track data for Pokemon Race mini")
 parser.add_argument("rom", help="Pokemon Race mini ROM file")
+parser.add_argument(
+	"--profile",
+	action="store_true",
+	help=(
+	"Time each stage and track its I/O and memory use, then write a report and a Chrome trace."
+	" With --jobs, work done in the other processes isn't included."
+	)
+)
+parser.add_argument(
+	"--profile-out",
+	default="profile",
+	metavar="PREFIX",
+	help="Write the profile to PREFIX.json and PREFIX.trace.json. Default: profile"
+)
 subparsers = parser.add_subparsers(dest="command")
 subparsers.add_parser("list", aliases=["l"], help="List known tracks.")
 export_parser = subparsers.add_parser(
@@ -66,6 +249,17 @@ export_parser.add_argument(
 export_parser.add_argument(
 	"--png", "-p", action="store_true", help="Export PNGs only, no TMX files."
 )
+export_parser.add_argument(
+	"--paletted",
+	action="store_true",
+	help="Save PNGs as 1 bit paletted images, or 2 bit with transparency, which are smaller."
+)
+export_parser.add_argument(
+	"--layer-format",
+	choices=layer_formats,
+	default=layer_formats[0],
+	help="How to store tile layers in TMX files: compressed (zlib, the default) or readable (csv)."
+)
 export_parser.add_argument(
 	"--tilesets",
 	"-t",
@@ -78,6 +272,24 @@ export_parser.add_argument(
 	action="store_true",
 	help=("Export the spriteset(s) for the specified track(s) as PNGs.")
 )
+export_parser.add_argument(
+	"--no-cache",
+	action="store_true",
+	help="Decode everything from scratch without reading or writing the cache folder."
+)
+export_parser.add_argument(
+	"--force",
+	"-F",
+	action="store_true",
+	help="Write every file, even those which are unchanged since the last export."
+)
+export_parser.add_argument(
+	"--jobs",
+	"-j",
+	type=int,
+	default=1,
+	help="Number of processes to export tracks with."
+)
 export_parser.add_argument(
 	"--render",
 	"-r",
@@ -101,192 +313,323 @@ import_parser.add_argument(
 	help="Folder to look in for TMX/PNG files if not the current directory."
 )
 import_parser.add_argument("--yes", "-y", action="store_true", help="Overwrite without asking.")
+import_parser.add_argument(
+	"--dry-run",
+	"-n",
+	action="store_true",
+	help="Report which bytes of the ROM would change without writing anything."
+)
+import_parser.add_argument(
+	"--patch",
+	"-p",
+	help=(
+	"Write the changes as an IPS or BPS patch (by file extension) against the ROM"
+	" instead of modifying the ROM."
+	)
+)
+import_parser.add_argument(
+	"--atomic",
+	action="store_true",
+	help="Write the new ROM to a temporary file and replace the original with it."
+)
+import_parser.add_argument(
+	"--check-ai",
+	action="store_true",
+	help="Replay the AI of the imported tracks and report any of it which doesn't finish."
+)
+import_parser.add_argument(
+	"--optimize-music",
+	action="store_true",
+	help="Also optimize the imported tracks' songs which haven't changed."
+)
+simulate_parser = subparsers.add_parser(
+	"simulate", aliases=["sim"], help="Replay the AI of tracks and report how each ghost does."
+)
+simulate_parser.add_argument(
+	"tracks",
+	nargs="*",
+	help="Replay the AI of one or more tracks by name. If nothing is specified, all of them."
+)
+simulate_parser.add_argument(
+	"--folder",
+	"-f",
+	help="Replay the AI in the TMX files in this folder instead of what's in the ROM."
+)
+watch_parser = subparsers.add_parser(
+	"watch", help="Import into the ROM each time the files in a folder change, until stopped."
+)
+watch_parser.add_argument(
+	"--folder",
+	"-f",
+	default="",
+	help="Folder to watch for TMX/PNG files if not the current directory."
+)
+watch_parser.add_argument(
+	"--interval",
+	type=float,
+	default=0.5,
+	help="Seconds to wait between looking for changes. Default: 0.5"
+)
+watch_parser.add_argument(
+	"--check-ai",
+	action="store_true",
+	help="Replay the AI of the changed tracks and report any of it which doesn't finish."
+)
+scan_parser = subparsers.add_parser(
+	"scan", help="Look through the ROM for graphics which tracks.toml doesn't lead to."
+)
+scan_parser.add_argument(
+	"--out",
+	"-o",
+	default="",
+	help="Folder to write scan.json and scan.png to if not the current directory."
+)
+scan_parser.add_argument(
+	"--limit",
+	"-n",
+	type=int,
+	default=48,
+	help="How many of the best candidates to list and draw. Default: 48"
+)
 
-written = set()
 
-try:
+def main():
 	args = parser.parse_args()
+	if args.profile:
+		profiling.start()
+
+	try:
+		if args.command in {"l", "list"}:
+			for name in track_args:
+				# TODO: print real names?
+				print(f"* {name}")
+		elif args.command in {"x", "export"}:
+			from lib import util
+			from lib.maps import save_tsx
+			from lib.cache import AssetCache, default_cache_folder
+			from lib.manifest import ExportManifest
+			from lib.export import ExportOptions, export_track, export_tracks
+			from lib.util import (
+				music, load_tileset, load_spriteset, write_tileset, write_spriteset, Table
+			)
+			from lib.sound import write_pmmusic, MinLibSound
+			from lib.structures import read2b_base
+			from lib.rom import Rom
+			from lib.writer import WriteBehind
+
+			load_tracks()
+			# Writing only overlaps with the rest given another CPU to do it on. Several
+			# processes already write alongside each other, and shouldn't be forked from one
+			# with writer threads.
+			threads = min(2, (os.cpu_count() or 1) - 1) if args.jobs <= 1 else 0
+			with Rom.open(args.rom) as rom, WriteBehind(threads) as writer:
+				util.writer = writer
+				if not args.no_cache:
+					util.cache = AssetCache(default_cache_folder(), rom)
+				util.manifest = ExportManifest(args.out, args.force)
+				util.paletted = args.paletted
+
+				# Load name tiles
+				load_tileset(rom, config["titles_grand_prix_tileset"], height=8)
+				load_tileset(rom, config["titles_menus_tileset"])
+
+				# Load splash screen sprites
+				for base in config["track_screens_gfx_bases"]:
+					load_spriteset(rom, base, height=15)
+
+				config["ai_easy_table_base"] = read2b_base(rom, config["ai_table_base"], 0)
+				config["ai_normal_table_base"] = read2b_base(rom, config["ai_table_base"], 1)
+				config["ai_hard_table_base"] = read2b_base(rom, config["ai_table_base"], 2)
 
-	if args.command in {"l", "list"}:
-		for name in tracks.keys():
-			# TODO: print real names?
-			print(f"* {name}")
-	elif args.command in {"x", "export"}:
-		with open(args.rom, "rb") as f:
-			# Load name tiles
-			load_tileset(f, config["titles_grand_prix_tileset"], height=8)
-			load_tileset(f, config["titles_menus_tileset"])
-
-			# Load splash screen sprites
-			splash1 = load_spriteset(f, config["track_screens_gfx_bases"][0], height=15)
-			splash2 = load_spriteset(f, config["track_screens_gfx_bases"][1], height=15)
-
-			config["ai_easy_table_base"] = read2b_base(f, config["ai_table_base"], 0)
-			config["ai_normal_table_base"] = read2b_base(f, config["ai_table_base"], 1)
-			config["ai_hard_table_base"] = read2b_base(f, config["ai_table_base"], 2)
-
-			# Export music
-			bgm_table = Table(config["audio_table_base"], config["track_count"], (b"\xf0", b"\xf2"))
-			bgm_table.read(f)
-			for i, data in bgm_table.iter_entries(f):
-				music[i] = MinLibSound.from_bin(f"track_{i}", data)
-
-			# TODO: don't overwrite what's already there
-			print("Exporting sound data...")
-			write_pmmusic(music.values(), args.out)
-
-			exports = args.tracks if args.tracks else list(tracks.keys())
-			for e in exports:
-				if e.startswith("tileset:"):
-					addr = int(e[8:], 16)
-					load_tileset(f, addr)
-					if args.png:
-						print(f"Rendering tileset ${addr:06x}...")
-						write_tileset(addr, args.out)
+				# Export music
+				bgm_table = Table(
+					config["audio_table_base"], config["track_count"], (b"\xf0", b"\xf2")
+				)
+				bgm_table.read(rom)
+				for i, data in bgm_table.iter_entries(rom):
+					music[i] = MinLibSound.from_bin(f"track_{i}", data)
+
+				print("Exporting sound data...")
+				write_pmmusic(music.values(), args.out)
+
+				opts = ExportOptions(
+					args.out, args.png, args.tilesets, args.spritesets, args.render,
+					args.layer_format
+				)
+				exporting = []
+				exports = args.tracks if args.tracks else list(tracks.keys())
+				for e in exports:
+					if e.startswith("tileset:"):
+						addr = int(e[8:], 16)
+						load_tileset(rom, addr)
+						if args.png:
+							print(f"Rendering tileset ${addr:06x}...")
+							write_tileset(addr, args.out)
+						else:
+							print(f"Exporting tileset ${addr:06x}...")
+							save_tsx(addr, args.out)
+					elif e.startswith("spriteset:"):
+						addr = int(e[10:], 16)
+						load_spriteset(rom, addr)
+						print(f"Rendering spriteset ${addr:06x}...")
+						write_spriteset(addr, args.out)
 					else:
-						raise Error("TSX not implemented yet")
-				elif e.startswith("spriteset:"):
-					addr = int(e[10:], 16)
-					load_spriteset(f, addr)
-					print(f"Rendering spriteset ${addr:06x}...")
-					write_spriteset(addr, args.out)
-				else:
-					# Map name
-					try:
-						track = tracks[e]
-					except KeyError:
-						raise Error(f"no known track {e}")
-					track.read(f)
-
-					if args.render:
-						print(f"Rendering {track.ident}...")
-						draw_track(track, args.out)
-
-					if not args.png:
-						print(f"Exporting track data for {track.ident}...")
-						save_tmx(track, args.out)
-
-					if args.tilesets:
-						print(f"Exporting tilesets for {track.ident}...")
-						if track.metadata.tileset_base not in written:
-							write_tileset(track.metadata.tileset_base, args.out)
-						if track.metadata.preview_tileset_base not in written:
-							write_tileset(track.metadata.preview_tileset_base, args.out)
-
-					if args.spritesets:
-						print(f"Exporting sprite sheet for {track.ident}...")
-						if track.metadata.sprite_base not in written:
-							write_spriteset(track.metadata.sprite_base, args.out)
-						print(f"Exporting splash screen for {track.ident}...")
-						im1 = render_spritemap(6, 2, track.splash_spritemap, splash1)
-						im2 = render_spritemap(6, 2, track.splash_spritemap, splash2)
-						im = Image.new("LA", (im1.width, im1.height * 2))
-						im.paste(im1, (0, 0, im1.width, im1.height))
-						im.paste(im2, (0, im1.height, im2.width, im1.height + im2.height))
-						im.save(os.path.join(args.out, f"splash_{track.ident}.png"))
-
-	elif args.command in {"i", "import"}:
-		afn = os.path.abspath(args.rom)
-		if not args.yes:
-			r = input(f"Are you sure you want to overwrite the contents of {afn}? [n] ")
-			if r != "y":
-				sys.exit(0)
-		with open(args.rom, "r+b") as f:
-			imports = args.tracks if args.tracks else list(tracks.keys())
-			sounds = read_pmmusic(args.folder)
-			for k, v in sounds.items():
-				if k.startswith("track_"):
-					music[int(k[6:])] = v
-
-			update = {"ai": set(), "music": set(), "tilesets": set(), "spritesets": set()}
-			for i in imports:
-				if i not in tracks:
-					print(f"No track named {i}", file=sys.stderr)
-					continue
+						# Map name
+						try:
+							track = tracks[e]
+						except KeyError:
+							raise Error(f"no known track {e}")
+						track.read(rom)
+						if args.jobs > 1:
+							exporting.append(track)
+						else:
+							export_track(track, opts)
+
+				export_tracks(exporting, opts, args.jobs)
+				# The manifest records the size and time of what was written
+				writer.wait()
+				if util.manifest:
+					util.manifest.save()
+
+		elif args.command in {"i", "import"}:
+			from lib.rom import Rom, RomJournal
+			from lib.patch import write_patch, patch_formats
+
+			load_tracks()
+			afn = os.path.abspath(args.rom)
+			if args.patch and os.path.splitext(args.patch)[1].lower() not in patch_formats:
+				raise Error(f"patch must be one of: {', '.join(patch_formats)}")
+			if not args.yes and not args.dry_run and not args.patch:
+				r = input(f"Are you sure you want to overwrite the contents of {afn}? [n] ")
+				if r != "y":
+					sys.exit(0)
+			with Rom.open(args.rom) as original:
+				f = RomJournal(original)
+
+			import_tracks(
+				f, args.folder, args.tracks or list(tracks.keys()), bool(args.tracks),
+				args.check_ai, args.optimize_music
+			)
+
+			if args.dry_run:
+				print("\n".join(f.report()))
+			elif args.patch:
+				size = write_patch(f, args.patch)
+				print(f"Wrote {size} byte patch to {os.path.abspath(args.patch)}")
+			else:
+				written = f.commit(args.rom, atomic=args.atomic)
+				print(f"Wrote {written} bytes to {afn}")
+		elif args.command == "watch":
+			import time
+			from lib.rom import Rom, RomJournal
+			from lib.watch import changes
+
+			load_tracks()
+			afn = os.path.abspath(args.rom)
+			folder = args.folder or os.curdir
+			with Rom.open(args.rom) as original:
+				f = RomJournal(original)
+
+			def reimport(imports: Sequence[str]):
+				start = time.perf_counter()
 				try:
-					track = tracks[i]
-					load_tmx(track, args.folder)
-					track.write(f, update)
-					print(f"Imported {track.ident}")
-				except FileNotFoundError:
-					if args.tracks:
-						print(f"No TMX for track {i}", file=sys.stderr)
-						continue
-
-			# Save title tilesets wholesale, TODO: consider saving partially?
-			save_tileset(f, config["titles_grand_prix_tileset"])
-			save_tileset(f, config["titles_menus_tileset"])
-			print("Wrote title tilesets")
-
-			# TODO: reallocate tables as needed
-			# for now, just make sure lengths are <= what's there
-			# Import music
-			raws = {}
-			lengths = {}
-			for m in update["music"]:
-				if m.ident.startswith("track_"):
-					idx = int(m.ident[6:])
-					raws[idx] = music[idx].to_bin()
-					lengths[idx] = len(raws[idx])
-
-			bgm_table = Table(config["audio_table_base"], config["track_count"], (b"\xf0", b"\xf2"))
-			bgm_table.read(f)
-			res = bgm_table.check_conflicts(lengths)
-			if res == 0:
-				raise Error(
-					"Cannot import music, result would be too large, and relocation is not yet supported."
-				)
-			elif res == 1:
-				# Import per song in-place
-				for idx, raw in raws.items():
-					bgm_table.write_entry(f, idx, raw, False)
-					print(f"Wrote sound data track_{idx}")
-			elif res == 2:
-				# Rewrite pointer array and overwrite entire music block
-				bgm_table.write_all_entries(f, (v for k, v in sorted(raws.items())), False)
-				print("Rewrote music table")
-
-			# Import AI
-			raws = [{}, {}, {}]
-			lengths = [{}, {}, {}]
-			mapping = {}
-			track: GrandPrixTrack
-			for track in update["ai"]:
-				raw = raws[0][track.index] = track.ai_easy.to_bin()
-				lengths[0][track.index] = len(raw)
-				raw = raws[1][track.index] = track.ai_normal.to_bin()
-				lengths[1][track.index] = len(raw)
-				raw = raws[2][track.index] = track.ai_hard.to_bin()
-				lengths[2][track.index] = len(raw)
-				mapping[track.index] = track.ident
-
-			for difficulty in (0, 1, 2):
-				diff_name = ["easy", "normal", "hard"][difficulty]
-				ai_table_base = read2b_base(f, config["ai_table_base"], difficulty)
-				ai_table = Table(ai_table_base, config["track_count"], b"\xff\x00")
-				ai_table.read(f)
-				res = ai_table.check_conflicts(lengths[difficulty])
-				if res == 0:
-					raise Error(
-						f"Cannot import AI for {diff_name} mode, result would be too large, and relocation is not yet supported."
+					import_tracks(f, args.folder, imports, check_ai=args.check_ai)
+				except Exception as err:
+					# A file saved in a bad state only loses this change, not the whole session
+					f.revert()
+					print(f"Error: {err}", file=sys.stderr)
+					return
+				written = f.commit(args.rom)
+				print(f"Wrote {written} bytes to {afn} in {time.perf_counter() - start:.2f}s")
+
+			reimport(list(tracks.keys()))
+			print(f"Watching {os.path.abspath(folder)} for changes, press Ctrl+C to stop")
+			try:
+				for changed in changes(folder, args.interval):
+					imports = tracks_affected(changed)
+					if imports is not None:
+						print(f"Changed {', '.join(os.path.relpath(fn, folder) for fn in changed)}")
+						reimport(imports)
+			except KeyboardInterrupt:
+				print("Stopped watching")
+		elif args.command in {"sim", "simulate"}:
+			from lib.maps import load_tmx
+			from lib.simulate import simulate
+			from lib.structures import read2b_base
+			from lib.rom import Rom
+
+			load_tracks()
+			replay = []
+			for name in args.tracks if args.tracks else tracks.keys():
+				if name not in tracks:
+					raise Error(f"no known track {name}")
+				replay.append(tracks[name])
+
+			if args.folder is None:
+				with Rom.open(args.rom) as rom:
+					for i, name in enumerate(("easy", "normal", "hard")):
+						config[f"ai_{name}_table_base"] = read2b_base(rom, config["ai_table_base"], i)
+					for track in replay:
+						track.read(rom)
+			else:
+				found = []
+				for track in replay:
+					try:
+						load_tmx(track, args.folder)
+						found.append(track)
+					except FileNotFoundError:
+						if args.tracks:
+							raise Error(f"no TMX for track {track.ident}")
+				replay = found
+
+			reports = simulate(replay)
+			for report in reports:
+				print(report)
+			failed = sum(not r.ok for r in reports)
+			print(f"{len(reports) - failed} of {len(reports)} ghosts finished")
+			if failed:
+				sys.exit(1)
+		elif args.command == "scan":
+			import json
+			from lib.scan import scan, contact_sheet
+			from lib.structures import known_ranges
+			from lib.rom import Rom
+
+			with Rom.open(args.rom) as rom:
+				found = scan(rom, known_ranges(rom, config))
+				best = found[:args.limit]
+				for i, c in enumerate(best, 1):
+					print(
+						f"{i:3}. {c.kind:9} ${c.start:06x}~${c.end - 1:06x}"
+						f" {c.count:4} {c.kind[:-3]}s, score {c.score:.2f}"
 					)
-				elif res == 1:
-					# Import per AI in-place
-					print(f"Writing AI data for {diff_name} mode...")
-					for idx, raw in raws[difficulty].items():
-						bgm_table.write_entry(f, idx, raw, False)
-						print(f"...{mapping[idx]}")
-				elif res == 2:
-					# Rewrite pointer array and overwrite entire AI block
-					bgm_table.write_all_entries(f, (v for k, v in sorted(raws.items())), False)
-					print("Rewrote {diff_name} AI table")
-
-			# Import tilesets, TODO: ensure correct size
-			for base in update["tilesets"]:
-				save_tileset(f, base)
-			print("Wrote track tilesets")
-	else:
-		raise Error(f"Unknown(?) command {args.command}")
+				if best:
+					print(f"{len(found)} candidate(s), export one with eg. x {best[0].target}")
+				else:
+					print("Found nothing")
+
+				os.makedirs(args.out or os.curdir, exist_ok=True)
+				with open(os.path.join(args.out, "scan.json"), "wt", encoding="utf8") as f:
+					json.dump([{
+						"kind": c.kind,
+						"start": c.start,
+						"end": c.end,
+						"score": round(c.score, 3),
+						"export": c.target,
+					} for c in found], f, indent="\t")
+				if best:
+					contact_sheet(rom, best).save(os.path.join(args.out, "scan.png"))
+		else:
+			raise Error(f"Unknown(?) command {args.command}")
+
+	except Error as err:
+		print(f"Error: {err.args[0]}", file=sys.stderr)
+	finally:
+		if args.profile:
+			profiling.stop()
+			for fn in profiling.save(args.profile_out):
+				print(f"Wrote profile to {os.path.abspath(fn)}")
+
 
-except Error as err:
-	print(f"Error: {err.args[0]}", file=sys.stderr)
+if __name__ == "__main__":
+	main()
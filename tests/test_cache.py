@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from lib import cache as cache_module
+from lib.cache import AssetCache
+from lib.rom import Rom
+
+
+def _cache(tmp_path, max_size: int) -> AssetCache:
+	return AssetCache(str(tmp_path), Rom(bytes(0x100)), max_size)
+
+
+def test_failed_put_leaves_no_temporary_file(tmp_path, monkeypatch):
+	c = _cache(tmp_path, 0x1000)
+
+	def fail(src, dst):
+		raise OSError("disk full")
+
+	monkeypatch.setattr(cache_module.os, "replace", fail)
+	with pytest.raises(OSError):
+		c.put(c.key("tileset", 0), b"\x00" * 8)
+	assert os.listdir(tmp_path) == []
+
+
+def test_folder_is_only_scanned_past_the_limit(tmp_path, monkeypatch):
+	c = _cache(tmp_path, 0x100)
+	scans = []
+	evict = c.evict
+	monkeypatch.setattr(c, "evict", lambda: (scans.append(c.size), evict()))
+
+	for addr in range(4):
+		c.put(c.key("tileset", addr), b"\x00" * 0x40)
+	# Once to find the size, then the folder fits until a fifth entry is put
+	assert len(scans) == 1
+	c.put(c.key("tileset", 4), b"\x00" * 0x40)
+	assert len(scans) == 2
+	assert c.size <= 0x100
+	assert len(os.listdir(tmp_path)) == 4
@@ -0,0 +1,37 @@
+import os
+
+from lib import config as config_module
+from lib.config import load_config
+
+
+def _toml(tmp_path) -> str:
+	fn = tmp_path / "tracks.toml"
+	fn.write_text('track_count = 1\n\n[Track1]\nindex = 0\n', encoding="utf8")
+	return str(fn)
+
+
+def test_parsed_copy_is_reused(tmp_path):
+	folder = str(tmp_path / "cache")
+	fn = _toml(tmp_path)
+	first = load_config(fn, folder)
+	assert first == ({"track_count": 1}, {"Track1": {"index": 0}})
+	assert len(os.listdir(folder)) == 1
+	assert load_config(fn, folder) == first
+
+
+def test_no_cache_leaves_the_folder_alone(tmp_path):
+	folder = tmp_path / "cache"
+	load_config(_toml(tmp_path), str(folder), cache=False)
+	assert not folder.exists()
+
+
+def test_failed_write_leaves_no_temporary_file(tmp_path, monkeypatch):
+	folder = tmp_path / "cache"
+
+	def fail(src, dst):
+		raise OSError("read-only")
+
+	monkeypatch.setattr(config_module.os, "replace", fail)
+	config, tracks = load_config(_toml(tmp_path), str(folder))
+	assert config == {"track_count": 1}
+	assert os.listdir(folder) == []
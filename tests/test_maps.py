@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from lib import util
+from lib.config import layer_formats, load_config
+from lib.maps import load_tmx, made_tilesets, save_tmx
+from lib.rom import Rom
+from lib.sound import MinLibSound
+from lib.structures import GrandPrixTrack, read2b_base
+from lib.synthetic import make_rom
+from lib.tmx import TileMap
+from lib.util import Table
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def rom_and_config():
+	config, _ = load_config(os.path.join(HERE, "tracks.toml"), cache=False)
+	rom = Rom(make_rom(config))
+	for i, name in enumerate(("easy", "normal", "hard")):
+		config[f"ai_{name}_table_base"] = read2b_base(rom, config["ai_table_base"], i)
+	return rom, config
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+	for d in (util.music, util.tilesets, util.tileset_sources, made_tilesets):
+		d.clear()
+	yield
+	for d in (util.music, util.tilesets, util.tileset_sources, made_tilesets):
+		d.clear()
+
+
+def _read(rom: Rom, config: dict, index: int) -> GrandPrixTrack:
+	util.load_tileset(rom, config["titles_grand_prix_tileset"], height=8)
+	util.load_tileset(rom, config["titles_menus_tileset"])
+	bgm_table = Table(config["audio_table_base"], config["track_count"], (b"\xf0", b"\xf2"))
+	bgm_table.read(rom)
+	for i, data in bgm_table.iter_entries(rom):
+		util.music[i] = MinLibSound.from_bin(f"track_{i}", data)
+	track = GrandPrixTrack(f"Track{index}", index, config=config)
+	track.read(rom)
+	return track
+
+
+@pytest.mark.parametrize("layer_format", layer_formats)
+@pytest.mark.parametrize("index", (0, 7))
+def test_save_then_load_is_identical(tmp_path, rom_and_config, layer_format, index):
+	rom, config = rom_and_config
+	track = _read(rom, config, index)
+	folder = str(tmp_path)
+	save_tmx(track, folder, layer_format)
+	with open(os.path.join(folder, f"{track.ident}.tmx"), encoding="utf8") as f:
+		assert f'encoding="{"csv" if layer_format == "csv" else "base64"}"' in f.read()
+
+	loaded = GrandPrixTrack(track.ident, index, config=config)
+	load_tmx(loaded, folder)
+	assert loaded.tilemap == track.tilemap
+	assert loaded.preview_tilemap == track.preview_tilemap
+	assert loaded.metadata == track.metadata
+	assert loaded.bases["metadata"] == track.bases["metadata"]
+	for difficulty in ("easy", "normal", "hard"):
+		ghost = f"ai_{difficulty}"
+		assert getattr(loaded, ghost).to_bin() == getattr(track, ghost).to_bin()
+		assert getattr(loaded, ghost).to_string() == getattr(track, ghost).to_string()
+
+
+def test_objects_are_stored_by_their_top_edge(tmp_path, rom_and_config):
+	rom, config = rom_and_config
+	track = _read(rom, config, 0)
+	save_tmx(track, str(tmp_path))
+
+	# Tiled and tmxlib put a rectangle's y at its top, where MapObject keeps its bottom
+	fn = str(tmp_path / f"{track.ident}.tmx")
+	with open(fn, encoding="utf8") as f:
+		text = f.read()
+	x, y = track.metadata.starting_x, track.metadata.starting_y
+	assert f'name="StartingPos" x="{x}" y="{y - 16}" width="16" height="16"' in text
+	pos = TileMap.open(fn).layers["Track objects"]["StartingPos"]
+	assert (pos.x, pos.y, pos.width, pos.height) == (x, y, 16, 16)
@@ -0,0 +1,108 @@
+import struct
+import zlib
+from typing import List, Tuple
+
+import numpy as np
+import pytest
+
+from lib.patch import IPS_EOF, make_bps, make_ips
+from lib.rom import Rom, RomJournal
+
+# Big enough to reach past the offset which IPS would read as "EOF"
+SIZE = 0x480000
+ORIGINAL = np.random.RandomState(0).randint(0, 0x100, SIZE, np.uint8).tobytes()
+
+
+def apply_ips(source: bytes, patch: bytes) -> bytes:
+	assert patch[:5] == b"PATCH"
+	ret = bytearray(source)
+	pos = 5
+	while patch[pos:pos + 3] != b"EOF":
+		addr = int.from_bytes(patch[pos:pos + 3], "big")
+		size, = struct.unpack_from(">H", patch, pos + 3)
+		pos += 5
+		if size:
+			ret[addr:addr + size] = patch[pos:pos + size]
+			pos += size
+		else:
+			run, = struct.unpack_from(">H", patch, pos)
+			ret[addr:addr + run] = patch[pos + 2:pos + 3] * run
+			pos += 3
+	assert pos + 3 == len(patch)
+	return bytes(ret)
+
+
+def _bps_number(patch: bytes, pos: int) -> Tuple[int, int]:
+	n, shift = 0, 1
+	while True:
+		x = patch[pos]
+		pos += 1
+		n += (x & 0x7f) * shift
+		if x & 0x80:
+			return n, pos
+		shift <<= 7
+		n += shift
+
+
+def apply_bps(source: bytes, patch: bytes) -> bytes:
+	assert patch[:4] == b"BPS1"
+	assert struct.unpack("<I", patch[-4:])[0] == zlib.crc32(patch[:-4])
+	source_size, pos = _bps_number(patch, 4)
+	target_size, pos = _bps_number(patch, pos)
+	metadata, pos = _bps_number(patch, pos)
+	assert source_size == len(source)
+	pos += metadata
+
+	ret = bytearray()
+	while pos < len(patch) - 12:
+		data, pos = _bps_number(patch, pos)
+		action, length = data & 3, (data >> 2) + 1
+		if action == 0:
+			ret += source[len(ret):len(ret) + length]
+		elif action == 1:
+			ret += patch[pos:pos + length]
+			pos += length
+		else:
+			raise AssertionError(f"unexpected action {action}")
+	assert len(ret) == target_size
+	assert struct.unpack("<II", patch[-12:-4]) == (zlib.crc32(source), zlib.crc32(ret))
+	return bytes(ret)
+
+
+def _journal(writes: List[Tuple[int, bytes]]) -> RomJournal:
+	f = RomJournal(Rom(ORIGINAL))
+	for addr, data in writes:
+		f.seek(addr)
+		f.write(data)
+	return f
+
+
+cases = {
+	"scattered": [(0x10, b"\x01\x02\x03"), (0x18, b"\x04"), (0x1000, b"\xaa" * 0x20)],
+	"long runs": [(0x20000, b"\x00" * 0x12345), (0x40000, bytes(range(0x100)) * 0x180)],
+	"literal at eof": [(IPS_EOF, b"\x12\x34\x56")],
+	"literal over eof": [(IPS_EOF - 2, b"\x12\x34\x56\x78\x9a")],
+	"byte at eof": [(IPS_EOF, b"\x99")],
+	"run at eof": [(IPS_EOF, b"\xff" * 0x20)],
+	"run over eof": [(IPS_EOF - 0x10, b"\x00" * 0x20)],
+	"run ending at eof": [(IPS_EOF - 0x0f, b"\x00" * 0x10), (IPS_EOF + 1, b"\x77")],
+	"end of rom": [(SIZE - 3, b"\x01\x02\x03")],
+}
+
+
+@pytest.mark.parametrize("writes", cases.values(), ids=cases.keys())
+def test_ips_applies_to_the_original(writes):
+	f = _journal(writes)
+	assert apply_ips(f.original, make_ips(f)) == bytes(f.data)
+
+
+@pytest.mark.parametrize("writes", cases.values(), ids=cases.keys())
+def test_bps_applies_to_the_original(writes):
+	f = _journal(writes)
+	assert apply_bps(f.original, make_bps(f)) == bytes(f.data)
+
+
+def test_nothing_changed():
+	f = _journal([])
+	assert make_ips(f) == b"PATCHEOF"
+	assert apply_bps(f.original, make_bps(f)) == f.original
@@ -0,0 +1,56 @@
+from lib.alloc import FreeSpace
+from lib.rom import Rom, RomJournal
+from lib.util import Table
+
+BANK = 0x030000
+A_BASE = BANK
+B_BASE = BANK + 4
+
+
+def _journal() -> RomJournal:
+	"""
+	A bank with two AI-style tables of two entries each, whose data is packed one after the
+	other and followed by padding, then free space to the end of the bank.
+	"""
+	f = RomJournal(Rom(bytes(0x40000)))
+	a = Table(A_BASE, 2, b"\xff\x00")
+	a._write_block(f, BANK + 0x100, [b"\x01\x09\xff\x00", b"\x01\x08\xff\x00"], 0x48)
+	b = Table(B_BASE, 2, b"\xff\x00")
+	b._write_block(f, BANK + 0x148, [b"\x02\x09\xff\x00", b"\x02\x08\xff\x00"], 0x18)
+	return f
+
+
+def _update_both(a_data: dict, b_data: dict) -> RomJournal:
+	""" Update A then B like import_tracks does the AI tables, and return the result. """
+	f = _journal()
+	a, b = Table(A_BASE, 2, b"\xff\x00"), Table(B_BASE, 2, b"\xff\x00")
+	space = FreeSpace.scan(f)
+	for table in (a, b):
+		table.read(f)
+		table.reserve(space)
+	a.update(f, a_data, space)
+	assert b.update(f, b_data, space) == 0
+	return f
+
+
+def _entries(f: Rom, base: int) -> list:
+	table = Table(base, 2, b"\xff\x00")
+	table.read(f)
+	return [table.read_entry(f, i) for i in range(2)]
+
+
+def test_entry_grown_into_padding_is_not_reused():
+	grown = b"\x03\x09" * 0x18 + b"\xff\x00"
+	b_data = {0: b"\x04\x09" * 0x10 + b"\xff\x00"}
+	f = _update_both({1: grown}, b_data)
+	assert _entries(f, A_BASE) == [b"\x01\x09\xff\x00", grown]
+	assert _entries(f, B_BASE)[0] == b_data[0]
+
+
+def test_repacked_table_is_not_reused():
+	# The first entry only fits once the second one's padding is given to it
+	grown = b"\x03\x09" * 0x0f + b"\xff\x00"
+	b_data = {0: b"\x04\x09" * 0x10 + b"\xff\x00"}
+	f = _update_both({0: grown, 1: b"\x01\x08\xff\x00"}, b_data)
+	assert _entries(f, A_BASE) == [grown, b"\x01\x08\xff\x00"]
+	assert _entries(f, B_BASE)[0] == b_data[0]